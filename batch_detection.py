@@ -0,0 +1,217 @@
+import argparse
+import collections
+import math
+import multiprocessing
+import os
+import time
+
+import cv2
+
+import gesture_detection
+import landmark_detection
+
+'''
+Offline gesture classification of recorded footage.
+
+Work is spread over a pool of processes, every process owns its own mediapipe Hands model
+(created once when the process starts). Results always come back in frame order.
+
+    # video file: every worker decodes its own range of frames, no frames are sent between processes
+    results = classify_video("recording.mp4", workers=8)
+
+    # any iterable of BGR frames: frames are sent to the workers in chunks
+    for gesture, hand in iter_classify(frames, workers=8, chunk_size=16):
+        ...
+
+Each result is a (gesture, hand) tuple, gesture is a string or None and hand is the
+landmark_detection.HandResult (or None if no hand was found).
+
+A video is split into one contiguous range per worker (at most RANGE_SIZE frames, long videos
+get more ranges than workers). A range is opened and sought once and then decoded in order:
+seeking decodes again from the keyframe before the target, and some codecs do not land on the
+exact frame, so seeks are kept rare. If the position after a seek is not the requested frame the
+range is decoded from the start of the file instead.
+
+The frame count of a video is an estimate for many containers: the last range is decoded up to
+the end of the file, and if a range ends early (seek or decode error) the frames it is missing
+are returned as (None, None), so every result still belongs to the frame at its position.
+
+Frames of a chunk are not processed in order with the previous chunk, so the model runs in
+static image mode (every frame is detected on its own) and results do not depend on the
+number of workers or the chunk size.
+'''
+
+
+class Helper:
+    WORKERS = os.cpu_count() or 1
+    CHUNK_SIZE = 32
+    # chunks (or video ranges) waiting per worker, keeps memory bounded for long recordings
+    CHUNKS_IN_FLIGHT = 2
+    # most frames of a video decoded by a process after one seek, the results of a range are held
+    # until it is done
+    RANGE_SIZE = 2048
+
+
+# model of the current worker process
+_hands = None
+
+
+def _init_worker():
+    global _hands
+    _hands = landmark_detection.init(static_image_mode=True)
+
+
+def _classify(image):
+    hand = landmark_detection.detect_landmarks(image, _hands)
+    return gesture_detection.detect_gesture(hand), hand
+
+
+def _classify_chunk(images):
+    return [_classify(image) for image in images]
+
+
+# video file positioned at frame `start`
+def _open_at(path, start):
+    cap = cv2.VideoCapture(path)
+    if start == 0:
+        return cap
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == start:
+        return cap
+    # the codec can not seek to the exact frame, skip the frames before the range instead
+    cap.release()
+    cap = cv2.VideoCapture(path)
+    for _ in range(start):
+        if not cap.grab():
+            break
+    return cap
+
+
+# decodes and classifies frames [start, start + count) of a video file (count None -> up to the end)
+def _classify_video_range(path, start, count):
+    cap = _open_at(path, start)
+    results = []
+    image = None
+    while count is None or len(results) < count:
+        is_read, image = cap.read(image)
+        if not is_read:
+            break
+        results.append(_classify(image))
+    cap.release()
+    return results
+
+
+def _chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# runs tasks on the pool keeping at most `in_flight` of them queued, yields the result of every task in order
+def _ordered(pool, function, tasks, in_flight):
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, task))
+        if len(pending) >= in_flight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def iter_classify(frames, workers=Helper.WORKERS, chunk_size=Helper.CHUNK_SIZE):
+    """
+    Classifies an iterable of frames on a pool of processes
+    :param frames: iterable of BGR images
+    :param workers: number of processes
+    :param chunk_size: frames sent to a process at once
+    :return: generator of (gesture, hand) in frame order
+    """
+    with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+        tasks = ((chunk,) for chunk in _chunks(frames, chunk_size))
+        for results in _ordered(pool, _classify_chunk, tasks, workers * Helper.CHUNKS_IN_FLIGHT):
+            yield from results
+
+
+def classify_frames(frames, workers=Helper.WORKERS, chunk_size=Helper.CHUNK_SIZE):
+    return list(iter_classify(frames, workers, chunk_size))
+
+
+def iter_classify_video(path, workers=Helper.WORKERS, chunk_size=Helper.CHUNK_SIZE, range_size=Helper.RANGE_SIZE):
+    """
+    Classifies every frame of a video file on a pool of processes
+    :param path: video file
+    :param workers: number of processes
+    :param chunk_size: frames sent to a process at once if the video has no frame count (frames are decoded here)
+    :param range_size: most frames decoded by a process after a single seek
+    :return: generator of (gesture, hand) in frame order, (None, None) for frames that could not be decoded
+    """
+    cap = cv2.VideoCapture(path)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if frame_count <= 0:
+        # frame count is unknown for some containers, decode here and send the frames instead
+        cap = cv2.VideoCapture(path)
+        yield from iter_classify(_read_video(cap), workers, chunk_size)
+        return
+
+    # one range per worker, more (of at most range_size frames) for long videos, the frame count
+    # may be an estimate so the last range goes on to the end of the file
+    size = max(min(math.ceil(frame_count / workers), range_size), 1)
+    ranges = [(start, size if start + size < frame_count else None) for start in range(0, frame_count, size)]
+    # frames missing from the ranges so far, only known to be missing once a later range has frames
+    missing = 0
+    with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+        tasks = ((path, start, count) for start, count in ranges)
+        for (start, count), results in zip(ranges, _ordered(pool, _classify_video_range, tasks,
+                                                            workers * Helper.CHUNKS_IN_FLIGHT)):
+            if missing and results:
+                print(f"{path}: {missing} frames before frame {start} could not be decoded")
+                yield from [(None, None)] * missing
+                missing = 0
+            yield from results
+            if count is not None:
+                missing += count - len(results)
+
+
+def classify_video(path, workers=Helper.WORKERS, chunk_size=Helper.CHUNK_SIZE, range_size=Helper.RANGE_SIZE):
+    return list(iter_classify_video(path, workers, chunk_size, range_size))
+
+
+def _read_video(cap):
+    while True:
+        is_read, image = cap.read()
+        if not is_read:
+            break
+        yield image
+    cap.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Label the gestures of every frame of a video file")
+    parser.add_argument("video")
+    parser.add_argument("--workers", type=int, default=Helper.WORKERS)
+    parser.add_argument("--chunk-size", type=int, default=Helper.CHUNK_SIZE,
+                        help="frames sent to a process at once (videos without a frame count)")
+    parser.add_argument("--range-size", type=int, default=Helper.RANGE_SIZE,
+                        help="most frames a process decodes after one seek")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    gestures = collections.Counter()
+    frames = 0
+    for index, (gesture, _) in enumerate(iter_classify_video(args.video, args.workers, args.chunk_size, args.range_size)):
+        print(f"{index},{gesture if gesture is not None else ''}")
+        gestures[gesture] += 1
+        frames += 1
+    elapsed = time.perf_counter() - start
+    print(f"Frames -> {frames} in {elapsed:.1f}s ({frames / max(elapsed, 1e-9):.1f} fps) with {args.workers} workers")
+    print(f"Gestures -> {dict(gestures)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import gesture_classifier
+import gesture_debouncer
+import gesture_detection
+import landmark_detection
+import landmark_recording
+import pattern_detection
+
+'''
+Per-stage latency benchmark of the main loop.
+
+Every stage of a frame is timed on its own, on recorded frames (--video), on recorded landmarks
+(--recording) and on synthetic images and landmarks:
+    capture          cap.read() of a video file
+    cvtColor         BGR -> RGB conversion done before inference
+    hands_process    mediapipe Hands.process()
+    landmark_stage   landmark_detection.run() (conversion + inference + landmark array)
+    classify         gesture_detection.detect_gesture()
+    classify_rules   gesture_detection.detect_gesture_reference() (original rule chain)
+    classify_model   learned classifier of --classifier (see gesture_classifier.py)
+    pattern          pattern_detection.pattern_recognition() (path tracking, no API calls)
+    circle_fit       pattern_detection.is_circle_found() on a tracker holding a circle path
+    display          cv2.imshow() + cv2.waitKey(1) (only with --display)
+
+For every stage p50/p95/p99 latency (ms), frames per second and bytes allocated per frame are
+reported and written as JSON, so results can be compared across commits:
+
+    python benchmark.py --video clip.mp4 --recording session.lmrec --output before.json
+    python benchmark.py --video clip.mp4 --recording session.lmrec --compare before.json
+
+--commits compares the debouncers instead (see landmark_recording.replay_commits): a learned
+classifier is trained on made up hand poses (a random template per class, rotated, scaled, moved
+and with noise), then a labelled session of SEGMENTS gestures is replayed through the WINDOW and
+EVIDENCE debouncers. Every segment is 20 frames without a hand, 10 frames of a hand making no
+gesture and then either a clear pose (60%), an ambiguous pose blended with another gesture (25%)
+or a hand flipping between two poses that is not meant as a gesture (15%). Same seed, same session:
+
+    python benchmark.py --commits
+'''
+
+
+class Helper:
+    ITERATIONS = 300
+    WARMUP = 10
+    # a stage is a regression if its p50 or p95 got slower by more than this
+    REGRESSION_THRESHOLD = 0.10
+    SYNTHETIC_SIZE = (480, 640)
+    OUTPUT = "benchmark_results.json"
+    # --commits: gestures in the session, frames of every gesture (and of "no gesture") to train on
+    SEGMENTS = 120
+    TRAINING_FRAMES = 500
+    FPS = 30
+    SEED = 3
+
+
+# times `function(item)` for every item, returns the latencies in seconds
+def _time_stage(function, items, iterations):
+    for index in range(min(Helper.WARMUP, iterations)):
+        function(items[index % len(items)])
+    latencies = np.empty(iterations)
+    for index in range(iterations):
+        item = items[index % len(items)]
+        start = time.perf_counter()
+        function(item)
+        latencies[index] = time.perf_counter() - start
+    return latencies
+
+
+# transient memory allocated by one call of `function`, averaged over the items
+def _allocations(function, items, iterations):
+    iterations = min(iterations, len(items) * 4, 100)
+    tracemalloc.start()
+    allocated = 0
+    for index in range(iterations):
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        function(items[index % len(items)])
+        _, peak = tracemalloc.get_traced_memory()
+        allocated += peak - baseline
+    tracemalloc.stop()
+    return allocated / max(iterations, 1)
+
+
+def benchmark_stage(name, function, items, iterations=Helper.ITERATIONS):
+    """
+    Measures one stage
+    :param name: stage name
+    :param function: called with one item per frame
+    :param items: inputs of the stage (frames, hands, ...)
+    :param iterations: number of timed calls
+    :return: dict with the measurements of the stage
+    """
+    latencies = _time_stage(function, items, iterations)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    result = {
+        "stage": name,
+        "iterations": iterations,
+        "p50_ms": round(float(p50), 4),
+        "p95_ms": round(float(p95), 4),
+        "p99_ms": round(float(p99), 4),
+        "fps": round(float(1 / max(latencies.mean(), 1e-12)), 1),
+        "alloc_bytes_per_frame": round(_allocations(function, items, iterations)),
+    }
+    print(f"{name:<26} p50 {result['p50_ms']:>9.3f} ms  p95 {result['p95_ms']:>9.3f} ms  "
+          f"p99 {result['p99_ms']:>9.3f} ms  {result['fps']:>10.1f} fps  {result['alloc_bytes_per_frame']:>9} B/frame")
+    return result
+
+
+def _synthetic_frames(count=8):
+    rng = np.random.default_rng(0)
+    height, width = Helper.SYNTHETIC_SIZE
+    frames = [rng.integers(0, 256, (height, width, 3), np.uint8) for _ in range(count // 2)]
+    frames += [np.full((height, width, 3), value, np.uint8) for value in np.linspace(0, 255, count - len(frames))]
+    return frames
+
+
+def _synthetic_hands(count=64):
+    rng = np.random.default_rng(0)
+    height, width = Helper.SYNTHETIC_SIZE
+    return [landmark_detection.HandResult(rng.random((landmark_detection.Helper.NUM_LANDMARKS, 3)).astype(np.float32),
+                                          landmark_detection.Helper.RIGHT_HAND, 1.0, width, height)
+            for _ in range(count)]
+
+
+# index finger pointing up and moving along a circle, like someone drawing the pattern
+def _circle_hands(count=120):
+    height, width = Helper.SYNTHETIC_SIZE
+    hands = []
+    for angle in np.linspace(0, 4 * np.pi, count):
+        points = np.full((landmark_detection.Helper.NUM_LANDMARKS, 3), 0.8, np.float32)
+        points[gesture_detection.HandLandmark.INDEX_FINGER_TIP, 0] = 0.5 + 0.2 * np.cos(angle)
+        points[gesture_detection.HandLandmark.INDEX_FINGER_TIP, 1] = 0.5 + 0.2 * np.sin(angle)
+        hands.append(landmark_detection.HandResult(points, landmark_detection.Helper.RIGHT_HAND, 1.0, width, height))
+    return hands
+
+
+# landmarks of a made up pose: template `index` rotated, scaled, moved and with noise,
+# `blend` (other template, weight) mixes in another pose
+def _synthetic_pose(templates, rng, index, noise=0.01, blend=None):
+    height, width = Helper.SYNTHETIC_SIZE
+    aspect = np.array((width / height, 1))
+    xy = templates[index] * aspect
+    if blend is not None:
+        other, weight = blend
+        xy = (1 - weight) * xy + weight * templates[other] * aspect
+    angle = rng.normal(0, 0.25)
+    rotation = np.array(((math.cos(angle), -math.sin(angle)), (math.sin(angle), math.cos(angle))))
+    xy = (xy - xy.mean(axis=0)) @ rotation.T * rng.uniform(0.3, 1) + rng.uniform(0.3, 0.7, 2) * aspect
+    xy += rng.normal(0, noise, xy.shape)
+    points = np.zeros((landmark_detection.Helper.NUM_LANDMARKS, 3), np.float32)
+    points[:, :2] = xy / aspect
+    return landmark_detection.HandResult(points, landmark_detection.Helper.RIGHT_HAND, 1.0, width, height)
+
+
+# one labelled recording per gesture (and one of "no gesture") to train a classifier on
+def _synthetic_training(directory, templates, rng, frames=Helper.TRAINING_FRAMES):
+    height, width = Helper.SYNTHETIC_SIZE
+    labels = list(gesture_detection.GESTURES) + [landmark_recording.Helper.NONE_LABEL]
+    paths = []
+    for index, label in enumerate(labels):
+        path = os.path.join(directory, f"{label}.lmrec")
+        recorder = landmark_recording.LandmarkRecorder(path, width, height, label=label)
+        # there are many more ways to hold a hand without making a gesture
+        for frame in range(frames * (len(labels) - 1) if label == landmark_recording.Helper.NONE_LABEL else frames):
+            recorder.write(frame / Helper.FPS, _synthetic_pose(templates, rng, index), None)
+        recorder.close()
+        paths.append(path)
+    return paths
+
+
+# labelled session of `segments` gestures (see the module docstring)
+def _synthetic_session(path, templates, rng, segments=Helper.SEGMENTS):
+    height, width = Helper.SYNTHETIC_SIZE
+    gestures = gesture_detection.GESTURES
+    no_gesture = len(gestures)
+    recorder = landmark_recording.LandmarkRecorder(path, width, height, label=landmark_recording.Helper.NONE_LABEL)
+    labelled = []
+
+    def write(hand):
+        recorder.write(recorder.count / Helper.FPS, hand, None)
+
+    for _ in range(segments):
+        gesture = int(rng.integers(0, len(gestures)))
+        kind = rng.random()
+        for _ in range(20):
+            write(None)
+        for _ in range(10):
+            write(_synthetic_pose(templates, rng, no_gesture))
+        start = recorder.count
+        if kind < 0.6:
+            for _ in range(int(rng.integers(20, 45))):
+                write(_synthetic_pose(templates, rng, gesture))
+            labelled.append((start, recorder.count, gestures[gesture]))
+        elif kind < 0.85:
+            other = int(rng.integers(0, len(gestures)))
+            for _ in range(int(rng.integers(30, 60))):
+                write(_synthetic_pose(templates, rng, gesture, blend=(other, 0.42)))
+            labelled.append((start, recorder.count, gestures[gesture]))
+        else:
+            other = (gesture + 1) % len(gestures)
+            for frame in range(30):
+                write(_synthetic_pose(templates, rng, gesture if frame % 2 else other, noise=0.02))
+    recorder.close()
+    for start, end, label in labelled:
+        landmark_recording.relabel(path, label, start, end)
+
+
+def benchmark_commits(segments=Helper.SEGMENTS, seed=Helper.SEED, bound=gesture_debouncer.Helper.BOUND):
+    """
+    Time-to-commit and false commits of the WINDOW and EVIDENCE debouncers on a synthetic labelled session
+    :param segments: gestures in the session
+    :param seed: seed of the poses and the session
+    :param bound: evidence needed to confirm a gesture (EVIDENCE)
+    :return: dict of debouncer name -> landmark_recording.replay_commits() result
+    """
+    rng = np.random.default_rng(seed)
+    templates = rng.random((len(gesture_detection.GESTURES) + 1, landmark_detection.Helper.NUM_LANDMARKS, 2))
+    with tempfile.TemporaryDirectory() as directory:
+        batch, labels = gesture_classifier.load_recordings(_synthetic_training(directory, templates, rng))
+        classifier = gesture_classifier.train(batch, labels)
+        session = os.path.join(directory, "session.lmrec")
+        _synthetic_session(session, templates, rng, segments)
+        debouncers = {
+            "window": gesture_debouncer.GestureDebouncer(gesture_detection.GESTURES),
+            "evidence": gesture_debouncer.EvidenceDebouncer(gesture_detection.GESTURES, gesture_detection.CLASSES,
+                                                            bound=bound),
+        }
+        return landmark_recording.replay_commits(session, debouncers, classifier)
+
+
+# calls `function(hand)` as if the hand was a new frame: HandResult builds its landmark list once
+# and keeps it, without the reset the rule chain would only pay for building it on the first call
+def _fresh_hand(function):
+    def call(hand):
+        if hand is not None:
+            hand._landmark = None
+        return function(hand)
+    return call
+
+
+def _read_video(path, limit):
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < limit:
+        is_read, image = cap.read()
+        if not is_read:
+            break
+        frames.append(image)
+    cap.release()
+    return frames
+
+
+def _recorded_hands(path):
+    recording = landmark_recording.LandmarkReplay(path)
+    hands = [recording.hand(index) for index in range(len(recording))]
+    return [hand for hand in hands if hand is not None] or [None]
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(video=None, recording=None, iterations=Helper.ITERATIONS, display=False, classifier=None):
+    results = []
+    frame_sets = {"synthetic": _synthetic_frames()}
+    if video is not None:
+        frame_sets["video"] = _read_video(video, iterations)
+        # cap.read() is timed on the video file itself
+        cap = cv2.VideoCapture(video)
+        buffer = [None]
+
+        def read_frame(_):
+            is_read, buffer[0] = cap.read(buffer[0])
+            if not is_read:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        results.append(benchmark_stage("capture", read_frame, [None], iterations))
+        cap.release()
+
+    try:
+        hands_model = landmark_detection.init()
+    except Exception as error:
+        print(f"Skipping model stages, hand landmark model unavailable ({error})")
+        hands_model = None
+
+    for source, frames in frame_sets.items():
+        if not frames:
+            continue
+        results.append(benchmark_stage(f"cvtColor[{source}]", lambda image: cv2.cvtColor(image, cv2.COLOR_BGR2RGB),
+                                       frames, iterations))
+        if hands_model is not None:
+            rgb_frames = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in frames]
+            results.append(benchmark_stage(f"hands_process[{source}]", hands_model.process, rgb_frames, iterations))
+            results.append(benchmark_stage(f"landmark_stage[{source}]",
+                                           lambda image: landmark_detection.run(image, hands_model), frames, iterations))
+
+    hand_sets = {"synthetic": _synthetic_hands(), "circle": _circle_hands()}
+    if recording is not None:
+        hand_sets["recording"] = _recorded_hands(recording)
+    for source, hands in hand_sets.items():
+        results.append(benchmark_stage(f"classify[{source}]", _fresh_hand(gesture_detection.detect_gesture),
+                                       hands, iterations))
+        results.append(benchmark_stage(f"classify_rules[{source}]", _fresh_hand(gesture_detection.detect_gesture_reference),
+                                       hands, iterations))
+        if classifier is not None:
+            results.append(benchmark_stage(f"classify_model[{source}]", _fresh_hand(classifier.classify), hands,
+                                           iterations))
+
+    pattern_data = pattern_detection.init()
+    pattern_data.on_circle = lambda direction: None
+    pattern_detection.reset_pattern(pattern_data)
+    results.append(benchmark_stage("pattern[circle]", lambda hand: pattern_detection.run(hand, pattern_data),
+                                   _circle_hands(), iterations))
+
+    circle_data = pattern_detection.init(draw=False)
+    for angle in np.linspace(0, 2 * np.pi, 120, endpoint=False):
+        circle_data.add_point(int(250 + 120 * np.cos(angle)), int(250 + 120 * np.sin(angle)))
+    results.append(benchmark_stage("circle_fit", lambda data: pattern_detection.is_circle_found(data),
+                                   [circle_data], iterations))
+
+    if display:
+        frames = frame_sets.get("video") or frame_sets["synthetic"]
+
+        def show(image):
+            cv2.imshow("camera", image)
+            cv2.waitKey(1)
+        results.append(benchmark_stage("display", show, frames, iterations))
+        cv2.destroyAllWindows()
+
+    return results
+
+
+# stages of `results` that got slower than in `baseline`
+def find_regressions(results, baseline, threshold=Helper.REGRESSION_THRESHOLD):
+    previous = {stage["stage"]: stage for stage in baseline["stages"]}
+    regressions = []
+    for stage in results["stages"]:
+        old = previous.get(stage["stage"])
+        if old is None:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            if old[metric] > 0 and stage[metric] > old[metric] * (1 + threshold):
+                regressions.append(f"{stage['stage']} {metric}: {old[metric]} -> {stage[metric]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the gesture detection loop")
+    parser.add_argument("--video", help="video file to take frames from")
+    parser.add_argument("--recording", help="landmark recording to take hands from (see landmark_recording.py)")
+    parser.add_argument("--iterations", type=int, default=Helper.ITERATIONS)
+    parser.add_argument("--display", action="store_true", help="also benchmark cv2.imshow/cv2.waitKey")
+    parser.add_argument("--output", default=Helper.OUTPUT, help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON results of a previous run, exit with 1 if a stage got slower")
+    parser.add_argument("--threshold", type=float, default=Helper.REGRESSION_THRESHOLD)
+    parser.add_argument("--classifier", help="learned gesture classifier to benchmark (see gesture_classifier.py)")
+    parser.add_argument("--commits", action="store_true",
+                        help="compare the debouncers on a synthetic labelled session instead of timing the stages")
+    args = parser.parse_args()
+    if args.commits:
+        for name, result in benchmark_commits().items():
+            print(f"Commits [{name}] -> {result}")
+        return
+    classifier = gesture_detection.init(args.classifier) if args.classifier else None
+
+    results = {
+        "commit": _git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "stages": run_benchmarks(args.video, args.recording, args.iterations, args.display, classifier),
+    }
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results -> {args.output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = find_regressions(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print(f"Regression -> {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import threading
+import time
+
+import cv2
+
+'''
+Background camera capture.
+
+A capture thread reads frames from the camera as fast as the camera delivers them and writes
+them into a small ring of preallocated frame buffers, so nothing backs up in the driver buffer.
+The processing loop always gets the freshest frame ("latest frame wins"): a frame that was not
+read before a newer one arrived is dropped and counted.
+
+The frame handed out by read() is the ring buffer itself (no copy). The capture thread will not
+write into it until it is given back with release(), so keep the ring larger than the number of
+frames held at the same time (+2, one being written and one waiting to be read).
+
+Usage:
+    capture = CameraCapture(1)
+    capture.start()
+    frame = capture.read()
+    ... use frame.image ...
+    capture.release(frame)
+    capture.stop()
+'''
+
+
+class Helper:
+    BUFFERS = 4
+    READ_TIMEOUT = 1.0
+    NO_SLOT = -1
+
+
+class Frame:
+    def __init__(self, image, timestamp, index, slot):
+        # BGR image, this is a buffer of the ring and is only valid until released
+        self.image = image
+        # time.monotonic() when the frame was read from the camera
+        self.timestamp = timestamp
+        # number of the frame since the capture started
+        self.index = index
+        self.slot = slot
+
+
+class CameraCapture:
+    def __init__(self, source, buffers=Helper.BUFFERS, on_frame=None):
+        """
+        :param source: camera index or video file
+        :param buffers: number of frame buffers in the ring
+        :param on_frame: called from the capture thread (with no lock held) when a new frame can be
+                         read or the capture stopped, lets one thread wait on many cameras
+        """
+        self.source = source
+        self.on_frame = on_frame
+        self.cap = cv2.VideoCapture(source)
+        self.buffers = [None] * buffers
+        self.timestamps = [0.0] * buffers
+        self.indexes = [0] * buffers
+        # number of readers currently holding each buffer
+        self.holds = [0] * buffers
+        # buffer with the newest frame and whether it was already handed out
+        self.latest = Helper.NO_SLOT
+        self.latest_consumed = True
+        self.last_index = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        # counters
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.frames_processed = 0
+
+    def start(self):
+        # read the first frame here to find out the frame size and preallocate the ring
+        is_read, image = self.cap.read()
+        if not is_read:
+            raise RuntimeError(f"Unable to read from camera {self.source}")
+        self.buffers = [image.copy() for _ in self.buffers]
+        self.running = True
+        self.thread = threading.Thread(target=self.__capture, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        self.cap.release()
+
+    def read(self, timeout=Helper.READ_TIMEOUT):
+        """
+        Waits for a frame newer than the last one read
+        :param timeout: seconds to wait for a frame
+        :return: Frame or None if the capture stopped (and its last frame was read) or no frame arrived in time
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: not self.latest_consumed or not self.running, timeout):
+                return None
+            # the last frame of a file (or before a disconnect) is still handed out
+            if self.latest_consumed:
+                return None
+            slot = self.latest
+            self.latest_consumed = True
+            self.holds[slot] += 1
+            self.frames_processed += 1
+            return Frame(self.buffers[slot], self.timestamps[slot], self.indexes[slot], slot)
+
+    # give a frame back to the ring so the capture thread can reuse its buffer
+    def release(self, frame):
+        with self.condition:
+            self.holds[frame.slot] -= 1
+
+    def stats(self):
+        return {
+            "captured": self.frames_captured,
+            "dropped": self.frames_dropped,
+            "processed": self.frames_processed,
+        }
+
+    # find a buffer that is neither held by a reader nor waiting to be read
+    def __free_slot(self):
+        with self.condition:
+            for slot in range(len(self.buffers)):
+                if slot != self.latest and self.holds[slot] == 0:
+                    return slot
+        return Helper.NO_SLOT
+
+    def __capture(self):
+        while self.running:
+            slot = self.__free_slot()
+            if slot == Helper.NO_SLOT:
+                # every buffer is in use, skip this frame
+                if self.cap.grab():
+                    with self.condition:
+                        self.frames_dropped += 1
+                continue
+
+            # decode straight into the ring buffer (no allocation while the frame size is unchanged)
+            is_read, image = self.cap.read(self.buffers[slot])
+            timestamp = time.monotonic()
+            if not is_read:
+                # camera disconnected or end of file
+                with self.condition:
+                    self.running = False
+                    self.condition.notify_all()
+                if self.on_frame is not None:
+                    self.on_frame()
+                break
+
+            with self.condition:
+                self.buffers[slot] = image
+                self.timestamps[slot] = timestamp
+                self.last_index += 1
+                self.indexes[slot] = self.last_index
+                self.frames_captured += 1
+                # the previous frame was never read, latest frame wins
+                if not self.latest_consumed:
+                    self.frames_dropped += 1
+                self.latest = slot
+                self.latest_consumed = False
+                self.condition.notify_all()
+            if self.on_frame is not None:
+                self.on_frame()
@@ -0,0 +1,144 @@
+import collections
+import threading
+import time
+
+'''
+Non-blocking command dispatcher.
+
+API calls (Nest, Spotify, Kasa) can take seconds, so the video loop only puts commands on a
+queue and worker threads run them. Every device has its own queue and worker ("lane"):
+    - commands of the same device run one at a time and in order
+    - commands of different devices run at the same time
+    - a command that waited longer than its deadline is dropped, the user has moved on
+    - a new command for a device supersedes (cancels) the commands of that device that are
+      still queued or running, e.g. "pause" right after "play" drops the "play"
+
+A running API call can not be interrupted, so cancellation is cooperative: the action receives
+its Command and should check `command.cancelled` before doing anything else (like speaking the
+result).
+
+Usage:
+    dispatcher = CommandDispatcher()
+    dispatcher.submit("spotify", action, arg1, arg2)    # runs action(command, arg1, arg2)
+    dispatcher.stop()
+'''
+
+
+class Helper:
+    # seconds a command may wait in the queue before it is dropped
+    DEADLINE = 5.0
+    STOP_TIMEOUT = 1.0
+
+
+class Command:
+    def __init__(self, device, action, args, deadline):
+        self.device = device
+        self.action = action
+        self.args = args
+        self.created = time.monotonic()
+        self.deadline = self.created + deadline
+        self.__cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.__cancelled.is_set()
+
+    def cancel(self):
+        self.__cancelled.set()
+
+    def is_stale(self):
+        return time.monotonic() > self.deadline
+
+
+# queue and worker thread of one device
+class _Lane:
+    def __init__(self, device, dispatcher):
+        self.device = device
+        self.queue = collections.deque()
+        self.running = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=dispatcher._run_lane, args=(self,), daemon=True)
+
+
+class CommandDispatcher:
+    def __init__(self, deadline=Helper.DEADLINE):
+        self.deadline = deadline
+        self.lanes = {}
+        self.lock = threading.Lock()
+        self.stopped = False
+        # counters
+        self.executed = 0
+        self.failed = 0
+        self.dropped_stale = 0
+        self.superseded = 0
+
+    def submit(self, device, action, *args, supersede=True, deadline=None):
+        """
+        Queues a command for a device, returns right away
+        :param device: name of the device, commands of the same device run one at a time
+        :param action: called as action(command, *args) on the worker of the device
+        :param supersede: cancel the queued and running commands of the device
+        :param deadline: seconds the command may wait before it is dropped
+        :return: the Command
+        """
+        command = Command(device, action, args, self.deadline if deadline is None else deadline)
+        lane = self.__lane(device)
+        with lane.condition:
+            if supersede:
+                self.superseded += len(lane.queue)
+                for queued in lane.queue:
+                    queued.cancel()
+                lane.queue.clear()
+                if lane.running is not None:
+                    lane.running.cancel()
+            lane.queue.append(command)
+            lane.condition.notify()
+        return command
+
+    def stop(self):
+        self.stopped = True
+        for lane in list(self.lanes.values()):
+            with lane.condition:
+                lane.condition.notify()
+            lane.thread.join(Helper.STOP_TIMEOUT)
+
+    def stats(self):
+        return {
+            "executed": self.executed,
+            "failed": self.failed,
+            "dropped_stale": self.dropped_stale,
+            "superseded": self.superseded,
+            "queued": {device: len(lane.queue) for device, lane in self.lanes.items()},
+        }
+
+    def __lane(self, device):
+        with self.lock:
+            lane = self.lanes.get(device)
+            if lane is None:
+                lane = self.lanes[device] = _Lane(device, self)
+                lane.thread.start()
+            return lane
+
+    # worker of a lane, runs the commands of one device in order
+    def _run_lane(self, lane):
+        while True:
+            with lane.condition:
+                lane.condition.wait_for(lambda: lane.queue or self.stopped)
+                if self.stopped:
+                    return
+                command = lane.queue.popleft()
+                if command.is_stale():
+                    self.dropped_stale += 1
+                    continue
+                lane.running = command
+
+            try:
+                command.action(command, *command.args)
+                self.executed += 1
+            except Exception as error:
+                # a failing API call must not stop the device's worker
+                self.failed += 1
+                print(f"Command for {lane.device} failed: {error}")
+            finally:
+                with lane.condition:
+                    lane.running = None
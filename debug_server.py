@@ -0,0 +1,182 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+
+'''
+Debug view for headless units.
+
+Deployed units have no screen, so nothing is drawn by default. The debug server streams the
+camera with the hand landmarks and the pattern path drawn on it as MJPEG over HTTP
+(open http://<unit>:8080/ in a browser, or `curl http://<unit>:8080/snapshot.jpg -o frame.jpg`).
+
+Drawing only happens while someone is watching: publish() takes a function that renders the
+frame and only calls it when a viewer is connected and the last frame is older than 1/max_fps,
+so frames cost nothing when nobody is looking.
+
+Usage:
+    server = DebugServer(8080).start()
+    server.publish(lambda: render(image, hand, pattern_data))
+    server.stop()
+'''
+
+
+class Helper:
+    HOST = "127.0.0.1"
+    PORT = 8080
+    MAX_FPS = 5
+    JPEG_QUALITY = 70
+    BOUNDARY = "frame"
+    # seconds a viewer waits for a frame before checking if the server stopped
+    VIEWER_TIMEOUT = 1.0
+    LANDMARK_COLOR = (0, 255, 0)
+    PATH_COLOR = (255, 255, 255)
+    LANDMARK_RADIUS = 4
+    PATH_THICKNESS = 3
+
+
+class DebugServer:
+    def __init__(self, port=Helper.PORT, host=Helper.HOST, max_fps=Helper.MAX_FPS):
+        """
+        :param port: port of the HTTP server
+        :param host: address to listen on (default: this machine only)
+        :param max_fps: frames rendered per second at most while a viewer is connected
+        """
+        self.address = (host, port)
+        self.interval = 1 / max_fps
+        self.condition = threading.Condition()
+        self.jpeg = None
+        self.frame_number = 0
+        self.last_render = 0.0
+        self.viewers = 0
+        self.stopped = False
+        self.server = None
+        self.thread = None
+        # counters
+        self.rendered = 0
+
+    @property
+    def watched(self):
+        return self.viewers > 0
+
+    def start(self):
+        self.server = ThreadingHTTPServer(self.address, _handler(self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        print(f"Debug view -> http://{self.address[0]}:{self.server.server_port}/")
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def publish(self, render):
+        """
+        Renders and sends a frame if a viewer is connected and it is time for a new frame
+        :param render: returns the BGR image to send, only called when it is sent
+        :return: True if the frame was rendered
+        """
+        now = time.monotonic()
+        if not self.watched or now - self.last_render < self.interval:
+            return False
+        self.last_render = now
+        is_encoded, jpeg = cv2.imencode(".jpg", render(), [cv2.IMWRITE_JPEG_QUALITY, Helper.JPEG_QUALITY])
+        if not is_encoded:
+            return False
+        with self.condition:
+            self.jpeg = jpeg.tobytes()
+            self.frame_number += 1
+            self.rendered += 1
+            self.condition.notify_all()
+        return True
+
+    def stats(self):
+        return {"viewers": self.viewers, "rendered": self.rendered}
+
+    # waits for a frame newer than `frame_number`, returns (frame number, jpeg) or None if stopped
+    def next_frame(self, frame_number):
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame_number != frame_number or self.stopped, Helper.VIEWER_TIMEOUT)
+            if self.stopped:
+                return None
+            return self.frame_number, self.jpeg
+
+    def add_viewer(self, count):
+        with self.condition:
+            self.viewers += count
+
+
+# request handler bound to a server
+def _handler(debug_server):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/snapshot.jpg":
+                self.__snapshot()
+            elif self.path == "/":
+                self.__stream()
+            else:
+                self.send_error(404)
+
+        # one frame, the viewer counts as connected until it is rendered
+        def __snapshot(self):
+            debug_server.add_viewer(1)
+            try:
+                frame = debug_server.next_frame(debug_server.frame_number)
+            finally:
+                debug_server.add_viewer(-1)
+            if frame is None or frame[1] is None:
+                self.send_error(503)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(frame[1])))
+            self.end_headers()
+            self.wfile.write(frame[1])
+
+        def __stream(self):
+            self.send_response(200)
+            self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={Helper.BOUNDARY}")
+            self.end_headers()
+            debug_server.add_viewer(1)
+            frame_number = debug_server.frame_number
+            try:
+                while True:
+                    frame = debug_server.next_frame(frame_number)
+                    if frame is None:
+                        return
+                    if frame[0] == frame_number or frame[1] is None:
+                        continue
+                    frame_number, jpeg = frame
+                    self.wfile.write(f"--{Helper.BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                                     f"Content-Length: {len(jpeg)}\r\n\r\n".encode())
+                    self.wfile.write(jpeg)
+                    self.wfile.write(b"\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # viewer closed the page
+                pass
+            finally:
+                debug_server.add_viewer(-1)
+
+        # no log line for every request
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+# camera frame as seen by the user (mirrored) with the landmarks and the pattern path drawn on it
+def render(image, hand, pattern_data=None):
+    view = cv2.flip(image, 1)
+    if hand is not None:
+        for x, y, _ in hand.to_pixels(mirror=True):
+            cv2.circle(view, (int(x), int(y)), Helper.LANDMARK_RADIUS, Helper.LANDMARK_COLOR, cv2.FILLED)
+    if pattern_data is not None and pattern_data.count > 1:
+        path = pattern_data.points[:pattern_data.count].reshape(-1, 1, 2)
+        cv2.polylines(view, [path], False, Helper.PATH_COLOR, Helper.PATH_THICKNESS)
+    return view
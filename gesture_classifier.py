@@ -0,0 +1,395 @@
+import argparse
+import math
+
+import numpy as np
+
+import gesture_detection
+import landmark_recording
+from gesture_detection import HandLandmark
+
+'''
+Learned gesture classifier.
+
+The hand written rules (see gesture_detection) compare raw image coordinates against fixed
+thresholds, so they depend on how far the user sits from the camera and how the hand is tilted.
+This classifier learns the gestures from labelled landmark recordings instead.
+
+Features are normalized before they are classified:
+    translation  landmarks are relative to the wrist
+    scale        divided by the wrist -> middle finger MCP distance (the palm length)
+    rotation     rotated so the palm points up
+The direction the palm pointed to before it was rotated is kept as two extra features (scaled
+by ORIENTATION_WEIGHT): thumb up and thumb down are the same hand shape, only turned around.
+x is scaled by the aspect ratio of the frame first, so angles are the same as in the image.
+
+Two engines, both pure numpy with no per-landmark python code at inference:
+    mlp   one hidden layer (default), a hand costs less than the rules (detect_gesture): the
+          normalization is folded into the first layer, see MLPClassifier.hand_confidences()
+    knn   k nearest training frames (at most MAX_SAMPLES of them are kept), needs no training
+          but costs more than the rules, for quick experiments on small recordings
+Compare them with `python benchmark.py --classifier gestures.npz` (classify_model stage).
+
+Both return a confidence for every class: GESTURES in gesture_detection order followed by "no
+gesture". The gesture is the most confident class if its confidence is at least min_confidence.
+
+Labels are the ground truth of the recordings (label column, see landmark_recording), never the
+gesture the rules found: frames without a hand or without a label are skipped, frames labelled
+"none" teach the "no gesture" class. A trained model is a compact .npz file.
+
+Usage:
+    # one recording per gesture, plus one of hand movements that are no gesture
+    python gesture_detection_main.py --record fist.lmrec --label fist
+    python gesture_detection_main.py --record none.lmrec --label none
+
+    python gesture_classifier.py train session1.lmrec session2.lmrec --engine mlp --output gestures.npz
+    python gesture_classifier.py evaluate gestures.npz session3.lmrec
+
+    classifier = gesture_detection.init("gestures.npz")
+    gesture = gesture_detection.run(hand, classifier)
+    gesture, confidences = classifier.classify(hand)
+'''
+
+
+class Helper:
+    MLP, KNN = "mlp", "knn"
+    ENGINES = (MLP, KNN)
+    # GESTURES followed by "no gesture"
+    NUM_CLASSES = len(gesture_detection.GESTURES) + 1
+    NO_GESTURE = len(gesture_detection.GESTURES)
+    # a gesture is only returned if the classifier is at least this confident
+    MIN_CONFIDENCE = 0.6
+    ORIENTATION_WEIGHT = 2.0
+    # features of a hand: 20 landmarks (the wrist is the origin) and the orientation
+    NUM_FEATURES = 2 * 20 + 2
+    # mlp
+    HIDDEN = 32
+    EPOCHS = 400
+    LEARNING_RATE = 0.01
+    WEIGHT_DECAY = 1e-4
+    # knn
+    K = 5
+    MAX_SAMPLES = 512
+    # part of the frames held out to report the accuracy after training
+    VALIDATION = 0.2
+    SEED = 0
+
+
+# normalized features of a batch of hands
+def features(points, aspect=1.0):
+    """
+    Translation, scale and rotation normalized features
+    :param points: (N, 21, 3) landmarks
+    :param aspect: width / height of the frame the landmarks were found on
+    :return: (N, NUM_FEATURES) float64 array
+    """
+    xy = np.asarray(points, np.float64)[:, :, :2]
+    xy = xy[:, 1:] - xy[:, HandLandmark.WRIST:HandLandmark.WRIST + 1]
+    palm = xy[:, HandLandmark.MIDDLE_FINGER_MCP - 1]
+    palm_x, palm_y = palm[:, 0] * aspect, palm[:, 1]
+    length = np.maximum(np.hypot(palm_x, palm_y), 1e-9)
+    up_x, up_y = palm_x / length, palm_y / length
+    # (x, y) @ rotation: x scaled by the aspect ratio, the palm rotated to point up (image y points
+    # down, so up is (0, -1) and y is flipped) and everything divided by the palm length
+    rotation = np.empty((len(xy), 2, 2))
+    rotation[:, 0, 0], rotation[:, 0, 1] = -up_y * aspect, -up_x * aspect
+    rotation[:, 1, 0], rotation[:, 1, 1] = up_x, -up_y
+    rotation /= length[:, None, None]
+    result = np.empty((len(xy), Helper.NUM_FEATURES))
+    result[:, :40] = (xy @ rotation).reshape(len(xy), 40)
+    result[:, 40] = up_x * Helper.ORIENTATION_WEIGHT
+    result[:, 41] = up_y * Helper.ORIENTATION_WEIGHT
+    return result
+
+
+# features() of a single hand (NUM_FEATURES,) without the batch overhead, this runs on every frame
+def hand_features(points, aspect=1.0):
+    xy = points[1:, :2] - points[HandLandmark.WRIST, :2]
+    palm_x, palm_y = xy[HandLandmark.MIDDLE_FINGER_MCP - 1].tolist()
+    palm_x *= aspect
+    length = max(math.hypot(palm_x, palm_y), 1e-9)
+    up_x, up_y = palm_x / length, palm_y / length
+    rotation = np.array(((-up_y * aspect / length, -up_x * aspect / length), (up_x / length, -up_y / length)))
+    result = np.empty(Helper.NUM_FEATURES)
+    np.matmul(xy, rotation, out=result[:40].reshape(20, 2))
+    result[40:] = up_x * Helper.ORIENTATION_WEIGHT, up_y * Helper.ORIENTATION_WEIGHT
+    return result
+
+
+def _softmax(logits):
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class _Classifier:
+    def __init__(self, mean, std, min_confidence=Helper.MIN_CONFIDENCE):
+        # standardization of the features, learned on the training set
+        self.mean = mean
+        self.std = std
+        self.min_confidence = min_confidence
+
+    def classify(self, hand):
+        """
+        Classifies the hand found by the landmark stage
+        :param hand: landmark_detection.HandResult or None
+        :return: (gesture or None, confidence of every class: GESTURES and then "no gesture")
+        """
+        if hand is None:
+            confidences = np.zeros(Helper.NUM_CLASSES)
+            confidences[Helper.NO_GESTURE] = 1.0
+            return None, confidences
+        confidences = self.hand_confidences(hand.points, hand.width / hand.height)
+        index = max(range(Helper.NUM_CLASSES), key=confidences.__getitem__)
+        gesture = None
+        if index != Helper.NO_GESTURE and confidences[index] >= self.min_confidence:
+            gesture = gesture_detection.GESTURES[index]
+        return gesture, np.array(confidences)
+
+    def save(self, path):
+        np.savez_compressed(path, engine=self.engine, mean=self.mean, std=self.std, **self.arrays())
+
+
+class MLPClassifier(_Classifier):
+    engine = Helper.MLP
+
+    def __init__(self, mean, std, w1, b1, w2, b2, min_confidence=Helper.MIN_CONFIDENCE):
+        super().__init__(mean, std, min_confidence)
+        self.w1, self.b1, self.w2, self.b2 = w1, b1, w2, b2
+        # the standardization is folded into the first layer, so features go in as they are
+        self.input_weights = w1 / std[:, None]
+        self.input_bias = b1 - (mean / std) @ w1
+        # single hand: the rotation is folded into the first layer too (see hand_confidences), the
+        # weights of the rotated x and y of every landmark side by side, the wrist row subtracts the
+        # wrist from every landmark, followed by the weights of the orientation and the bias
+        hidden = len(b1)
+        landmark_weights = self.input_weights[:40].reshape(20, 2 * hidden)
+        self.landmark_weights = np.vstack((-landmark_weights.sum(axis=0), landmark_weights))
+        self.constant_weights = np.vstack((self.input_weights[40:] * Helper.ORIENTATION_WEIGHT, self.input_bias))
+        self.output_bias = b2.tolist()
+
+    # (N, NUM_CLASSES) confidences of a batch of features
+    def predict_proba(self, batch):
+        hidden = np.maximum(batch @ self.input_weights + self.input_bias, 0.0)
+        return _softmax(hidden @ self.w2 + self.b2)
+
+    def hand_confidences(self, points, aspect):
+        """
+        predict_proba() of a single hand (list of NUM_CLASSES floats) without computing its features: the first layer is linear in
+        the rotated landmarks, sum over (k, j) of rotation[k, j] * (landmark k @ weights of feature j),
+        so the landmarks go through the weights once and only the 4 rotation values change per hand.
+        This runs on every frame, with as few numpy calls as possible.
+        """
+        (wrist_x, wrist_y), (palm_x, palm_y) = points[HandLandmark.WRIST, :2].tolist(), \
+            points[HandLandmark.MIDDLE_FINGER_MCP, :2].tolist()
+        palm_x, palm_y = (palm_x - wrist_x) * aspect, palm_y - wrist_y
+        length = max(math.hypot(palm_x, palm_y), 1e-9)
+        up_x, up_y = palm_x / length, palm_y / length
+        rows = np.empty((7, len(self.b1)))
+        np.matmul(points[:, :2].T, self.landmark_weights, out=rows[:4].reshape(2, -1))
+        rows[4:] = self.constant_weights
+        # rotation (see features()), orientation and 1 for the bias
+        coefficients = np.array((-up_y * aspect / length, -up_x * aspect / length, up_x / length, -up_y / length,
+                                 up_x, up_y, 1.0))
+        hidden = coefficients @ rows
+        np.maximum(hidden, 0.0, out=hidden)
+        # the softmax of the few classes is cheaper in python
+        logits = [logit + bias for logit, bias in zip((hidden @ self.w2).tolist(), self.output_bias)]
+        highest = max(logits)
+        exp = [math.exp(logit - highest) for logit in logits]
+        total = sum(exp)
+        return [value / total for value in exp]
+
+    def arrays(self):
+        return {"w1": self.w1, "b1": self.b1, "w2": self.w2, "b2": self.b2}
+
+    @staticmethod
+    def fit(batch, labels, hidden=Helper.HIDDEN, epochs=Helper.EPOCHS, learning_rate=Helper.LEARNING_RATE,
+            seed=Helper.SEED):
+        """
+        Trains the network with full batch Adam on class balanced cross entropy
+        :param batch: (N, NUM_FEATURES) standardized features
+        :param labels: (N,) class of every frame
+        :return: w1, b1, w2, b2
+        """
+        rng = np.random.default_rng(seed)
+        count = len(batch)
+        params = [rng.normal(0, np.sqrt(2 / batch.shape[1]), (batch.shape[1], hidden)), np.zeros(hidden),
+                  rng.normal(0, np.sqrt(2 / hidden), (hidden, Helper.NUM_CLASSES)), np.zeros(Helper.NUM_CLASSES)]
+        moments = [np.zeros_like(param) for param in params]
+        velocities = [np.zeros_like(param) for param in params]
+        # rare gestures count as much as the frames without a gesture
+        frequency = np.bincount(labels, minlength=Helper.NUM_CLASSES)
+        weights = (count / (np.count_nonzero(frequency) * np.maximum(frequency, 1)))[labels][:, None]
+        targets = np.eye(Helper.NUM_CLASSES)[labels]
+        beta1, beta2 = 0.9, 0.999
+        for epoch in range(1, epochs + 1):
+            w1, b1, w2, b2 = params
+            pre_activation = batch @ w1 + b1
+            hidden_output = np.maximum(pre_activation, 0.0)
+            error = (_softmax(hidden_output @ w2 + b2) - targets) * weights / count
+            hidden_error = (error @ w2.T) * (pre_activation > 0)
+            grads = [batch.T @ hidden_error + Helper.WEIGHT_DECAY * w1, hidden_error.sum(axis=0),
+                     hidden_output.T @ error + Helper.WEIGHT_DECAY * w2, error.sum(axis=0)]
+            for param, grad, moment, velocity in zip(params, grads, moments, velocities):
+                moment *= beta1
+                moment += (1 - beta1) * grad
+                velocity *= beta2
+                velocity += (1 - beta2) * grad ** 2
+                param -= learning_rate * (moment / (1 - beta1 ** epoch)) / (np.sqrt(velocity / (1 - beta2 ** epoch)) + 1e-8)
+        return params
+
+
+class KNNClassifier(_Classifier):
+    engine = Helper.KNN
+
+    def __init__(self, mean, std, samples, labels, k=Helper.K, min_confidence=Helper.MIN_CONFIDENCE):
+        """
+        :param samples: (M, NUM_FEATURES) standardized features of the training frames that are kept
+        :param labels: (M,) class of every sample
+        """
+        super().__init__(mean, std, min_confidence)
+        self.samples = samples
+        self.labels = labels.astype(np.intp)
+        self.k = min(int(k), len(samples))
+        # |sample|^2 of the distance, computed once
+        self.norms = np.einsum("ij,ij->i", samples, samples)
+
+    # (N, NUM_CLASSES) share of the k nearest training frames that have each class
+    def predict_proba(self, batch):
+        # |a - b|^2 without |a|^2, it is the same for every sample of a row
+        distances = self.norms - 2 * ((batch - self.mean) / self.std) @ self.samples.T
+        nearest = np.argpartition(distances, self.k - 1, axis=1)[:, :self.k]
+        # votes of all rows counted at once, every row has its own NUM_CLASSES bins
+        bins = self.labels[nearest] + np.arange(len(batch))[:, None] * Helper.NUM_CLASSES
+        votes = np.bincount(bins.ravel(), minlength=len(batch) * Helper.NUM_CLASSES)
+        return votes.reshape(len(batch), Helper.NUM_CLASSES) / self.k
+
+    def hand_confidences(self, points, aspect):
+        distances = self.norms - 2 * (((hand_features(points, aspect) - self.mean) / self.std) @ self.samples.T)
+        nearest = np.argpartition(distances, self.k - 1)[:self.k]
+        return (np.bincount(self.labels[nearest], minlength=Helper.NUM_CLASSES) / self.k).tolist()
+
+    def arrays(self):
+        return {"samples": self.samples, "labels": self.labels.astype(np.int8), "k": self.k}
+
+    # keeps at most `max_samples` frames, split evenly between the classes (rare gestures keep all of theirs)
+    @staticmethod
+    def select(batch, labels, max_samples=Helper.MAX_SAMPLES, seed=Helper.SEED):
+        if len(batch) <= max_samples:
+            return batch, labels
+        rng = np.random.default_rng(seed)
+        classes, counts = np.unique(labels, return_counts=True)
+        # largest per class quota that fits
+        quota = max_samples // len(classes)
+        while quota < max_samples and np.minimum(counts, quota + 1).sum() <= max_samples:
+            quota += 1
+        keep = np.concatenate([rng.permutation(np.flatnonzero(labels == label))[:quota] for label in classes])
+        return batch[keep], labels[keep]
+
+
+def load(path, min_confidence=Helper.MIN_CONFIDENCE):
+    """
+    Loads a classifier saved by train()
+    :param path: .npz file
+    :param min_confidence: confidence below which no gesture is returned
+    :return: MLPClassifier or KNNClassifier
+    """
+    with np.load(path) as data:
+        engine = str(data["engine"])
+        if engine == Helper.MLP:
+            return MLPClassifier(data["mean"], data["std"], data["w1"], data["b1"], data["w2"], data["b2"],
+                                 min_confidence)
+        if engine == Helper.KNN:
+            return KNNClassifier(data["mean"], data["std"], data["samples"], data["labels"], int(data["k"]),
+                                 min_confidence)
+    raise ValueError(f"{path}: unknown classifier engine {engine}")
+
+
+# features and classes of every labelled frame with a hand in the recordings
+def load_recordings(paths):
+    batches, labels = [], []
+    for path in paths:
+        recording = landmark_recording.LandmarkReplay(path)
+        used = (recording.hands != landmark_recording.Helper.NO_HAND) & \
+               (recording.labels != landmark_recording.Helper.UNLABELLED)
+        if not used.any():
+            print(f"{path}: no labelled frames with a hand, skipped (see labels in landmark_recording.py)")
+            continue
+        gestures = recording.labels[used].astype(np.intp)
+        gestures[gestures == landmark_recording.Helper.NO_GESTURE] = Helper.NO_GESTURE
+        batches.append(features(recording.points[used], recording.width / recording.height))
+        labels.append(gestures)
+    if not batches:
+        return np.empty((0, Helper.NUM_FEATURES)), np.empty(0, np.intp)
+    return np.concatenate(batches), np.concatenate(labels)
+
+
+def train(batch, labels, engine=Helper.MLP, min_confidence=Helper.MIN_CONFIDENCE):
+    """
+    Trains a classifier
+    :param batch: (N, NUM_FEATURES) features (see features())
+    :param labels: (N,) class of every frame (index in GESTURES, NO_GESTURE for no gesture)
+    :param engine: MLP or KNN
+    :return: MLPClassifier or KNNClassifier
+    """
+    if engine not in Helper.ENGINES:
+        raise ValueError(f"Unknown classifier engine {engine}")
+    if len(batch) == 0:
+        raise ValueError("No labelled frames with a hand to train on")
+    mean = batch.mean(axis=0)
+    std = np.maximum(batch.std(axis=0), 1e-6)
+    standardized = (batch - mean) / std
+    if engine == Helper.MLP:
+        return MLPClassifier(mean, std, *MLPClassifier.fit(standardized, labels), min_confidence=min_confidence)
+    samples, sample_labels = KNNClassifier.select(standardized, labels)
+    return KNNClassifier(mean, std, samples, sample_labels, min_confidence=min_confidence)
+
+
+def evaluate(classifier, batch, labels):
+    """
+    Accuracy of a classifier
+    :return: dict with frames, accuracy and accuracy of every class
+    """
+    confidences = classifier.predict_proba(batch)
+    predicted = np.argmax(confidences, axis=1)
+    predicted[confidences.max(axis=1) < classifier.min_confidence] = Helper.NO_GESTURE
+    names = gesture_detection.GESTURES + (None,)
+    per_class = {names[label]: round(float(np.mean(predicted[labels == label] == label)), 3)
+                 for label in np.unique(labels)}
+    return {
+        "frames": len(batch),
+        "accuracy": round(float(np.mean(predicted == labels)), 3) if len(batch) else None,
+        "per_class": per_class,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train or evaluate the learned gesture classifier")
+    commands = parser.add_subparsers(dest="command", required=True)
+    train_parser = commands.add_parser("train", help="train on the labels of landmark recordings")
+    train_parser.add_argument("recordings", nargs="+")
+    train_parser.add_argument("--engine", choices=Helper.ENGINES, default=Helper.MLP)
+    train_parser.add_argument("--output", default="gestures.npz", help=".npz file to save the classifier to")
+    train_parser.add_argument("--validation", type=float, default=Helper.VALIDATION,
+                              help="part of the frames held out to report the accuracy")
+    evaluate_parser = commands.add_parser("evaluate", help="accuracy of a classifier on the labels of landmark recordings")
+    evaluate_parser.add_argument("classifier")
+    evaluate_parser.add_argument("recordings", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "evaluate":
+        batch, labels = load_recordings(args.recordings)
+        print(f"Classifier -> {evaluate(load(args.classifier), batch, labels)}")
+        return
+
+    batch, labels = load_recordings(args.recordings)
+    held_out = np.random.default_rng(Helper.SEED).random(len(batch)) < args.validation
+    classifier = train(batch[~held_out], labels[~held_out], args.engine)
+    if held_out.any():
+        print(f"Validation -> {evaluate(classifier, batch[held_out], labels[held_out])}")
+    classifier = train(batch, labels, args.engine)
+    classifier.save(args.output)
+    print(f"Saved {args.engine} classifier trained on {len(batch)} frames -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
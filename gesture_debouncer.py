@@ -0,0 +1,230 @@
+import math
+import time
+
+'''
+Streaming gesture debouncer.
+
+A gesture is only acted on once it has been seen often enough, so a single misclassified frame
+does not turn the lights off. Confirmation modes:
+
+    WINDOW       the gesture is seen `threshold` times among the last `window` gestures
+                 (frames without a gesture are ignored)
+    CONSECUTIVE  the gesture is seen in `threshold` frames in a row
+    TIME         the gesture is seen in every frame for at least `hold_time` seconds
+
+Every update costs constant time and memory: the window is a fixed-size ring of label ids with
+a running count per label.
+
+After a gesture is confirmed, the debouncer starts over. With `hysteresis` > 0 the confirmed
+gesture is also latched: it can not be confirmed again until `hysteresis` frames without it have
+been seen (frames of the latched gesture are ignored until then), so holding a pose fires once.
+
+EvidenceDebouncer does not count frames, it adds up how sure every frame is (EVIDENCE mode):
+every frame adds the margin of its most confident class over the second one (log of the ratio
+of their confidences, at most `max_frame_evidence`) to the evidence of that class, and takes it
+away from every other gesture. A gesture is confirmed as soon as its evidence reaches `bound`.
+A clear pose is confirmed after bound / max_frame_evidence frames, an ambiguous one (two gestures
+almost as likely) needs many more frames and a pose that flips between two gestures is never
+confirmed. Frames without a hand count as certain "no gesture" frames.
+
+It needs a classifier with real confidences (gesture_classifier). The hand written rules are all
+or nothing, every frame is a certain one, so it only counts bound / max_frame_evidence frames in
+a row: use WINDOW with the rules.
+
+Usage:
+    debouncer = GestureDebouncer(["up", "down"], threshold=12)
+    gesture = debouncer.update(current_gesture)   # confirmed gesture or None
+
+    debouncer = EvidenceDebouncer(["up", "down"], gesture_detection.CLASSES)
+    gesture, confidences = classifier.classify(hand)
+    gesture = debouncer.update(gesture, timestamp, confidences)
+'''
+
+
+class Helper:
+    WINDOW, CONSECUTIVE, TIME, EVIDENCE = "window", "consecutive", "time", "evidence"
+    MODES = (WINDOW, CONSECUTIVE, TIME)
+    THRESHOLD = 12
+    WINDOW_SIZE = 24
+    HOLD_TIME = 0.5
+    HYSTERESIS = 0
+    NONE = -1
+    # EVIDENCE: evidence needed to confirm a gesture, at most MAX_FRAME_EVIDENCE comes from one frame
+    # (a class e = 2.7 times more confident than the next one)
+    BOUND = 4.0
+    MAX_FRAME_EVIDENCE = 1.0
+    # EVIDENCE: frames without the confirmed gesture before it can be confirmed again
+    RELEASE_FRAMES = 8
+    # confidences of 0 are clipped to this before taking the log
+    MIN_CONFIDENCE = 1e-6
+
+
+class GestureDebouncer:
+    def __init__(self, labels, threshold=Helper.THRESHOLD, window=Helper.WINDOW_SIZE, hysteresis=Helper.HYSTERESIS,
+                 mode=Helper.WINDOW, hold_time=Helper.HOLD_TIME):
+        """
+        :param labels: gestures that can be confirmed
+        :param threshold: number of frames needed to confirm a gesture (WINDOW and CONSECUTIVE)
+        :param window: number of last gestures looked at (WINDOW)
+        :param hysteresis: frames without the confirmed gesture needed before it can be confirmed again
+        :param mode: WINDOW, CONSECUTIVE or TIME
+        :param hold_time: seconds a gesture has to be held (TIME)
+        """
+        if mode not in Helper.MODES:
+            raise ValueError(f"Unknown debounce mode {mode}")
+        if mode == Helper.WINDOW and threshold > window:
+            raise ValueError("threshold can not be larger than the window")
+        self.labels = list(labels)
+        self.ids = {label: index for index, label in enumerate(self.labels)}
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.mode = mode
+        self.hold_time = hold_time
+        # ring of label ids and running count of every label in the ring
+        self.ring = [Helper.NONE] * window
+        self.counts = [0] * len(self.labels)
+        self.size = 0
+        self.head = 0
+        # current run of the same gesture (CONSECUTIVE and TIME)
+        self.streak_id = Helper.NONE
+        self.streak_length = 0
+        self.streak_start = 0.0
+        # latched gesture and frames seen without it
+        self.latched_id = Helper.NONE
+        self.released_frames = 0
+
+    def update(self, label, timestamp=None, confidences=None):
+        """
+        Adds the gesture of a frame
+        :param label: gesture of the frame or None
+        :param timestamp: time of the frame (TIME mode), defaults to now
+        :param confidences: not used, same arguments as EvidenceDebouncer.update()
+        :return: the confirmed gesture or None
+        """
+        label_id = self.ids.get(label, Helper.NONE)
+        if self.latched_id != Helper.NONE:
+            if label_id == self.latched_id:
+                return None
+            self.released_frames += 1
+            if self.released_frames >= self.hysteresis:
+                self.latched_id = Helper.NONE
+
+        if self.mode == Helper.WINDOW:
+            confirmed = self.__update_window(label_id)
+        else:
+            confirmed = self.__update_streak(label_id, time.monotonic() if timestamp is None else timestamp)
+
+        if not confirmed:
+            return None
+        self.reset()
+        if self.hysteresis > 0:
+            self.latched_id = label_id
+            self.released_frames = 0
+        return self.labels[label_id]
+
+    # forget everything seen so far (the latched gesture stays latched)
+    def reset(self):
+        for index in range(len(self.counts)):
+            self.counts[index] = 0
+        self.size = 0
+        self.head = 0
+        self.streak_id = Helper.NONE
+        self.streak_length = 0
+
+    def __update_window(self, label_id):
+        if label_id == Helper.NONE:
+            return False
+        if self.size == len(self.ring):
+            # ring is full, the oldest gesture leaves the window
+            self.counts[self.ring[self.head]] -= 1
+        else:
+            self.size += 1
+        self.ring[self.head] = label_id
+        self.head = (self.head + 1) % len(self.ring)
+        self.counts[label_id] += 1
+        return self.counts[label_id] >= self.threshold
+
+    def __update_streak(self, label_id, timestamp):
+        if label_id != self.streak_id:
+            self.streak_id = label_id
+            self.streak_length = 0
+            self.streak_start = timestamp
+        if label_id == Helper.NONE:
+            return False
+        self.streak_length += 1
+        if self.mode == Helper.CONSECUTIVE:
+            return self.streak_length >= self.threshold
+        return timestamp - self.streak_start >= self.hold_time
+
+
+class EvidenceDebouncer:
+    def __init__(self, labels, classes, bound=Helper.BOUND, max_frame_evidence=Helper.MAX_FRAME_EVIDENCE,
+                 hysteresis=Helper.RELEASE_FRAMES):
+        """
+        :param labels: gestures that can be confirmed
+        :param classes: class of every entry of the confidences given to update() (None for "no gesture"),
+                        e.g. gesture_detection.CLASSES
+        :param bound: evidence needed to confirm a gesture
+        :param max_frame_evidence: evidence a single frame can add
+        :param hysteresis: frames without the confirmed gesture needed before it can be confirmed again
+        """
+        self.labels = list(labels)
+        self.ids = {label: index for index, label in enumerate(self.labels)}
+        # gesture id of every class, NONE for "no gesture" and classes that can not be confirmed
+        self.class_ids = [self.ids.get(name, Helper.NONE) for name in classes]
+        self.bound = bound
+        self.max_frame_evidence = max_frame_evidence
+        self.hysteresis = hysteresis
+        self.evidence = [0.0] * len(self.labels)
+        # latched gesture and frames seen without it
+        self.latched_id = Helper.NONE
+        self.released_frames = 0
+
+    def update(self, label, timestamp=None, confidences=None):
+        """
+        Adds the evidence of a frame
+        :param label: gesture of the frame or None
+        :param timestamp: time of the frame (not used, same arguments as GestureDebouncer.update())
+        :param confidences: confidence of every class (see `classes`), None -> `label` is certain
+        :return: the confirmed gesture or None
+        """
+        label_id, margin = self.__strongest(label, confidences)
+
+        if self.latched_id != Helper.NONE:
+            if label_id == self.latched_id:
+                return None
+            self.released_frames += 1
+            if self.released_frames >= self.hysteresis:
+                self.latched_id = Helper.NONE
+
+        evidence = self.evidence
+        for index in range(len(evidence)):
+            if index == label_id:
+                evidence[index] += margin
+            elif evidence[index]:
+                evidence[index] = max(evidence[index] - margin, 0.0)
+        if label_id == Helper.NONE or evidence[label_id] < self.bound:
+            return None
+
+        self.reset()
+        if self.hysteresis > 0:
+            self.latched_id = label_id
+            self.released_frames = 0
+        return self.labels[label_id]
+
+    # forget the evidence seen so far (the latched gesture stays latched)
+    def reset(self):
+        for index in range(len(self.evidence)):
+            self.evidence[index] = 0.0
+
+    # gesture id of the most confident class and its margin over the next one
+    def __strongest(self, label, confidences):
+        if confidences is None:
+            return self.ids.get(label, Helper.NONE), self.max_frame_evidence
+        values = confidences.tolist() if hasattr(confidences, "tolist") else list(confidences)
+        best = max(range(len(values)), key=values.__getitem__)
+        highest = values[best]
+        values[best] = -1.0
+        second = max(values)
+        margin = math.log(max(highest, Helper.MIN_CONFIDENCE) / max(second, Helper.MIN_CONFIDENCE))
+        return self.class_ids[best], min(margin, self.max_frame_evidence)
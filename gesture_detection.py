@@ -1,10 +1,7 @@
-import concurrent.futures
 import enum
 import math
 
-import cv2
-import mediapipe as mp
-from mediapipe.python.solutions.hands import HandLandmark
+import numpy as np
 
 
 class HandLandmark(enum.IntEnum):
@@ -32,14 +29,229 @@ class HandLandmark(enum.IntEnum):
     PINKY_TIP = 20
 
 
-def init():
-    return mp.solutions.hands.Hands(min_detection_confidence=0.5, min_tracking_confidence=0.5, max_num_hands=1)
+# gestures in the order they are checked, the first one that matches wins
+GESTURES = ("up", "down", "fist", "ok", "left", "right", "call", "two")
+# classes of the confidences returned by the classifiers: the gestures and then "no gesture"
+CLASSES = GESTURES + (None,)
 
+# Vectorized rule classifier.
+#
+# Every rule of the original if chain (see detect_gesture_reference) is a list of comparisons
+# "a < b" (or "not a < b") between features of the hand. All features of a frame are gathered
+# once into one float64 vector:
+#     x of the 21 landmarks, y of the 21 landmarks,
+#     shared extrema (lowest MCP, lowest fingertip, ...),
+#     distances between the landmark pairs used by the rules,
+#     thresholds
+# and every comparison of every rule is evaluated in a single array operation. A rule matches if
+# all of its comparisons hold, and the first matching rule (in GESTURES order) is the gesture.
+#
+# Landmarks are float32, the features are compared as float64 exactly like the original chain
+# does with the (float32) protobuf values, so both return the same gesture.
 
-def run(image, hands):
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future = executor.submit(detect_gesture, image, hands)
-        return future.result()
+
+class _Features:
+    NUM_LANDMARKS = 21
+    # extrema shared by the rules: (name, landmarks, True for min / False for max, x or y)
+    EXTREMA = (
+        ("mcp_min_y", (HandLandmark.INDEX_FINGER_MCP, HandLandmark.MIDDLE_FINGER_MCP,
+                       HandLandmark.RING_FINGER_MCP, HandLandmark.PINKY_MCP), True, "y"),
+        ("mcp_max_x", (HandLandmark.INDEX_FINGER_MCP, HandLandmark.MIDDLE_FINGER_MCP,
+                       HandLandmark.RING_FINGER_MCP, HandLandmark.PINKY_MCP), False, "x"),
+        ("tip_min_y", (HandLandmark.INDEX_FINGER_TIP, HandLandmark.MIDDLE_FINGER_TIP,
+                       HandLandmark.RING_FINGER_TIP, HandLandmark.PINKY_TIP), True, "y"),
+        ("fist_min_y", (HandLandmark.THUMB_IP, HandLandmark.INDEX_FINGER_TIP, HandLandmark.MIDDLE_FINGER_TIP,
+                        HandLandmark.RING_FINGER_TIP, HandLandmark.PINKY_TIP), True, "y"),
+        ("ok_max_y", (HandLandmark.MIDDLE_FINGER_TIP, HandLandmark.RING_FINGER_TIP, HandLandmark.PINKY_TIP), False, "y"),
+        ("call_min_y", (HandLandmark.INDEX_FINGER_TIP, HandLandmark.MIDDLE_FINGER_TIP,
+                        HandLandmark.RING_FINGER_TIP), True, "y"),
+    )
+    # landmark pairs the rules measure the distance of
+    DISTANCES = (
+        (HandLandmark.RING_FINGER_MCP, HandLandmark.THUMB_TIP),
+        (HandLandmark.INDEX_FINGER_TIP, HandLandmark.THUMB_TIP),
+        (HandLandmark.INDEX_FINGER_MCP, HandLandmark.THUMB_TIP),
+        (HandLandmark.PINKY_TIP, HandLandmark.THUMB_TIP),
+        (HandLandmark.PINKY_TIP, HandLandmark.RING_FINGER_MCP),
+        (HandLandmark.INDEX_FINGER_TIP, HandLandmark.MIDDLE_FINGER_TIP),
+        (HandLandmark.THUMB_TIP, HandLandmark.RING_FINGER_TIP),
+    )
+    THRESHOLDS = (0.15, 0.05, 0.1, 0.2, 0.14, 0.08)
+
+    # position of each feature in the feature vector
+    @staticmethod
+    def x(landmark):
+        return int(landmark)
+
+    @staticmethod
+    def y(landmark):
+        return _Features.NUM_LANDMARKS + int(landmark)
+
+    @staticmethod
+    def extremum(name):
+        names = [extremum[0] for extremum in _Features.EXTREMA]
+        return 2 * _Features.NUM_LANDMARKS + names.index(name)
+
+    @staticmethod
+    def distance(landmark1, landmark2):
+        return 2 * _Features.NUM_LANDMARKS + len(_Features.EXTREMA) + _Features.DISTANCES.index((landmark1, landmark2))
+
+    @staticmethod
+    def threshold(value):
+        return 2 * _Features.NUM_LANDMARKS + len(_Features.EXTREMA) + len(_Features.DISTANCES) + \
+            _Features.THRESHOLDS.index(value)
+
+
+# comparison "a < b" of two features
+def _less(a, b):
+    return a, b, True
+
+
+# comparison "not a < b" of two features (a >= b)
+def _not_less(a, b):
+    return a, b, False
+
+
+def _build_rules():
+    f, lm = _Features, HandLandmark
+    tips = (lm.INDEX_FINGER_TIP, lm.MIDDLE_FINGER_TIP, lm.RING_FINGER_TIP, lm.PINKY_TIP)
+    return {
+        # thumb up: thumb above index/pinky MCPs and pinky curled
+        "up": [_less(f.y(lm.THUMB_TIP), f.y(lm.THUMB_IP)), _less(f.y(lm.THUMB_IP), f.y(lm.THUMB_MCP)),
+               _less(f.y(lm.THUMB_MCP), f.y(lm.INDEX_FINGER_MCP)), _less(f.y(lm.INDEX_FINGER_MCP), f.y(lm.PINKY_MCP)),
+               _less(f.x(lm.PINKY_TIP), f.x(lm.PINKY_PIP))],
+        # thumb down: thumb below the MCPs and no fingertip sticking out past the MCPs
+        "down": [_less(f.y(lm.THUMB_IP), f.y(lm.THUMB_TIP)), _less(f.y(lm.THUMB_MCP), f.y(lm.THUMB_IP)),
+                 _less(f.y(lm.INDEX_FINGER_MCP), f.y(lm.THUMB_MCP)), _less(f.y(lm.PINKY_MCP), f.y(lm.INDEX_FINGER_MCP))] +
+                [_not_less(f.extremum("mcp_max_x"), f.x(tip)) for tip in tips],
+        # fist: fingertips below the MCPs and thumb tip close to the ring MCP
+        "fist": [_less(f.extremum("mcp_min_y"), f.extremum("fist_min_y")),
+                 _less(f.distance(lm.RING_FINGER_MCP, lm.THUMB_TIP), f.threshold(0.15))],
+        # ok: thumb and index tip touching, other fingers up
+        "ok": [_less(f.distance(lm.INDEX_FINGER_TIP, lm.THUMB_TIP), f.threshold(0.05)),
+               _less(f.extremum("ok_max_y"), f.extremum("mcp_min_y"))],
+        # thumb pointing left
+        "left": [_less(f.x(lm.THUMB_IP), f.x(lm.THUMB_TIP)), _less(f.x(lm.THUMB_MCP), f.x(lm.THUMB_IP)),
+                 _less(f.extremum("mcp_min_y"), f.extremum("tip_min_y")), _less(f.extremum("mcp_min_y"), f.y(lm.WRIST)),
+                 _less(f.y(lm.PINKY_MCP), f.y(lm.THUMB_CMC)),
+                 _less(f.threshold(0.1), f.distance(lm.INDEX_FINGER_MCP, lm.THUMB_TIP)),
+                 _less(f.y(lm.INDEX_FINGER_MCP), f.y(lm.WRIST))],
+        # thumb pointing right
+        "right": [_less(f.x(lm.THUMB_TIP), f.x(lm.THUMB_IP)), _less(f.x(lm.THUMB_IP), f.x(lm.THUMB_MCP)),
+                  _less(f.x(lm.THUMB_MCP), f.x(lm.THUMB_CMC)), _less(f.extremum("mcp_min_y"), f.extremum("tip_min_y")),
+                  _less(f.y(lm.THUMB_TIP), f.y(lm.WRIST)), _less(f.extremum("mcp_min_y"), f.y(lm.WRIST))],
+        # call: index, middle and ring curled, thumb and pinky spread out
+        "call": [_less(f.extremum("mcp_min_y"), f.extremum("call_min_y")),
+                 _less(f.threshold(0.2), f.distance(lm.PINKY_TIP, lm.THUMB_TIP)),
+                 _less(f.threshold(0.14), f.distance(lm.PINKY_TIP, lm.RING_FINGER_MCP))],
+        # two: ring and pinky curled, index and middle together, thumb holding the ring finger
+        "two": [_less(f.y(lm.RING_FINGER_MCP), f.y(lm.PINKY_TIP)), _less(f.y(lm.MIDDLE_FINGER_MCP), f.y(lm.RING_FINGER_TIP)),
+                _less(f.distance(lm.INDEX_FINGER_TIP, lm.MIDDLE_FINGER_TIP), f.threshold(0.08)),
+                _less(f.distance(lm.THUMB_TIP, lm.RING_FINGER_TIP), f.threshold(0.08))],
+    }
+
+
+# lookup tables used to evaluate all the rules at once
+class _Rules:
+    def __init__(self, rules):
+        comparisons = [comparison for gesture in GESTURES for comparison in rules[gesture]]
+        # left and right side of every comparison and the expected result
+        self.left = np.array([comparison[0] for comparison in comparisons], np.intp)
+        self.right = np.array([comparison[1] for comparison in comparisons], np.intp)
+        self.expected = np.array([comparison[2] for comparison in comparisons], bool)
+        # index of the first comparison of every gesture
+        self.starts = np.cumsum([0] + [len(rules[gesture]) for gesture in GESTURES[:-1]])
+
+        # values of the extrema are gathered and reduced in one go, maxima are minima of negated values
+        extrema = _Features.EXTREMA
+        self.extrema_source = np.array([_Features.x(landmark) if axis == "x" else _Features.y(landmark)
+                                        for _, landmarks, _, axis in extrema for landmark in landmarks], np.intp)
+        self.extrema_sign = np.array([1.0 if is_min else -1.0 for _, landmarks, is_min, _ in extrema
+                                      for _ in landmarks])
+        self.extrema_starts = np.cumsum([0] + [len(landmarks) for _, landmarks, _, _ in extrema[:-1]])
+        self.extrema_result_sign = np.array([1.0 if is_min else -1.0 for _, _, is_min, _ in extrema])
+
+        self.distance_from = np.array([pair[0] for pair in _Features.DISTANCES], np.intp)
+        self.distance_to = np.array([pair[1] for pair in _Features.DISTANCES], np.intp)
+        self.thresholds = np.array(_Features.THRESHOLDS)
+
+
+_RULES = _Rules(_build_rules())
+
+
+# hand written rules as a classifier, with the interface of the learned ones (see gesture_classifier.py)
+class RuleClassifier:
+    engine = "rules"
+
+    def classify(self, hand):
+        """
+        :param hand: landmark_detection.HandResult or None
+        :return: (gesture or None, confidence of every class: GESTURES and then "no gesture", 1 for the match)
+        """
+        confidences = np.zeros(len(CLASSES))
+        gesture = detect_gesture(hand)
+        confidences[CLASSES.index(gesture)] = 1.0
+        return gesture, confidences
+
+
+def init(weights=None):
+    """
+    Creates the gesture classifier
+    :param weights: .npz file saved by `python gesture_classifier.py train` (None -> hand written rules)
+    :return: classifier given to run()
+    """
+    if weights is None:
+        return RuleClassifier()
+    import gesture_classifier
+    return gesture_classifier.load(weights)
+
+
+_RULE_CLASSIFIER = RuleClassifier()
+
+
+# classifier_data: returned by init(), None -> hand written rules
+def run(hand, classifier_data=None):
+    if classifier_data is None:
+        return detect_gesture(hand)
+    return classifier_data.classify(hand)[0]
+
+
+# run() that also returns the confidence of every class (see CLASSES)
+def classify(hand, classifier_data=None):
+    if classifier_data is None:
+        classifier_data = _RULE_CLASSIFIER
+    return classifier_data.classify(hand)
+
+
+def detect_gesture(hand):
+    """
+    Detects the gesture of the hand found by the landmark stage
+    :param hand: landmark_detection.HandResult or None
+    :return: string of gesture
+    """
+    if hand is None:
+        return None
+    index = _first_match(_match_rules(hand.points))
+    return None if index is None else GESTURES[index]
+
+
+# evaluates every rule at once, returns a bool per gesture (in GESTURES order)
+def _match_rules(points):
+    xy = points[:, :2].astype(np.float64)
+    # x of all landmarks followed by y of all landmarks
+    coordinates = xy.T.ravel()
+    extrema = np.minimum.reduceat(coordinates[_RULES.extrema_source] * _RULES.extrema_sign,
+                                  _RULES.extrema_starts) * _RULES.extrema_result_sign
+    delta = xy[_RULES.distance_from] - xy[_RULES.distance_to]
+    distances = np.hypot(delta[:, 0], delta[:, 1])
+    features = np.concatenate((coordinates, extrema, distances, _RULES.thresholds))
+    comparisons = (features[_RULES.left] < features[_RULES.right]) == _RULES.expected
+    return np.logical_and.reduceat(comparisons, _RULES.starts)
+
+
+def _first_match(matches):
+    index = int(np.argmax(matches))
+    return index if matches[index] else None
 
 
 # function to calculate distance between two landmarks
@@ -47,20 +259,16 @@ def calculate_distance(landmark1, landmark2):
     return math.hypot(landmark1.x - landmark2.x, landmark1.y - landmark2.y)
 
 
-# write function documentation
-def detect_gesture(image, hands):
+# original rule chain, kept as the reference detect_gesture is checked against
+def detect_gesture_reference(hand):
     """
-    Detects the gesture of the hand in the image
-    :param image:
-    :param hands:
+    Detects the gesture of the hand found by the landmark stage (one rule at a time)
+    :param hand: landmark_detection.HandResult or None
     :return: string of gesture
     """
-    image.flags.writeable = False
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    hand_landmarks = hands.process(image).multi_hand_landmarks
-    if not hand_landmarks:
+    if hand is None:
         return None
-    hand_landmarks = hand_landmarks[0]
+    hand_landmarks = hand
     # recognize gestures
     # left screen is 1 and right screen is 0
     # top of screen is 0 and bottom of screen is 1
@@ -1,10 +1,26 @@
+import argparse
+import signal
+import threading
+import time
+import startup
 import cv2
+import command_dispatcher
+import debug_server
+import gesture_debouncer
 import gesture_detection
+import idle_detection
+import landmark_detection
+import landmark_recording
 import pattern_detection
-import spotify
-import nest
+import pipeline
+import stream_manager
 import text_to_speech
-import kasa
+
+# integrations (and their secrets) are imported on first use, see startup.py
+http_session = startup.lazy("http_session")
+spotify = startup.lazy("spotify")
+nest = startup.lazy("nest")
+kasa = startup.lazy("kasa")
 
 '''
     SDSU [Fall 2022] - CS530 (Systems Programming)
@@ -23,68 +39,243 @@ import kasa
 '''
 
 class Data:
-    responses = [nest._Helper.ERROR, nest._Helper.CONNECTION_ERROR]
+    # error values returned by the integrations
+    responses = ["ERROR", "CONNECTION_ERROR"]
     frames = 12
+    # number of last gestures a gesture is counted in
+    window = 24
+    # the hand written rules are all or nothing, a gesture runs once it is seen in `frames` frames
+    debounce_mode = gesture_debouncer.Helper.WINDOW
+    # a learned classifier gives real confidences, a gesture runs as soon as the frames add up to enough
+    # evidence (see gesture_debouncer.EvidenceDebouncer): a clear pose after 4-5 frames, an ambiguous one later
+    classifier_debounce_mode = gesture_debouncer.Helper.EVIDENCE
+    confidence_bound = gesture_debouncer.Helper.BOUND
     gestures = ["up", "down", "left", "right", "fist", "ok", "two", "call"]
     EMPTY = None
+    # seconds between pipeline reports
+    REPORT_INTERVAL = 10
+    # run the hand model on a crop around the last hand (see landmark_detection.HandTracker)
+    USE_ROI = True
+    # devices, commands of a device run one at a time
+    SPOTIFY, NEST, KASA = "spotify", "nest", "kasa"
+    # integrations whose tokens are fetched at startup (module names)
+    INTEGRATIONS = (NEST, SPOTIFY, KASA)
+    # voice replies
+    CALL_MESSAGE = "Call Gesture Detected"
+    KASA_ERROR_MESSAGE = "Issue changing status of kasa"
 
-def main():
-    # initialize pattern detection
-    pattern_detection_data = pattern_detection.init()
-    gesture_detector_data = gesture_detection.init()
-    # begin capture of video
-    cap = cv2.VideoCapture(1)
-    gesture_list = []
-    last_command = ""
-    
-    while True:
-        # read current frame from camera
-        _, img = cap.read()
+    @staticmethod
+    def create_mode_message(mode):
+        return f"Thermostat mode is currently set to {mode}"
+
+    # every reply the program can give, synthesized once so they play right away (and offline)
+    @staticmethod
+    def voice_replies():
+        replies = [Data.CALL_MESSAGE, Data.KASA_ERROR_MESSAGE]
+        replies += [Data.create_mode_message(mode) for mode in [nest._Helper.COOL, nest._Helper.HEAT, nest._Helper.OFF]]
+        return replies + pattern_detection.Helper.voice_replies()
+
+# keeps the detected gestures of a camera and runs the API call of a confirmed gesture
+class GestureSession:
+    # debounce_mode: Data.debounce_mode, or Data.classifier_debounce_mode with a learned classifier
+    def __init__(self, dispatcher, debounce_mode=Data.debounce_mode):
+        self.dispatcher = dispatcher
+        if debounce_mode == gesture_debouncer.Helper.EVIDENCE:
+            # a gesture has to add up to enough evidence before its API call runs
+            self.debouncer = gesture_debouncer.EvidenceDebouncer(Data.gestures, gesture_detection.CLASSES,
+                                                                 bound=Data.confidence_bound)
+        else:
+            # a gesture has to be seen in 12 frames before its API call runs
+            self.debouncer = gesture_debouncer.GestureDebouncer(Data.gestures, threshold=Data.frames,
+                                                                window=Data.window, mode=debounce_mode)
+        self.last_command = ""
+
+    # called with the gesture of every frame (None if no gesture) and the confidence of every class
+    # (see gesture_detection.CLASSES)
+    def update(self, current_gesture, timestamp=None, confidences=None):
+        # first frame that went through the model, gestures work from here on
+        if not startup.timeline.reached("first_actionable_frame"):
+            startup.timeline.mark("first_actionable_frame")
+            print(f"Startup -> {startup.timeline.report()}")
+        gesture = self.debouncer.update(current_gesture, timestamp, confidences)
+        if gesture is None:
+            return
         
-        # detect if a gesture is recognized and push it into the queue
-        current_gesture = gesture_detection.run(img, gesture_detector_data)
+        # handle gesture if found
+        gesture_found = handle_gestures(gesture, self.last_command, self.dispatcher)
+        # stores last command, used to handle call + (up or down or first) gesture command
+        if gesture_found == "call":
+            self.last_command = gesture_found
+        # reset last command if call + gesture (up or down) command was ran already
+        elif gesture_found in ["up", "down", "fist"] and self.last_command == "call":
+            self.last_command = ""
+
+# debouncer of the gesture classifier (None is the hand written rules)
+def debounce_mode(classifier_data):
+    return Data.debounce_mode if classifier_data is None else Data.classifier_debounce_mode
+
+# get the token of an integration before the first gesture needs it
+def prefetch_integration(name):
+    response = startup.load(name).prefetch()
+    if response in Data.responses:
+        raise RuntimeError(f"{name} returned {response}")
+
+# slow first calls run in the background while the camera opens: API tokens and voice replies
+# (and the hand model if `load_model`), returns the Future of the model
+# with `use_roi` the model gets crops and full frames in turn, so it can not track the hand between them
+def start_background_tasks(load_model=True, use_roi=Data.USE_ROI):
+    model = None
+    if load_model:
+        model = startup.background("model_ready", lambda: landmark_detection.warm_up(
+            landmark_detection.init(static_image_mode=use_roi)))
+    for name in Data.INTEGRATIONS:
+        startup.background(f"{name}_ready", prefetch_integration, name)
+    startup.background("voice_replies_ready", lambda: text_to_speech.prewarm(Data.voice_replies()).join())
+    return model
+
+# stop the program on ctrl+c or `kill` (headless units have no 'q' key)
+def install_stop_signals():
+    stop_requested = threading.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: stop_requested.set())
+    return stop_requested
+
+# debug view of a frame, only drawn when a viewer is connected to the debug server
+def publish_debug_view(server, image, hand, pattern_data):
+    if server is not None:
+        server.publish(lambda: debug_server.render(image, hand, pattern_data))
+
+# headless: no windows and nothing drawn, stop with SIGINT/SIGTERM
+# debug_port: serve a debug view of the camera on this port (see debug_server.py)
+# classifier_path: learned gesture classifier (see gesture_classifier.py), None uses the hand written rules
+# record_label: gesture the user makes during the recording (ground truth, see landmark_recording.py)
+def main(record_path=None, source=1, headless=False, debug_port=None, classifier_path=None, record_label=None):
+    startup.timeline.mark("imports")
+    # hand model, API tokens and voice replies are loaded in the background while the camera opens
+    landmark_detector_data = start_background_tasks()
+    stop_requested = install_stop_signals()
+    debug_view = debug_server.DebugServer(debug_port).start() if debug_port is not None else None
+    # API calls run on worker threads so they never stall the video
+    dispatcher = command_dispatcher.CommandDispatcher()
+    # initialize pattern detection (the canvas is only drawn when it is shown)
+    pattern_detection_data = pattern_detection.init(draw=not headless)
+    # volume/temperature changes add up, so a circle never cancels the one before it
+    pattern_detection_data.on_circle = lambda rotation_direction: submit_pattern_command(dispatcher, rotation_direction)
+    classifier_data = gesture_detection.init(classifier_path)
+    session = GestureSession(dispatcher, debounce_mode(classifier_data))
+    # begin capture of video, every stage runs on its own thread (see pipeline.py)
+    # stop running the model when nobody is in front of the camera (see idle_detection.py)
+    frame_pipeline = pipeline.Pipeline(source, landmark_detector_data, pattern_detection_data, session.update,
+                                       record_path=record_path, use_roi=Data.USE_ROI,
+                                       idle_monitor=idle_detection.IdleMonitor(),
+                                       classifier_data=classifier_data, record_label=record_label).start()
+    startup.timeline.mark("camera_open")
+    last_report = time.monotonic()
+    
+    while frame_pipeline.running and not stop_requested.is_set():
+        # get the next frame that went through all stages
+        packet = frame_pipeline.get()
+        if packet is None:
+            continue
         
-        if current_gesture is not None:
-            gesture_list.append(current_gesture)
+        publish_debug_view(debug_view, packet.frame.image, packet.hand, pattern_detection_data)
+        if not headless:
+            ############## FOR DEMO PURPOSES ##############
+            # show window (this will contain the gesture path)
+            cv2.imshow("Pattern Canvas", packet.canvas)
+            # show window (basic camera view)
+            cv2.imshow("camera", packet.frame.image)
+        # frame is no longer needed, let the capture thread reuse its buffer
+        frame_pipeline.done(packet)
         
-        # if at least 12 frames were found
-        if len(gesture_list) >= Data.frames and gesture_list.count(gesture_list[len(gesture_list)-1]) >= Data.frames:
-            # handle gesture if found
-            gesture_found = handle_gestures(gesture_list, last_command)
-            # a gesture was found
-            if gesture_found in Data.gestures:
-                # clear the gesture list
-                gesture_list.clear()
-                # stores last command, used to handle call + (up or down or first) gesture command
-                if gesture_found == "call":
-                    last_command = gesture_found
-                # reset last command if call + gesture (up or down) command was ran already
-                elif gesture_found in ["up", "down", "fist"] and last_command == "call":
-                    last_command = ""
-                    
-        # detect is a circle pattern is recognized
-        pattern_detection.run(img, pattern_detection_data)
-            
-        ############## FOR DEMO PURPOSES ##############
-        # show window (this will contain the gesture path)
-        cv2.imshow("Pattern Canvas", pattern_detection_data.canvas)
-        # show window (basic camera view)
-        cv2.imshow("camera", img)
+        # report frame rate and queue depths of the stages
+        if time.monotonic() - last_report > Data.REPORT_INTERVAL:
+            print(f"Pipeline -> {frame_pipeline.stats()}")
+            last_report = time.monotonic()
         
         # press 'q' to exit program
-        key = cv2.waitKey(1)
-        if key == ord("q"):
+        if not headless and cv2.waitKey(1) == ord("q"):
             break
 
     # release resource and close windows
-    cap.release()
-    cv2.destroyAllWindows()
+    print(f"Pipeline -> {frame_pipeline.stats()}")
+    frame_pipeline.stop()
+    print(f"Commands -> {dispatcher.stats()}")
+    dispatcher.stop()
+    print(f"HTTP -> {http_session.stats()}")
+    print(f"Speech -> {text_to_speech.stats()}")
+    print(f"Startup -> {startup.timeline.report()}")
+    text_to_speech.stop()
+    if debug_view is not None:
+        debug_view.stop()
+    if not headless:
+        cv2.destroyAllWindows()
+
+
+# several cameras (rooms), every camera has its own gestures and pattern, models are shared (see stream_manager.py)
+def main_streams(sources, workers=stream_manager.Helper.WORKERS, headless=False, debug_port=None, classifier_path=None):
+    startup.timeline.mark("imports")
+    # every worker of the stream manager loads its own model
+    start_background_tasks(load_model=False)
+    stop_requested = install_stop_signals()
+    debug_view = debug_server.DebugServer(debug_port).start() if debug_port is not None else None
+    dispatcher = command_dispatcher.CommandDispatcher()
+
+    def create_pattern_tracker(name):
+        pattern_data = pattern_detection.init(draw=False)
+        pattern_data.on_circle = lambda rotation_direction: submit_pattern_command(dispatcher, rotation_direction)
+        return pattern_data
+
+    # frames only go to the main thread if they are shown
+    display = not headless or debug_view is not None
+    classifier_data = gesture_detection.init(classifier_path)
+    manager = stream_manager.StreamManager(sources,
+                                           lambda name: GestureSession(dispatcher, debounce_mode(classifier_data)).update,
+                                           workers, create_pattern_tracker, display=display,
+                                           classifier_data=classifier_data).start()
+    startup.timeline.mark("camera_open")
+    last_report = time.monotonic()
+
+    while manager.running and not stop_requested.is_set():
+        # report frame rate and latency of every stream
+        if time.monotonic() - last_report > Data.REPORT_INTERVAL:
+            print(f"Streams -> {manager.stats()}")
+            last_report = time.monotonic()
+
+        if not display:
+            stop_requested.wait(stream_manager.Helper.GET_TIMEOUT)
+            continue
+        packet = manager.get()
+        if packet is None:
+            continue
+        # debug view shows the first stream
+        if packet.stream is manager.streams[0]:
+            publish_debug_view(debug_view, packet.frame.image, packet.hand, packet.stream.pattern_data)
+        if not headless:
+            cv2.imshow(f"camera {packet.stream.name}", packet.frame.image)
+        manager.done(packet)
+
+        # press 'q' to exit program
+        if not headless and cv2.waitKey(1) == ord("q"):
+            break
+
+    print(f"Streams -> {manager.stats()}")
+    manager.stop()
+    print(f"Commands -> {dispatcher.stats()}")
+    dispatcher.stop()
+    print(f"HTTP -> {http_session.stats()}")
+    print(f"Speech -> {text_to_speech.stats()}")
+    print(f"Startup -> {startup.timeline.report()}")
+    text_to_speech.stop()
+    if debug_view is not None:
+        debug_view.stop()
+    if not headless:
+        cv2.destroyAllWindows()
 
 
 # if a gesture was detected for a certain number of frames
-# then run its' respective API call
-def handle_gestures(gesture_list, last_command):
-    current_gesture = gesture_list[len(gesture_list)-1]
+# then queue its' respective API call (it runs on the worker of the device, see command_dispatcher.py)
+def handle_gestures(current_gesture, last_command, dispatcher):
     # run command based on current gesture
     # gesture thumbs up 
     if current_gesture == "up":
@@ -92,14 +283,10 @@ def handle_gestures(gesture_list, last_command):
         # flip the kasa switch on
         if last_command == "call":
             print(f"Call + Up Gesture Detected -> Kasa Switch -> ON")
-            response = kasa.flip_switch(1)
-            # notify user if an error occurs
-            if response in Data.responses:
-                text_to_speech.run("Issue changing status of kasa")
+            dispatcher.submit(Data.KASA, flip_kasa_switch, 1)
         else:
             # start spotify playback
-            response = spotify.start_playback()
-            print(f"Spotify -> Start Playback")
+            dispatcher.submit(Data.SPOTIFY, run_spotify_command, spotify.start_playback, "Spotify -> Start Playback")
         return "up"
     # gesture thumbs down
     elif current_gesture == "down":
@@ -107,74 +294,120 @@ def handle_gestures(gesture_list, last_command):
         # flip the kasa switch off
         if last_command == "call":
             print(f"Call + Down Gesture Detected -> Kasa Switch -> OFF")
-            response = kasa.flip_switch(0)
-            # notify user if an error occurs
-            if response in Data.responses:
-                 text_to_speech.run("Issue changing status of kasa")
+            dispatcher.submit(Data.KASA, flip_kasa_switch, 0)
         else:
-            spotify.pause_playback()
-            print("Spotify -> Pause Playback")
+            dispatcher.submit(Data.SPOTIFY, run_spotify_command, spotify.pause_playback, "Spotify -> Pause Playback")
         return "down"
     # gesture right
     elif current_gesture == "right":
-        spotify.skip_playback()
-        print("Spotify -> Next Song")
+        dispatcher.submit(Data.SPOTIFY, run_spotify_command, spotify.skip_playback, "Spotify -> Next Song")
         return "right"
     # gesture left  
     elif current_gesture == "left":
-        spotify.previous_playback()
-        print("Spotify -> Previous Song")
+        dispatcher.submit(Data.SPOTIFY, run_spotify_command, spotify.previous_playback, "Spotify -> Previous Song")
         return "left"
     # gesture ok
     elif current_gesture == "ok":
-        response = nest.update_thermostat(nest._Helper.COOL, nest._Helper.CHANGE_MODE_COMMAND)
-        if response in Data.responses:
-            # notify user if an error occurs
-            text_to_speech.run(pattern_detection.Helper.THERMOSTAT_ERROR_MESSAGE)
-        else:
-            text_to_speech.run(f"Thermostat mode is currently set to {nest.get_current_temp_mode()}")
-            print("Thermostat Mode Set -> COOL")
+        dispatcher.submit(Data.NEST, set_thermostat_mode, nest._Helper.COOL)
         return "ok"
     # gesture two
     elif current_gesture == "two":
-        response = nest.update_thermostat(nest._Helper.HEAT, nest._Helper.CHANGE_MODE_COMMAND)
-        if response in Data.responses:
-            # notify user if an error occurs
-            text_to_speech.run(pattern_detection.Helper.THERMOSTAT_ERROR_MESSAGE)
-        else:
-            text_to_speech.run(f"Thermostat mode is currently set to {nest.get_current_temp_mode()}")
-            print("Thermostat Mode Set -> HEAT")
+        dispatcher.submit(Data.NEST, set_thermostat_mode, nest._Helper.HEAT)
         return "two"
     # gesture fist
     elif current_gesture == "fist":
         # if last command is call
         # turn of thermostat
         if last_command == "call":
-            response = nest.update_thermostat(nest._Helper.OFF, nest._Helper.CHANGE_MODE_COMMAND)
-            if response in Data.responses:
-                # notify user if an error occurs
-                text_to_speech.run(pattern_detection.Helper.THERMOSTAT_ERROR_MESSAGE)
-            else:
-                text_to_speech.run(f"Thermostat mode is currently set to {nest.get_current_temp_mode()}")
-                print("Thermostat Mode Set -> OFF")
+            dispatcher.submit(Data.NEST, set_thermostat_mode, nest._Helper.OFF)
         else:
             # if last command is not a fist, get current mode of Nest thermostat
-            response = nest.get_current_temp_mode()
-            if response in Data.responses:
-                # notify user if an error occurs
-                text_to_speech.run(pattern_detection.Helper.THERMOSTAT_ERROR_MESSAGE)
-            else:
-                text_to_speech.run(f"Thermostat mode is currently set to {response}")
-                print(f"Thermostat Mode -> {response}")
+            dispatcher.submit(Data.NEST, say_thermostat_mode)
         return "fist"
     # gesture call
     elif current_gesture == "call":
         # call by itself does nothing
         # it needs to be used with UP or DOWN or FIST Gesture
         # notify user that call gesture was detected
-        text_to_speech.run(f"Call Gesture Detected")
+        text_to_speech.run(Data.CALL_MESSAGE)
         return "call"
 
 
+############## COMMANDS (run on the worker of each device) ##############
+
+# turn the kasa switch on (1) or off (0)
+def flip_kasa_switch(command, state):
+    response = kasa.flip_switch(state)
+    # notify user if an error occurs
+    if response in Data.responses and not command.cancelled:
+        text_to_speech.run(Data.KASA_ERROR_MESSAGE, text_to_speech.Helper.PRIORITY_ERROR)
+
+def run_spotify_command(command, spotify_command, message):
+    spotify_command()
+    print(message)
+
+# change the mode of the thermostat and tell the user the new mode
+def set_thermostat_mode(command, mode):
+    response = nest.update_thermostat(mode, nest._Helper.CHANGE_MODE_COMMAND)
+    # a newer thermostat command was given, it will tell the user the mode
+    if command.cancelled:
+        return
+    if response in Data.responses:
+        # notify user if an error occurs
+        text_to_speech.run(pattern_detection.Helper.THERMOSTAT_ERROR_MESSAGE, text_to_speech.Helper.PRIORITY_ERROR)
+    else:
+        text_to_speech.run(Data.create_mode_message(nest.get_current_temp_mode()))
+        print(f"Thermostat Mode Set -> {mode}")
+
+# tell the user the current mode of the thermostat
+def say_thermostat_mode(command):
+    response = nest.get_current_temp_mode()
+    if command.cancelled:
+        return
+    if response in Data.responses:
+        # notify user if an error occurs
+        text_to_speech.run(pattern_detection.Helper.THERMOSTAT_ERROR_MESSAGE, text_to_speech.Helper.PRIORITY_ERROR)
+    else:
+        text_to_speech.run(Data.create_mode_message(response))
+        print(f"Thermostat Mode -> {response}")
+
+# change volume or temperature after a circle pattern
+# the spotify part runs on the spotify lane and only hands over to the nest lane when nothing is playing,
+# so a circle never runs at the same time as another command for the same device
+def submit_pattern_command(dispatcher, rotation_direction):
+    dispatcher.submit(Data.SPOTIFY, run_pattern_command, dispatcher, rotation_direction, supersede=False)
+
+# change the spotify volume, or queue the thermostat change if spotify is not playing
+def run_pattern_command(command, dispatcher, rotation_direction):
+    if not pattern_detection.spotify_pattern_command(rotation_direction):
+        dispatcher.submit(Data.NEST, run_pattern_thermostat_command, rotation_direction, supersede=False)
+
+# change the thermostat temperature after a circle pattern
+def run_pattern_thermostat_command(command, rotation_direction):
+    pattern_detection.nest_pattern_command(rotation_direction)
+
+
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Gesture-Based Home Control")
+    parser.add_argument("--record", metavar="FILE", help="record landmarks and gestures (see landmark_recording.py)")
+    parser.add_argument("--label", metavar="GESTURE",
+                        choices=gesture_detection.GESTURES + (landmark_recording.Helper.NONE_LABEL,),
+                        help="with --record: the gesture you make during the whole recording, or none "
+                             "(ground truth to train and evaluate classifiers on)")
+    parser.add_argument("--source", action="append",
+                        help="camera index or video file, repeat for several rooms (default: camera 1)")
+    parser.add_argument("--workers", type=int, default=stream_manager.Helper.WORKERS,
+                        help="hand models shared by the rooms (with several --source)")
+    parser.add_argument("--headless", action="store_true", help="no windows and nothing drawn, stop with ctrl+c or kill")
+    parser.add_argument("--debug-port", type=int, metavar="PORT",
+                        help="serve an MJPEG debug view on this port (drawn only while someone watches)")
+    parser.add_argument("--classifier", metavar="FILE",
+                        help="learned gesture classifier (see gesture_classifier.py), default: hand written rules")
+    args = parser.parse_args()
+    if args.label is not None and args.record is None:
+        parser.error("--label needs --record")
+    sources = [int(source) if source.isdigit() else source for source in args.source or ["1"]]
+    if len(sources) > 1:
+        main_streams(sources, args.workers, args.headless, args.debug_port, args.classifier)
+    else:
+        main(args.record, sources[0], args.headless, args.debug_port, args.classifier, args.label)
@@ -0,0 +1,102 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+'''
+Shared HTTP transport for the nest, spotify and kasa modules.
+
+Every integration gets one HttpClient for the whole program. It wraps a requests.Session, so
+connections are kept alive and pooled per host: repeated commands to the same cloud API reuse
+a warm connection instead of doing a new TCP and TLS handshake every time.
+
+Every request has a connect and read timeout (a hung endpoint raises requests.exceptions.Timeout
+instead of blocking forever) and is timed per integration.
+
+Usage:
+    _http = http_session.client("nest")
+    response = _http.get(url, headers=headers)
+    http_session.stats()    # {"nest": {"requests": 3, "mean_ms": 120.5, ...}}
+'''
+
+
+class Helper:
+    # seconds to connect and seconds to wait for the response
+    CONNECT_TIMEOUT = 3.05
+    READ_TIMEOUT = 10
+    # hosts with pooled connections and connections kept per host
+    POOL_CONNECTIONS = 4
+    POOL_MAXSIZE = 4
+
+
+class HttpClient:
+    def __init__(self, name, timeout=(Helper.CONNECT_TIMEOUT, Helper.READ_TIMEOUT)):
+        self.name = name
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=Helper.POOL_CONNECTIONS, pool_maxsize=Helper.POOL_MAXSIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.lock = threading.Lock()
+        # request timing
+        self.requests = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_time = 0.0
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.requests += 1
+                self.total_time += elapsed
+                self.max_time = max(self.max_time, elapsed)
+                self.last_time = elapsed
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "mean_ms": round(self.total_time / self.requests * 1000, 1) if self.requests else 0.0,
+                "max_ms": round(self.max_time * 1000, 1),
+                "last_ms": round(self.last_time * 1000, 1),
+            }
+
+
+_clients = {}
+_lock = threading.Lock()
+
+
+# the client of an integration (created on first use)
+def client(name):
+    with _lock:
+        if name not in _clients:
+            _clients[name] = HttpClient(name)
+        return _clients[name]
+
+
+# request timing of every integration
+def stats():
+    with _lock:
+        clients = dict(_clients)
+    return {name: http_client.stats() for name, http_client in clients.items()}
@@ -0,0 +1,163 @@
+import cv2
+import numpy as np
+
+'''
+Idle mode for the inference stage.
+
+Running the hand model on every frame keeps a core busy even when nobody is in the room. After
+`idle_after` frames in a row without a hand the monitor goes idle: frames are only checked every
+`interval` seconds with a cheap presence check (a small grayscale copy of the frame compared to
+the last one checked) and the model is not run. Motion wakes the monitor up and the model runs
+on every frame again. While idle the model is still run every `probe_interval` seconds, so a
+hand held perfectly still in front of the camera is not missed.
+
+Counters: seconds spent active and idle, number of wake ups, wake ups that never found a hand
+and the wake latency (motion seen -> first hand found).
+
+Usage:
+    monitor = IdleMonitor()
+    if monitor.should_infer(image, timestamp):
+        hand = ...
+        monitor.update(hand is not None, timestamp)
+'''
+
+
+class Helper:
+    ACTIVE, IDLE = "active", "idle"
+    # frames without a hand before going idle
+    IDLE_AFTER = 90
+    # seconds between presence checks while idle
+    INTERVAL = 0.25
+    # seconds between model runs while idle (0 -> never)
+    PROBE_INTERVAL = 2.0
+    # size of the grayscale copy that is compared
+    MOTION_SIZE = (64, 48)
+    # a pixel changed if its gray value changed more than PIXEL_THRESHOLD,
+    # there is motion if more than MOTION_THRESHOLD of the pixels changed
+    PIXEL_THRESHOLD = 25
+    MOTION_THRESHOLD = 0.01
+
+
+class IdleMonitor:
+    def __init__(self, idle_after=Helper.IDLE_AFTER, interval=Helper.INTERVAL, motion_threshold=Helper.MOTION_THRESHOLD,
+                 pixel_threshold=Helper.PIXEL_THRESHOLD, probe_interval=Helper.PROBE_INTERVAL):
+        """
+        :param idle_after: frames without a hand before going idle
+        :param interval: seconds between presence checks while idle
+        :param motion_threshold: part of the pixels that has to change to wake up
+        :param pixel_threshold: gray value change of a pixel that counts as changed
+        :param probe_interval: seconds between model runs while idle (0 -> never)
+        """
+        self.idle_after = idle_after
+        self.interval = interval
+        self.motion_threshold = motion_threshold
+        self.pixel_threshold = pixel_threshold
+        self.probe_interval = probe_interval
+        self.mode = Helper.ACTIVE
+        self.frames_without_hand = 0
+        self.last_check = None
+        self.last_probe = None
+        self.reference = None
+        # time motion was seen, until a hand is found
+        self.woke_at = None
+        # time per mode
+        self.mode_since = None
+        self.time_in_mode = {Helper.ACTIVE: 0.0, Helper.IDLE: 0.0}
+        # counters
+        self.wakes = 0
+        self.false_wakes = 0
+        self.wake_latency_total = 0.0
+        self.wake_latency_max = 0.0
+        self.woken_by_hand = 0
+
+    @property
+    def idle(self):
+        return self.mode == Helper.IDLE
+
+    # seconds to wait before the next frame is worth looking at (0 while active)
+    def wait_time(self, timestamp):
+        if not self.idle or self.last_check is None:
+            return 0.0
+        return max(self.last_check + self.interval - timestamp, 0.0)
+
+    def should_infer(self, image, timestamp):
+        """
+        Decides if the model has to run on a frame
+        :param image: camera frame (BGR)
+        :param timestamp: time.monotonic() of the frame
+        :return: True if the model has to run on the frame
+        """
+        if self.mode_since is None:
+            self.mode_since = timestamp
+        if not self.idle:
+            return True
+        if self.last_check is not None and timestamp - self.last_check < self.interval:
+            return False
+
+        self.last_check = timestamp
+        small = cv2.cvtColor(cv2.resize(image, Helper.MOTION_SIZE, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        reference, self.reference = self.reference, small
+        if reference is not None:
+            changed = np.count_nonzero(cv2.absdiff(small, reference) > self.pixel_threshold)
+            if changed > self.motion_threshold * small.size:
+                self.wakes += 1
+                self.woke_at = timestamp
+                self.__set_mode(Helper.ACTIVE, timestamp)
+                return True
+
+        if self.probe_interval and (self.last_probe is None or timestamp - self.last_probe >= self.probe_interval):
+            self.last_probe = timestamp
+            return True
+        return False
+
+    def update(self, hand_found, timestamp):
+        """
+        Called with the result of every model run
+        :param hand_found: the model found a hand
+        :param timestamp: time.monotonic() of the frame
+        """
+        if hand_found:
+            self.frames_without_hand = 0
+            if self.idle:
+                # found by a probe, no motion was seen
+                self.woke_at = timestamp
+                self.wakes += 1
+                self.__set_mode(Helper.ACTIVE, timestamp)
+            if self.woke_at is not None:
+                latency = timestamp - self.woke_at
+                self.woken_by_hand += 1
+                self.wake_latency_total += latency
+                self.wake_latency_max = max(self.wake_latency_max, latency)
+                self.woke_at = None
+            return
+
+        if self.idle:
+            return
+        self.frames_without_hand += 1
+        if self.frames_without_hand >= self.idle_after:
+            # woke up but no hand showed up
+            if self.woke_at is not None:
+                self.false_wakes += 1
+                self.woke_at = None
+            self.reference = None
+            self.last_check = None
+            self.__set_mode(Helper.IDLE, timestamp)
+
+    def stats(self, timestamp=None):
+        time_in_mode = dict(self.time_in_mode)
+        if timestamp is not None and self.mode_since is not None:
+            time_in_mode[self.mode] += timestamp - self.mode_since
+        return {
+            "mode": self.mode,
+            "active_s": round(time_in_mode[Helper.ACTIVE], 1),
+            "idle_s": round(time_in_mode[Helper.IDLE], 1),
+            "wakes": self.wakes,
+            "false_wakes": self.false_wakes,
+            "wake_latency_ms": round(self.wake_latency_total / self.woken_by_hand * 1000, 1) if self.woken_by_hand else None,
+            "max_wake_latency_ms": round(self.wake_latency_max * 1000, 1) if self.woken_by_hand else None,
+        }
+
+    def __set_mode(self, mode, timestamp):
+        self.time_in_mode[self.mode] += timestamp - self.mode_since
+        self.mode, self.mode_since = mode, timestamp
+        self.frames_without_hand = 0
@@ -1,13 +1,48 @@
+import threading
+import time
 import uuid
 import requests
+import http_session
 from kasa_secrets import LOGIN_EMAIL, LOGIN_PASSWORD, KASA_SMART_PLUG_NAME
 
 #######################################################################################
-# This program controls a Kasa SmartPlug using KASA API in order to turn it ON and OFF. 
+# This program controls a Kasa SmartPlug using KASA API in order to turn it ON and OFF.
+#
+# The cloud token and the deviceId of every plug (by alias) are kept between calls, so
+# after the first call flipping the plug is a single request. The token is renewed when
+# it gets old or the API rejects it, the device list is fetched again when the plug is
+# not found or the API does not know the device anymore.
+#
+# Methods (available to use):
+# returns nothing if successful or ERROR
+# flip_switch(new_state)  # 1 -> ON, 0 -> OFF
+# log in and find the plug ahead of the first command, e.g. at startup
+# prefetch()
 #######################################################################################
 
+# pooled connections shared by every call to the Kasa API
+_http = http_session.client("kasa")
+
 class Kasa:
     ERROR = "ERROR"
+    LOGIN_URL = "https://wap.tplinkcloud.com/"
+    PASSTHROUGH_URL = "https://use1-wap.tplinkcloud.com/"
+    # seconds a token is used before logging in again
+    TOKEN_LIFETIME = 12 * 60 * 60
+    # error codes of the API: token expired/invalid, device offline/not bound to the account
+    TOKEN_ERRORS = {-20651, -20675}
+    DEVICE_ERRORS = {-20571, -20580}
+
+# state kept between calls
+class _Session:
+    token = None
+    token_time = 0
+    # same terminal for the whole program, a new one on every login creates a new session each time
+    terminal_uuid = str(uuid.uuid4())
+    # alias -> (deviceId, url to send commands for the device to)
+    devices = {}
+    # calls from different threads share the token and device index
+    lock = threading.Lock()
 
 # get token to use in API call
 def __get_kasa_token():
@@ -17,36 +52,84 @@ def __get_kasa_token():
                 "appType": "Kasa_Android",
                 "cloudUserName": LOGIN_EMAIL,
                 "cloudPassword": LOGIN_PASSWORD,
-                "terminalUUID": str(uuid.uuid4())
+                "terminalUUID": _Session.terminal_uuid
             }
     }
-    
-    response = requests.post(url="https://wap.tplinkcloud.com/", json=payload)
-    
+
+    try:
+        response = _http.post(url=Kasa.LOGIN_URL, json=payload)
+    except requests.exceptions.RequestException:
+        return Kasa.ERROR
+
     # make sure there wasn't an error
     if response.status_code == 200:
-        try: 
+        try:
             return response.json()["result"]["token"]
         except KeyError:
             return Kasa.ERROR
     else:
         return Kasa.ERROR
 
-# get the status and device id of SmartPlug
-def __get_kasa_device_status(token):
+# token of the session, logs in if there is none or it is too old (or `renew` is set)
+def __get_session_token(renew=False):
+    if renew or _Session.token is None or time.monotonic() - _Session.token_time > Kasa.TOKEN_LIFETIME:
+        token = __get_kasa_token()
+        if token == Kasa.ERROR:
+            _Session.token = None
+            return Kasa.ERROR
+        _Session.token, _Session.token_time = token, time.monotonic()
+    return _Session.token
+
+# get the device id of every device on the account (indexed by name)
+# returns the devices, the error code of the API or ERROR
+def __get_kasa_devices(token):
     payload = {"method": "getDeviceList"}
-    device_list = requests.post(f"https://wap.tplinkcloud.com?token={token}", json=payload)
-    
-    # find the device based on device name
-    for index in range(len(device_list.json())):
-        device = device_list.json()['result']['deviceList'][index]
-        if device['alias'] == KASA_SMART_PLUG_NAME:
-            return device['deviceId']
-    
-    return Kasa.ERROR
+    try:
+        response = _http.post(f"{Kasa.LOGIN_URL}?token={token}", json=payload)
+    except requests.exceptions.RequestException:
+        return Kasa.ERROR
+
+    try:
+        json_data = response.json()
+        # e.g. the token was rejected, there is no result then
+        error_code = json_data.get("error_code", 0)
+        if error_code != 0:
+            return error_code
+        device_list = json_data['result']['deviceList']
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return Kasa.ERROR
+
+    return {device['alias']: (device['deviceId'], device.get('appServerUrl', Kasa.PASSTHROUGH_URL))
+            for device in device_list}
+
+# get the device id of SmartPlug, the device list is only fetched if the plug is not known yet (or `refresh` is set)
+# returns the device, the error code of the API or ERROR
+def __get_kasa_device(token, alias, refresh=False):
+    if refresh or alias not in _Session.devices:
+        devices = __get_kasa_devices(token)
+        if not isinstance(devices, dict):
+            return devices
+        _Session.devices = devices
+
+    return _Session.devices.get(alias, Kasa.ERROR)
+
+# get the device id of SmartPlug, logs in again and retries once if the token was rejected
+# returns (token, device), device is ERROR if the plug could not be found
+def __get_plug(token, refresh=False):
+    device = __get_kasa_device(token, KASA_SMART_PLUG_NAME, refresh)
+    if device in Kasa.TOKEN_ERRORS:
+        token = __get_session_token(renew=True)
+        if token == Kasa.ERROR:
+            return token, Kasa.ERROR
+        device = __get_kasa_device(token, KASA_SMART_PLUG_NAME, refresh)
+    if not isinstance(device, tuple):
+        return token, Kasa.ERROR
+    return token, device
 
 # switch state of plug to whatever the user specfies
-def __flip_switch(token, deviceID, deviceState):
+# returns nothing if successful, the error code of the API or ERROR
+def __flip_switch(token, device, deviceState):
+    deviceID, url = device
     payload = {
             "method": "passthrough",
             "params": {
@@ -55,14 +138,53 @@ def __flip_switch(token, deviceID, deviceState):
                     '{\"system\":{\"set_relay_state\":{\"state\":' + str(deviceState) + '}}}'
             }
         }
-    
-    response = requests.post(url=f"https://use1-wap.tplinkcloud.com/?token={token}", json=payload)
-    
+
+    try:
+        response = _http.post(url=f"{url.rstrip('/')}/?token={token}", json=payload)
+    except requests.exceptions.RequestException:
+        return Kasa.ERROR
+
     if response.status_code != 200:
         return Kasa.ERROR
-  
-# change the current state of the switch  
+
+    try:
+        error_code = response.json().get("error_code", 0)
+    except ValueError:
+        return Kasa.ERROR
+    if error_code != 0:
+        return error_code
+
+# change the current state of the switch
 def flip_switch(new_state):
-    token = __get_kasa_token()
-    deviceID = __get_kasa_device_status(token)
-    __flip_switch(token, deviceID, new_state)
\ No newline at end of file
+    with _Session.lock:
+        token = __get_session_token()
+        if token == Kasa.ERROR:
+            return Kasa.ERROR
+        token, device = __get_plug(token)
+        if device == Kasa.ERROR:
+            return Kasa.ERROR
+
+        status = __flip_switch(token, device, new_state)
+        # token was rejected, log in again and retry once
+        if status in Kasa.TOKEN_ERRORS:
+            token = __get_session_token(renew=True)
+            if token == Kasa.ERROR:
+                return Kasa.ERROR
+            status = __flip_switch(token, device, new_state)
+        # device is not known under that id anymore, look it up again and retry once
+        if status in Kasa.DEVICE_ERRORS:
+            token, device = __get_plug(token, refresh=True)
+            if device == Kasa.ERROR:
+                return Kasa.ERROR
+            status = __flip_switch(token, device, new_state)
+
+        return None if status is None else Kasa.ERROR
+
+# log in and look up the plug before the first command needs them
+def prefetch():
+    with _Session.lock:
+        token = __get_session_token()
+        if token == Kasa.ERROR:
+            return Kasa.ERROR
+        if __get_plug(token)[1] == Kasa.ERROR:
+            return Kasa.ERROR
@@ -0,0 +1,236 @@
+import collections
+import time
+
+import cv2
+import numpy as np
+
+'''
+Single hand-landmark inference stage shared by gesture detection and pattern detection.
+
+Every frame goes through mediapipe's Hands model exactly once. The result is a HandResult
+holding the 21 normalized landmarks of the camera frame (as captured, NOT mirrored), which
+hand of the user it is and the size of the frame.
+
+Consumers that want the mirrored ("selfie") view, like the pattern detector which draws
+the path as if the user was looking in a mirror, get it through coordinates (mirrored x = 1 - x)
+instead of running inference again on cv2.flip() output. Mirroring does not change which
+hand the user is holding up, so handedness is the same for both views.
+
+HandTracker (used by the pipeline) keeps the bounding box of the last hand and runs the model
+on a padded crop around it instead of the whole frame, falling back to the full frame when the
+hand is lost. The image given to the model is scaled down to an inference width that adapts
+to the measured latency. Landmarks are always mapped back to normalized coordinates of the
+full frame, so consumers can not tell the difference.
+'''
+
+# a single landmark, same fields as mediapipe's NormalizedLandmark
+Landmark = collections.namedtuple("Landmark", ["x", "y", "z"])
+
+
+class Helper:
+    LEFT_HAND = "Left"
+    RIGHT_HAND = "Right"
+    NUM_LANDMARKS = 21
+    MIN_DETECTION_CONFIDENCE = 0.5
+    MIN_TRACKING_CONFIDENCE = 0.5
+    MAX_NUM_HANDS = 1
+    # part of the hand's size added to each side of the crop
+    ROI_PADDING = 0.35
+    # smallest crop (part of the frame's shorter side), a far away hand still gets some context
+    MIN_ROI_SIZE = 0.25
+    # longest side of the image given to the model, largest first
+    INFERENCE_WIDTHS = (640, 480, 320, 240)
+    # seconds the model may take per frame, resolution goes down above and up well below it
+    TARGET_LATENCY = 0.030
+    LATENCY_HEADROOM = 0.6
+    # frames between resolution changes and weight of a new latency sample
+    ADAPT_INTERVAL = 30
+    LATENCY_SMOOTHING = 0.1
+
+
+class HandResult:
+    def __init__(self, points, handedness, score, width, height):
+        # (21, 3) float32 array of normalized x, y, z (x and y are in [0, 1] of the frame)
+        self.points = points
+        # "Left" or "Right", the hand of the user (not the side of the image it appears on)
+        self.handedness = handedness
+        # confidence of the handedness classification
+        self.score = score
+        # size of the frame the landmarks were detected on
+        self.width, self.height = width, height
+        self._landmark = None
+
+    # landmarks as a list of (x, y, z) named tuples, mirrors mediapipe's `landmark` field
+    @property
+    def landmark(self):
+        if self._landmark is None:
+            self._landmark = [Landmark(*point) for point in self.points.tolist()]
+        return self._landmark
+
+    # landmarks in pixel coordinates of the frame, optionally mirrored horizontally
+    def to_pixels(self, mirror=False):
+        x = 1 - self.points[:, 0] if mirror else self.points[:, 0]
+        pixels = np.empty((Helper.NUM_LANDMARKS, 3), np.int32)
+        pixels[:, 0] = x * self.width
+        pixels[:, 1] = self.points[:, 1] * self.height
+        pixels[:, 2] = self.points[:, 2] * self.width
+        return pixels
+
+
+# static_image_mode: detect every image on its own instead of tracking the hand between frames
+def init(static_image_mode=False):
+    # mediapipe takes a while to import, it is only loaded when a model is created
+    import mediapipe as mp
+    return mp.solutions.hands.Hands(static_image_mode=static_image_mode,
+                                    min_detection_confidence=Helper.MIN_DETECTION_CONFIDENCE,
+                                    min_tracking_confidence=Helper.MIN_TRACKING_CONFIDENCE,
+                                    max_num_hands=Helper.MAX_NUM_HANDS)
+
+
+# run the model once on a blank frame, so the first camera frame does not pay for setting it up
+def warm_up(hands, width=Helper.INFERENCE_WIDTHS[0], height=480):
+    hands.process(np.zeros((height, width, 3), np.uint8))
+    return hands
+
+
+def run(image, hands):
+    return detect_landmarks(image, hands)
+
+
+def detect_landmarks(image, hands):
+    """
+    Runs the hand landmark model once on the (BGR) camera frame
+    :param image: camera frame
+    :param hands: mediapipe Hands instance returned by init()
+    :return: HandResult or None if no hand was found
+    """
+    height, width = image.shape[:2]
+    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    # lets mediapipe use the image without copying it
+    rgb_image.flags.writeable = False
+    results = hands.process(rgb_image)
+    if not results.multi_hand_landmarks:
+        return None
+
+    landmarks = results.multi_hand_landmarks[0].landmark
+    points = np.array([(landmark.x, landmark.y, landmark.z) for landmark in landmarks], np.float32)
+    # mediapipe assumes a mirrored (selfie) image when labelling the hand, the camera
+    # frame is not mirrored so the label is swapped to get the actual hand of the user
+    classification = results.multi_handedness[0].classification[0]
+    handedness = Helper.LEFT_HAND if classification.label == Helper.RIGHT_HAND else Helper.RIGHT_HAND
+    return HandResult(points, handedness, classification.score, width, height)
+
+
+# scale the image down so its longest side is at most max_size
+def _resize(image, max_size):
+    height, width = image.shape[:2]
+    scale = max_size / max(height, width)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(int(width * scale), 1), max(int(height * scale), 1)), interpolation=cv2.INTER_AREA)
+
+
+class HandTracker:
+    def __init__(self, hands, use_roi=True, inference_width=Helper.INFERENCE_WIDTHS[0], adaptive=True,
+                 target_latency=Helper.TARGET_LATENCY):
+        """
+        Runs the landmark model on a crop around the last hand, at an adaptive resolution
+        :param hands: mediapipe Hands instance returned by init(), init(static_image_mode=True) if use_roi
+                      (a tracking model loses its track when it gets crops and full frames in turn)
+        :param use_roi: crop around the last hand, False always runs on the full frame
+        :param inference_width: longest side of the image given to the model (starting value if adaptive)
+        :param adaptive: change inference_width between Helper.INFERENCE_WIDTHS to stay under target_latency
+        :param target_latency: seconds the model may take per frame
+        """
+        self.hands = hands
+        self.use_roi = use_roi
+        self.inference_width = inference_width
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        # (x0, y0, x1, y1) pixels of the crop for the next frame, None -> full frame
+        self.roi = None
+        self.latency = None
+        self.frames_since_adapt = 0
+        # counters
+        self.roi_frames = 0
+        self.full_frames = 0
+        self.fallbacks = 0
+
+    # hands: model to use for this frame (None -> the tracker's model), lets trackers share models
+    def run(self, image, hands=None):
+        hands = self.hands if hands is None else hands
+        start = time.perf_counter()
+        hand = None
+        if self.roi is not None:
+            self.roi_frames += 1
+            hand = self.__detect(image, self.roi, hands)
+            if hand is None:
+                # hand left the crop (or was lost), look at the whole frame again
+                self.fallbacks += 1
+        if hand is None:
+            self.full_frames += 1
+            hand = self.__detect(image, None, hands)
+
+        self.roi = self.__next_roi(hand) if self.use_roi and hand is not None else None
+        self.__adapt(time.perf_counter() - start)
+        return hand
+
+    def stats(self):
+        return {
+            "roi_frames": self.roi_frames,
+            "full_frames": self.full_frames,
+            "fallbacks": self.fallbacks,
+            # share of crops without a hand, each of them runs the model a second time on the full frame
+            "fallback_rate": round(self.fallbacks / self.roi_frames, 3) if self.roi_frames else None,
+            "inference_width": self.inference_width,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+        }
+
+    # run the model on a part of the frame and map the landmarks back to the full frame
+    def __detect(self, image, roi, hands):
+        height, width = image.shape[:2]
+        x0, y0, x1, y1 = roi if roi is not None else (0, 0, width, height)
+        crop = _resize(image[y0:y1, x0:x1], self.inference_width)
+        hand = detect_landmarks(crop, hands)
+        if hand is None:
+            return None
+
+        crop_width, crop_height = x1 - x0, y1 - y0
+        points = hand.points
+        points[:, 0] = (points[:, 0] * crop_width + x0) / width
+        points[:, 1] = (points[:, 1] * crop_height + y0) / height
+        # z uses the same scale as x
+        points[:, 2] *= crop_width / width
+        return HandResult(points, hand.handedness, hand.score, width, height)
+
+    # padded square around the hand, inside the frame
+    def __next_roi(self, hand):
+        width, height = hand.width, hand.height
+        xs, ys = hand.points[:, 0] * width, hand.points[:, 1] * height
+        size = max(xs.max() - xs.min(), ys.max() - ys.min()) * (1 + 2 * Helper.ROI_PADDING)
+        size = min(max(size, Helper.MIN_ROI_SIZE * min(width, height)), min(width, height))
+        center_x, center_y = (xs.max() + xs.min()) / 2, (ys.max() + ys.min()) / 2
+        x0 = int(min(max(center_x - size / 2, 0), width - size))
+        y0 = int(min(max(center_y - size / 2, 0), height - size))
+        return x0, y0, x0 + int(size), y0 + int(size)
+
+    # lower the resolution when the model is too slow, raise it when there is room
+    def __adapt(self, elapsed):
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += (elapsed - self.latency) * Helper.LATENCY_SMOOTHING
+        if not self.adaptive:
+            return
+        self.frames_since_adapt += 1
+        if self.frames_since_adapt < Helper.ADAPT_INTERVAL:
+            return
+        self.frames_since_adapt = 0
+
+        widths = Helper.INFERENCE_WIDTHS
+        smaller = [size for size in widths if size < self.inference_width]
+        larger = [size for size in widths if size > self.inference_width]
+        if self.latency > self.target_latency and smaller:
+            self.inference_width = max(smaller)
+        elif self.latency < self.target_latency * Helper.LATENCY_HEADROOM and larger:
+            self.inference_width = min(larger)
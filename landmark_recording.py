@@ -0,0 +1,417 @@
+import argparse
+import collections
+import os
+import struct
+import time
+
+import numpy as np
+
+import gesture_debouncer
+import gesture_detection
+import landmark_detection
+import pattern_detection
+
+'''
+Compact recording of hand landmarks, for camera-free regression and performance runs.
+
+A recording is a single binary file laid out in columns, every column is a preallocated array
+with one entry per frame:
+
+    header     magic, version, capacity (frames allocated), count (frames written), frame size
+    timestamp  float64              time.monotonic() of the frame
+    points     float32 (21, 3)      normalized landmarks (0 when no hand was found)
+    hand       int8                 0 no hand, 1 left hand, 2 right hand
+    score      float32              handedness confidence
+    gesture    int8                 gesture the classifier found, index in gesture_detection.GESTURES,
+                                    -1 for no gesture
+    label      int8                 gesture the user was actually making (ground truth, same indices),
+                                    -2 if the frame was not labelled
+
+The gesture column is what the program saw, so it can not be used to train or judge the classifier.
+Labels are given while recording (--label of gesture_detection_main.py: the user makes that gesture,
+or "none" for hand movements that are no gesture, for the whole recording) or afterwards for a range
+of frames (--relabel). Version 1 recordings have no label column, all of their frames are unlabelled.
+
+The file is written through a memory map (it doubles in size when it runs out of frames) and
+replayed through a read-only memory map, so replaying does not decode video or copy landmarks.
+
+Usage:
+    recorder = LandmarkRecorder("session.lmrec", width, height, label="fist")
+    recorder.write(timestamp, hand, gesture)
+    recorder.close()
+
+    for timestamp, hand, gesture in LandmarkReplay("session.lmrec"):
+        ...
+
+    # check the classifier against a recording at full speed
+    python landmark_recording.py session.lmrec --pattern
+
+    # time-to-commit and false commits of the debouncers (labels are the truth)
+    python landmark_recording.py session.lmrec --commits [--classifier gestures.npz]
+
+    # label frames 120 to 479 as "ok", and everything from frame 480 on as no gesture
+    python landmark_recording.py session.lmrec --relabel ok --frames 120:480
+    python landmark_recording.py session.lmrec --relabel none --frames 480:
+'''
+
+
+class Helper:
+    MAGIC = b"LMREC\0\0\0"
+    VERSION = 2
+    # magic, version, capacity, count, width, height
+    HEADER = struct.Struct("<8sIIIII")
+    HEADER_SIZE = 64
+    ALIGNMENT = 64
+    CAPACITY = 30 * 60 * 10
+    NUM_LANDMARKS = landmark_detection.Helper.NUM_LANDMARKS
+    NO_HAND, LEFT_HAND, RIGHT_HAND = 0, 1, 2
+    NO_GESTURE = -1
+    UNLABELLED = -2
+    # label of the frames where the user makes no gesture
+    NONE_LABEL = "none"
+    # commits: frames without a gesture inside a labelled gesture that do not end it, and the
+    # frames a gesture has to be held to count as one the user meant
+    MAX_GAP = 5
+    MIN_SEGMENT = 10
+    # name, dtype and shape of one entry of every column
+    COLUMNS = (
+        ("timestamp", np.float64, ()),
+        ("points", np.float32, (landmark_detection.Helper.NUM_LANDMARKS, 3)),
+        ("hand", np.int8, ()),
+        ("score", np.float32, ()),
+        ("gesture", np.int8, ()),
+        ("label", np.int8, ()),
+    )
+    # columns of every version of the format (version 1 has no labels)
+    VERSION_COLUMNS = {1: COLUMNS[:5], 2: COLUMNS}
+    HANDS = {landmark_detection.Helper.LEFT_HAND: LEFT_HAND, landmark_detection.Helper.RIGHT_HAND: RIGHT_HAND}
+    HAND_NAMES = {LEFT_HAND: landmark_detection.Helper.LEFT_HAND, RIGHT_HAND: landmark_detection.Helper.RIGHT_HAND}
+
+
+# byte offset of every column in a file allocated for `capacity` frames
+def _layout(capacity, columns=Helper.COLUMNS):
+    offsets, offset = {}, Helper.HEADER_SIZE
+    for name, dtype, shape in columns:
+        offsets[name] = offset
+        size = capacity * np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64))
+        offset += -(-size // Helper.ALIGNMENT) * Helper.ALIGNMENT
+    return offsets, offset
+
+
+def _map_columns(path, capacity, mode, columns=Helper.COLUMNS):
+    offsets, _ = _layout(capacity, columns)
+    return {name: np.memmap(path, dtype=dtype, mode=mode, offset=offsets[name], shape=(capacity,) + shape)
+            for name, dtype, shape in columns}
+
+
+def _read_header(path):
+    with open(path, "rb") as file:
+        magic, version, capacity, count, width, height = Helper.HEADER.unpack(file.read(Helper.HEADER.size))
+    if magic != Helper.MAGIC or version not in Helper.VERSION_COLUMNS:
+        raise ValueError(f"{path} is not a landmark recording")
+    return version, capacity, count, width, height
+
+
+# value of the label column for a gesture name, "none" or None (not labelled)
+def label_code(label):
+    if label is None:
+        return Helper.UNLABELLED
+    if label == Helper.NONE_LABEL:
+        return Helper.NO_GESTURE
+    if label not in gesture_detection.GESTURES:
+        raise ValueError(f"Unknown label {label}, expected one of {gesture_detection.GESTURES} or {Helper.NONE_LABEL}")
+    return gesture_detection.GESTURES.index(label)
+
+
+class LandmarkRecorder:
+    def __init__(self, path, width, height, capacity=Helper.CAPACITY, label=None):
+        """
+        :param path: recording file (overwritten)
+        :param width: width of the frames
+        :param height: height of the frames
+        :param capacity: frames allocated at first, the file grows when they run out
+        :param label: gesture the user makes during the whole recording, "none" for no gesture
+                      or None if the frames are not labelled
+        """
+        self.path = path
+        self.width, self.height = width, height
+        self.label = label_code(label)
+        self.count = 0
+        self.capacity = 0
+        self.columns = None
+        self.__allocate(capacity)
+
+    def write(self, timestamp, hand, gesture):
+        """
+        Adds a frame to the recording
+        :param timestamp: time of the frame
+        :param hand: landmark_detection.HandResult or None
+        :param gesture: gesture detected in the frame or None
+        """
+        if self.count == self.capacity:
+            self.__allocate(self.capacity * 2)
+        index = self.count
+        self.columns["timestamp"][index] = timestamp
+        if hand is None:
+            self.columns["points"][index] = 0
+            self.columns["hand"][index] = Helper.NO_HAND
+            self.columns["score"][index] = 0
+        else:
+            self.columns["points"][index] = hand.points
+            self.columns["hand"][index] = Helper.HANDS[hand.handedness]
+            self.columns["score"][index] = hand.score
+        self.columns["gesture"][index] = Helper.NO_GESTURE if gesture is None else gesture_detection.GESTURES.index(gesture)
+        self.columns["label"][index] = self.label
+        self.count += 1
+
+    def close(self):
+        self.__flush()
+        self.columns = None
+
+    def __flush(self):
+        for column in self.columns.values():
+            column.flush()
+        with open(self.path, "r+b") as file:
+            file.write(Helper.HEADER.pack(Helper.MAGIC, Helper.VERSION, self.capacity, self.count, self.width, self.height))
+
+    # (re)creates the file with room for `capacity` frames, keeping the frames written so far
+    def __allocate(self, capacity):
+        _, size = _layout(capacity)
+        if self.columns is None:
+            with open(self.path, "wb") as file:
+                file.truncate(size)
+            self.capacity = capacity
+            self.columns = _map_columns(self.path, capacity, "r+")
+            self.__flush()
+            return
+
+        new_path = f"{self.path}.tmp"
+        with open(new_path, "wb") as file:
+            file.truncate(size)
+        columns = _map_columns(new_path, capacity, "r+")
+        for name, column in self.columns.items():
+            columns[name][:self.count] = column[:self.count]
+        self.close()
+        for column in columns.values():
+            column.flush()
+        # unmap the new file before replacing the old one
+        columns = None
+        os.replace(new_path, self.path)
+        self.capacity = capacity
+        self.columns = _map_columns(self.path, capacity, "r+")
+        self.__flush()
+
+
+class LandmarkReplay:
+    def __init__(self, path):
+        self.path = path
+        version, capacity, self.count, self.width, self.height = _read_header(path)
+        columns = _map_columns(path, capacity, "r", Helper.VERSION_COLUMNS[version])
+        # only the frames that were written
+        self.timestamps = columns["timestamp"][:self.count]
+        self.points = columns["points"][:self.count]
+        self.hands = columns["hand"][:self.count]
+        self.scores = columns["score"][:self.count]
+        self.gestures = columns["gesture"][:self.count]
+        if "label" in columns:
+            self.labels = columns["label"][:self.count]
+        else:
+            self.labels = np.full(self.count, Helper.UNLABELLED, np.int8)
+
+    def __len__(self):
+        return self.count
+
+    # landmarks of a frame as the landmark stage returned them (no copy), None if there was no hand
+    def hand(self, index):
+        hand = int(self.hands[index])
+        if hand == Helper.NO_HAND:
+            return None
+        return landmark_detection.HandResult(self.points[index], Helper.HAND_NAMES[hand], float(self.scores[index]),
+                                             self.width, self.height)
+
+    def gesture(self, index):
+        gesture = int(self.gestures[index])
+        return None if gesture == Helper.NO_GESTURE else gesture_detection.GESTURES[gesture]
+
+    # yields (timestamp, hand, gesture) of every frame
+    def __iter__(self):
+        for index in range(self.count):
+            yield float(self.timestamps[index]), self.hand(index), self.gesture(index)
+
+
+def relabel(path, label, start=0, end=None):
+    """
+    Sets the ground truth of a range of frames
+    :param path: recording file (version 2)
+    :param label: gesture the user makes in those frames, "none" for no gesture or None to unlabel them
+    :param start: first frame
+    :param end: frame after the last one, None for the end of the recording
+    :return: number of frames changed
+    """
+    code = label_code(label)
+    version, capacity, count, _, _ = _read_header(path)
+    if version < Helper.VERSION:
+        raise ValueError(f"{path} was recorded before frames could be labelled, record it again")
+    labels = _map_columns(path, capacity, "r+")["label"]
+    frames = labels[:count][start:end]
+    frames[:] = code
+    labels.flush()
+    return len(frames)
+
+
+def replay(path, track_pattern=False):
+    """
+    Feeds a recording to the gesture classifier (and pattern tracker) as fast as possible
+    :param path: recording file
+    :param track_pattern: also run the circle pattern tracker, circles are counted but no API is called
+    :return: dict with frames, fps, gestures found and frames where the gesture changed from the recording
+    """
+    recording = LandmarkReplay(path)
+    pattern_data = None
+    circles = collections.Counter()
+    if track_pattern:
+        pattern_data = pattern_detection.init()
+        pattern_data.on_circle = lambda direction: circles.update([direction])
+        pattern_detection.reset_pattern(pattern_data)
+
+    gestures = collections.Counter()
+    mismatches = []
+    start = time.perf_counter()
+    for index, (_, hand, recorded_gesture) in enumerate(recording):
+        gesture = gesture_detection.detect_gesture(hand)
+        gestures[gesture] += 1
+        if gesture != recorded_gesture:
+            mismatches.append(index)
+        if pattern_data is not None:
+            pattern_detection.run(hand, pattern_data)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "frames": len(recording),
+        "fps": round(len(recording) / max(elapsed, 1e-9), 1),
+        "gestures": dict(gestures),
+        "circles": dict(circles),
+        "mismatches": mismatches,
+    }
+
+
+# gestures as (gesture, first frame, last frame), short gaps without a gesture do not end one
+def _segments(gestures, max_gap=Helper.MAX_GAP):
+    segments = []
+    current, start, last = Helper.NO_GESTURE, 0, 0
+    for index, gesture in enumerate(gestures.tolist()):
+        if gesture == current and current != Helper.NO_GESTURE:
+            last = index
+        elif gesture == Helper.NO_GESTURE and current != Helper.NO_GESTURE and index - last <= max_gap:
+            continue
+        else:
+            if current != Helper.NO_GESTURE:
+                segments.append((current, start, last))
+            current, start, last = gesture, index, index
+    if current != Helper.NO_GESTURE:
+        segments.append((current, start, last))
+    return segments
+
+
+def replay_commits(path, debouncers, classifier_data=None):
+    """
+    Feeds a recording to gesture debouncers and checks when they confirm a gesture
+    :param path: recording file, its labels are taken as the truth (the gesture column is what the rules
+                 found when it was recorded, the rules would only be compared with themselves)
+    :param debouncers: dict of name -> debouncer (gesture_debouncer.GestureDebouncer or EvidenceDebouncer)
+    :param classifier_data: classifier the hands are classified with again (gesture_detection.init())
+    :return: dict of name -> commits, false commits (gesture not being made), false commit rate, labelled
+             gestures confirmed / missed and time-to-commit (labelled gesture start -> first commit);
+             commits in unlabelled frames are only counted as unlabelled_commits
+    """
+    recording = LandmarkReplay(path)
+    labelled = recording.labels != Helper.UNLABELLED
+    if not labelled.any():
+        raise ValueError(f"{path} has no labelled frames, label it with --relabel")
+    segments = _segments(np.where(labelled, recording.labels, Helper.NO_GESTURE))
+    # segment of every frame, a commit right after the gesture ended (the gap) still belongs to it
+    segment_of = np.full(len(recording), -1)
+    for number, (_, start, last) in enumerate(segments):
+        segment_of[start:last + Helper.MAX_GAP + 1] = number
+
+    classified = [gesture_detection.classify(hand, classifier_data) for hand in
+                  (recording.hand(index) for index in range(len(recording)))]
+    results = {}
+    for name, debouncer in debouncers.items():
+        commits, false_commits, unlabelled_commits, latencies, frames_to_commit = 0, 0, 0, [], []
+        confirmed = set()
+        for index, (gesture, confidences) in enumerate(classified):
+            committed = debouncer.update(gesture, float(recording.timestamps[index]), confidences)
+            if committed is None:
+                continue
+            number = segment_of[index]
+            if number < 0 and not labelled[index]:
+                unlabelled_commits += 1
+                continue
+            commits += 1
+            if number < 0 or gesture_detection.GESTURES[segments[number][0]] != committed:
+                false_commits += 1
+            elif number not in confirmed:
+                confirmed.add(number)
+                start = segments[number][1]
+                latencies.append(recording.timestamps[index] - recording.timestamps[start])
+                frames_to_commit.append(index - start + 1)
+        held = [number for number, (_, start, last) in enumerate(segments) if last - start + 1 >= Helper.MIN_SEGMENT]
+        results[name] = {
+            "commits": commits,
+            "false_commits": false_commits,
+            "false_commit_rate": round(false_commits / commits, 3) if commits else None,
+            "unlabelled_commits": unlabelled_commits,
+            "gestures": len(held),
+            "missed": sum(number not in confirmed for number in held),
+            "time_to_commit_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 1) if latencies else None,
+            "time_to_commit_p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 1) if latencies else None,
+            "frames_to_commit_p50": float(np.percentile(frames_to_commit, 50)) if frames_to_commit else None,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a landmark recording through the gesture classifier")
+    parser.add_argument("recording")
+    parser.add_argument("--pattern", action="store_true", help="also run the circle pattern tracker")
+    parser.add_argument("--commits", action="store_true",
+                        help="time-to-commit and false commits of the frame window and evidence debouncers "
+                             "(on the labelled frames)")
+    parser.add_argument("--classifier", help="learned gesture classifier for --commits (default: hand written rules)")
+    parser.add_argument("--bound", type=float, default=gesture_debouncer.Helper.BOUND,
+                        help="evidence needed to confirm a gesture (--commits)")
+    parser.add_argument("--relabel", metavar="GESTURE",
+                        help=f"set the ground truth of --frames to a gesture or {Helper.NONE_LABEL}")
+    parser.add_argument("--frames", default=":", metavar="START:END", help="frames to --relabel (default: all)")
+    args = parser.parse_args()
+
+    if args.relabel is not None:
+        start, _, end = args.frames.partition(":")
+        changed = relabel(args.recording, args.relabel, int(start) if start else 0, int(end) if end else None)
+        print(f"Labelled {changed} frames as {args.relabel}")
+        return
+
+    if args.commits:
+        debouncers = {
+            "window": gesture_debouncer.GestureDebouncer(gesture_detection.GESTURES),
+            "evidence": gesture_debouncer.EvidenceDebouncer(gesture_detection.GESTURES, gesture_detection.CLASSES,
+                                                            bound=args.bound),
+        }
+        classifier_data = gesture_detection.init(args.classifier) if args.classifier else None
+        for name, result in replay_commits(args.recording, debouncers, classifier_data).items():
+            print(f"Commits [{name}] -> {result}")
+        return
+
+    result = replay(args.recording, args.pattern)
+    print(f"Frames -> {result['frames']} ({result['fps']} fps)")
+    print(f"Gestures -> {result['gestures']}")
+    if args.pattern:
+        print(f"Circles -> {result['circles']}")
+    print(f"Frames with a different gesture than recorded -> {len(result['mismatches'])}")
+    if result["mismatches"]:
+        print(result["mismatches"][:50])
+
+
+if __name__ == '__main__':
+    main()
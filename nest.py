@@ -1,5 +1,7 @@
+import threading
+import time
 import requests
-import pip._vendor.requests as requests
+import http_session
 from nest_secrets import PROJECT_ID, DEVICE_ID, CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN
 
 '''
@@ -16,6 +18,12 @@ get_current_temp_mode()
 # get current temp ("OFF" -> 0, "HOT" or "COOL" -> value > 0)
 get_current_temp()
 
+# seconds thermostat data is reused before calling the API again (default 5)
+set_device_state_ttl(seconds)
+
+# get a token (and the thermostat data) ahead of the first command, e.g. at startup
+prefetch()
+
 # parameter: value - int{set-temperate via [number]} -OR- string{set-mode via ["OFF", "HOT", "COOL"]}
 # parameter: command - string{"SetCool", "SetHeat", "SetMode"}
 # info 1: "SetCool", "SetHeat" used with setting temperate number
@@ -25,9 +33,18 @@ get_current_temp()
 update_thermostat(value, command)
 '''
 
+# pooled connections shared by every call to the Nest API
+_http = http_session.client("nest")
+
 class _Helper:
-    # access token changes for each API call
+    # current access token (managed by _TokenCache)
     ACCESS_TOKEN = None
+    # refresh the token this many seconds before it expires
+    TOKEN_REFRESH_AHEAD = 60
+    # used if the token response has no "expires_in"
+    DEFAULT_TOKEN_LIFETIME = 3600
+    # seconds the thermostat data is reused before asking the API again
+    DEVICE_STATE_TTL = 5
     
     # constants
     ERROR = 'ERROR'
@@ -71,20 +88,121 @@ class _Helper:
 
 class __Nest_Thermostat:
     def __init__(self, response):
-        self.temperature_scale = response.json()["traits"]["sdm.devices.traits.Settings"]["temperatureScale"]
-        self.device_mode = response.json()["traits"]["sdm.devices.traits.ThermostatMode"]["mode"]
+        traits = response.json()["traits"]
+        self.temperature_scale = traits["sdm.devices.traits.Settings"]["temperatureScale"]
+        self.device_mode = traits["sdm.devices.traits.ThermostatMode"]["mode"]
         # json returns either one of these values or none, but never both at the same time (for current use-case)
         try:
-            self.device_heat_temp = _Helper.from_c_to_fahrenheit(float(response.json()["traits"]["sdm.devices.traits.ThermostatTemperatureSetpoint"]["heatCelsius"]))
+            self.device_heat_temp = _Helper.from_c_to_fahrenheit(float(traits["sdm.devices.traits.ThermostatTemperatureSetpoint"]["heatCelsius"]))
         except KeyError:
             self.device_heat_temp = 0
         try:
-            self.device_cool_temp = _Helper.from_c_to_fahrenheit(float(response.json()["traits"]["sdm.devices.traits.ThermostatTemperatureSetpoint"]["coolCelsius"]))
+            self.device_cool_temp = _Helper.from_c_to_fahrenheit(float(traits["sdm.devices.traits.ThermostatTemperatureSetpoint"]["coolCelsius"]))
         except KeyError:
             self.device_cool_temp = 0
 
-# generates new token so that a call can be made to the API
-def __get_new_token():
+# keeps the thermostat data for a few seconds, so the reads of one command (mode, then temperature)
+# cost a single API call. Successful updates are written into the cached data, errors drop it.
+class _DeviceCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.device = None
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+
+    # cached thermostat data or None if there is none or it is too old
+    def get(self):
+        with self.lock:
+            if self.device is not None and time.monotonic() - self.fetched_at < self.ttl:
+                return self.device
+            return None
+
+    def set(self, device):
+        with self.lock:
+            self.device = device
+            self.fetched_at = time.monotonic()
+
+    # apply a change that was accepted by the API to the cached data
+    def update(self, mode=None, heat_temp=None, cool_temp=None):
+        with self.lock:
+            if self.device is None:
+                return
+            if mode is not None:
+                self.device.device_mode = mode
+            if heat_temp is not None:
+                self.device.device_heat_temp = heat_temp
+            if cool_temp is not None:
+                self.device.device_cool_temp = cool_temp
+
+    def invalidate(self):
+        with self.lock:
+            self.device = None
+
+_device_cache = _DeviceCache(_Helper.DEVICE_STATE_TTL)
+
+# keeps the access token until it expires and refreshes it in the background before it does,
+# so a thermostat command only asks for a new token when there is none yet (or it was rejected)
+class _TokenCache:
+    def __init__(self, request_token, warm_up):
+        # request_token() returns (token, expires_in) or an error
+        self.request_token = request_token
+        # warm_up() is called once with every new token
+        self.warm_up = warm_up
+        self.expires_at = 0
+        # reentrant: the warm-up call may invalidate the token it is warming up
+        self.lock = threading.RLock()
+        self.timer = None
+
+    def get(self):
+        """
+        Returns None if there is a valid token (in _Helper.ACCESS_TOKEN) or {ERROR or CONNECTION_ERROR}
+        """
+        # held while refreshing, so callers that find the token expired wait for one new token
+        with self.lock:
+            if _Helper.ACCESS_TOKEN is not None and time.monotonic() < self.expires_at:
+                return None
+            return self.__refresh()
+
+    # forget the token (e.g. the API rejected it), the next call gets a new one
+    def invalidate(self):
+        with self.lock:
+            _Helper.ACCESS_TOKEN = None
+            self.expires_at = 0
+
+    # gets a new token and warms it up, returns None on success or {ERROR or CONNECTION_ERROR}
+    def __refresh(self):
+        result = self.request_token()
+        if result in {_Helper.ERROR, _Helper.CONNECTION_ERROR}:
+            return result
+        token, expires_in = result
+        self.__swap(token, expires_in)
+        self.warm_up()
+        with self.lock:
+            # the warm-up call was rejected and invalidated the new token
+            if _Helper.ACCESS_TOKEN != token:
+                return _Helper.ERROR
+            self.__schedule(expires_in - _Helper.TOKEN_REFRESH_AHEAD)
+        return None
+
+    def __swap(self, token, expires_in):
+        with self.lock:
+            _Helper.ACCESS_TOKEN = token
+            self.expires_at = time.monotonic() + expires_in
+
+    def __schedule(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(max(delay, 1), self.__refresh_in_background)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def __refresh_in_background(self):
+        # not under the lock: the token requests run while other threads keep using the current token,
+        # on failure it is kept until it expires and get() tries again then
+        self.__refresh()
+
+# requests a new token using the refresh token, returns (token, expires_in) or {ERROR or CONNECTION_ERROR}
+def __request_token():
     # make a request to get a new token using a refresh token
     params = {
         'client_id': f'{CLIENT_ID}',
@@ -94,28 +212,45 @@ def __get_new_token():
     }
     
     try:
-        response = requests.post('https://www.googleapis.com/oauth2/v4/token', params=params)
+        response = _http.post('https://www.googleapis.com/oauth2/v4/token', params=params)
     except (requests.exceptions.Timeout, requests.exceptions.TooManyRedirects, requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
         return _Helper.CONNECTION_ERROR
         
-    if 'error' not in response.json():
-        _Helper.ACCESS_TOKEN = response.json()['access_token']
+    json_data = response.json()
+    if 'error' not in json_data and 'access_token' in json_data:
+        return json_data['access_token'], int(json_data.get('expires_in', _Helper.DEFAULT_TOKEN_LIFETIME))
     else:
         print("Error retrieving token")
         return _Helper.ERROR
-    
-    # call is required to complete authentication of new token (just need to make a call using get())
-    __get_device_info()
+
+# call is required to complete authentication of new token (just need to make a call using get())
+def __complete_authentication():
+    nest_data = __get_device_info()
+    # the response has the thermostat data, keep it so the next read does not ask again
+    try:
+        _device_cache.set(__Nest_Thermostat(nest_data))
+    except AttributeError:
+        pass
+
+_token_cache = _TokenCache(__request_token, __complete_authentication)
+
+# makes sure there is a valid token so that a call can be made to the API
+def __get_new_token():
+    return _token_cache.get()
 
 # makes API call to get thermostat data for device
 def __get_device_info():
     try:
-        response = requests.get(f'{_Helper.START_OF_API_CALL}{PROJECT_ID}/devices/{DEVICE_ID}', headers=_Helper.get_headers())
+        response = _http.get(f'{_Helper.START_OF_API_CALL}{PROJECT_ID}/devices/{DEVICE_ID}', headers=_Helper.get_headers())
     except (requests.exceptions.Timeout, requests.exceptions.TooManyRedirects, requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
         return _Helper.CONNECTION_ERROR
 
     if response.status_code !=200:
         print("Connecting to Nest Device Failed...")
+        _device_cache.invalidate()
+        # token was rejected, get a new one next time
+        if response.status_code == 401:
+            _token_cache.invalidate()
         return _Helper.ERROR
 
     return response
@@ -126,8 +261,18 @@ def __is_thermostat_off():
 
 # establish connection to NEST Api and return object with desired data    
 def __get_nest_data():
-    # re-new authentication
-    __get_new_token()
+    # use the data of the last call if it is recent enough
+    nest_device = _device_cache.get()
+    if nest_device is not None:
+        return nest_device
+    # make sure authentication is valid
+    status = __get_new_token()
+    if status is not None:
+        return status
+    # a new token fetches the thermostat data while completing authentication
+    nest_device = _device_cache.get()
+    if nest_device is not None:
+        return nest_device
     # get NEST data from API
     nest_data = __get_device_info()
     try:
@@ -136,6 +281,7 @@ def __get_nest_data():
     except AttributeError:
         return nest_data
     
+    _device_cache.set(nest_device)
     return nest_device
     
 # update thermostat mode (OFF, HEAT, COOL) or change temperature value
@@ -149,16 +295,30 @@ def __update_thermostat(value, command, internal_method = True):
             return _Helper.ERROR
     
     try:
-        response = requests.post(f'{_Helper.START_OF_API_CALL}{PROJECT_ID}/devices/{DEVICE_ID}:executeCommand', headers=_Helper.get_headers(), json=_Helper.get_params(value, command))
+        response = _http.post(f'{_Helper.START_OF_API_CALL}{PROJECT_ID}/devices/{DEVICE_ID}:executeCommand', headers=_Helper.get_headers(), json=_Helper.get_params(value, command))
     except (requests.exceptions.Timeout, requests.exceptions.TooManyRedirects, requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
+        _device_cache.invalidate()
         return _Helper.CONNECTION_ERROR
     
     if response.status_code != 200:
         print(f"Error changing thermostat to {command} and {value}")
+        _device_cache.invalidate()
+        if response.status_code == 401:
+            _token_cache.invalidate()
         return _Helper.ERROR
+    
+    # the thermostat now has the new value, keep the cached data in sync (write-through)
+    if command == _Helper.CHANGE_MODE_COMMAND:
+        _device_cache.update(mode=value)
+    elif command == _Helper.HEAT_COMMAND:
+        _device_cache.update(heat_temp=_Helper.from_c_to_fahrenheit(_Helper.from_f_to_celsuis(value)))
+    elif command == _Helper.COOL_COMMAND:
+        _device_cache.update(cool_temp=_Helper.from_c_to_fahrenheit(_Helper.from_f_to_celsuis(value)))
 
 def update_thermostat(value, command):
-    __get_new_token()
+    status = __get_new_token()
+    if status is not None:
+        return status
     return __update_thermostat(value, command, True)
    
 # get current temp of thermostat    
@@ -179,3 +339,11 @@ def get_current_temp_mode():
         return nest_device.device_mode
     except:
         return _Helper.ERROR
+
+# change how long thermostat data is reused before calling the API again
+def set_device_state_ttl(seconds):
+    _device_cache.ttl = seconds
+
+# get a token and the thermostat data before the first command needs them
+def prefetch():
+    return __get_new_token()
@@ -1,12 +1,13 @@
 import cv2
-from cvzone.HandTrackingModule import HandDetector
 import numpy as np
 import math
+import startup
 import text_to_speech
 import time
-from threading import Thread
-import spotify
-import nest
+
+# integrations are imported on first use (see startup.py)
+spotify = startup.lazy("spotify")
+nest = startup.lazy("nest")
 
 '''
 This program is able to detect a circular pattern made with the index finger along with the
@@ -17,30 +18,34 @@ an app or speaking. The use case for this pattern detector is for changing the t
 of a NEST thermostat and or the volume of a speaker when playing music.
 
 This is accomplished by following these steps:
-1. Detect if the right hand is present in a image/frame and find the position of the index finger.
+1. Detect if the right hand is present in the landmarks found by landmark_detection and find the 
+    position of the index finger (mirrored, so the path is drawn like in a mirror).
 2. Make sure index finger is on top on all other fingers (aka you are pointing with your right index finger).
-3. Follow the path of index finger by "drawing" the path on a window named "Pattern Canvas"
+3. Follow the path of index finger, every new point updates a least squares circle fit (Kasa method)
+    kept as running sums, so adding a point costs the same no matter how long the path is.
 4. If the path comes back near the starting point, it is assumed that this MIGHT be a circle,
-    therefore let cv2.HoughCircles() method determine if a circle was found.
+    therefore check the fitted circle: the points have to lie close to it (residual), the path
+    has to go around it (area enclosed by the path vs area of the circle) and be big enough.
+
+The path can also be drawn on a window named "Pattern Canvas" (debug only, not used for detection).
 
 Info: 
 Some logic was added to handle jerky motions.
 
 Limitations: 
-1. On occasion, it cannot recognize the pattern right away, but it usually works on the second revolution.
-2. Sometimes it deletes the pattern because it detects a jerk, probably due to processing speed. 
+1. Sometimes it deletes the pattern because it detects a jerk, probably due to processing speed. 
 
 '''
 
-def init():
-    return Helper()
+# draw: keep the path on a canvas for debugging
+def init(draw=True):
+    return PatternTracker(draw)
 
 class Helper:  
     # constants
     WHITE = (255, 255, 255)
     END_RADIUS = 40
     DRAW_THICKNESS = 8
-    IS_DRAW_OUT_OF_CIRCLE = False
     # max distance between coordinates
     MIN_POINTS = 30
     CLOCKWISE = "CLOCK-WISE"
@@ -50,115 +55,214 @@ class Helper:
     TIME_BETWEEN_COMMANDS = 2
     EMPTY = 0
     RIGHT_HAND = "Right"
-    HAND_DATA = "lmList"
     INCREMENT_SPOTIFY_VOLUME = 10
     INCREMENT_THERMOSTAT = 1
+    # circle fit: smallest radius (pixels), largest rms distance of the points to the circle
+    # (part of the radius) and smallest area enclosed by the path (part of the circle's area)
+    MIN_RADIUS = 25
+    MAX_FIT_ERROR = 0.2
+    MIN_COVERAGE = 0.6
     
-    # variables
-    last_x1, last_y1 = EMPTY_VALUE, EMPTY_VALUE
-    circle_points = []
     finger_color = WHITE
-    rotation_direction = EMPTY
-    last_command_time = EMPTY
+    # points of a path kept before it starts over (far more than a circle needs)
+    MAX_PATH_POINTS = 1024
+    CANVAS_SIZE = (500, 500)
     
     # voice replies
     THERMOSTAT_OFF_MESSAGE = "Thermostat is off, turn it on to change temperature"
     THERMOSTAT_ERROR_MESSAGE = "Issue connecting to nest device, try again later"
-    
-    def __init__(self):
-        # setting up hand detector
-        self.detector = HandDetector(maxHands=1, minTrackCon=0.75, detectionCon=0.75) 
-        # create canvas (window) for the gestures
-        self.canvas = np.zeros((500, 500), np.uint8)
-    
-    def clear_canvas(self):
-        self.canvas = np.zeros((500, 500), np.uint8)
+    # setpoints of the thermostat (fahrenheit), used to cache the temperature replies
+    MIN_TEMPERATURE, MAX_TEMPERATURE = 50, 90
     
     @staticmethod
     def create_message(mode, temperature):
         return f"Thermostat mode is currently set to {mode} and the temperature is {temperature} degrees"
+
+    # every reply of the pattern commands (cached by text to speech at startup)
+    @staticmethod
+    def voice_replies():
+        replies = [Helper.THERMOSTAT_OFF_MESSAGE, Helper.THERMOSTAT_ERROR_MESSAGE]
+        for mode in [nest._Helper.COOL, nest._Helper.HEAT]:
+            replies += [Helper.create_message(mode, temperature)
+                        for temperature in range(Helper.MIN_TEMPERATURE, Helper.MAX_TEMPERATURE + 1)]
+        return replies
     
-def run(img, program_data):   
-    # run on a different thread
-    thread = Thread(target = pattern_recognition, args =(img, program_data, ))
-    thread.start()
-    # wait until method is finished to proceed
-    thread.join()
+# least squares circle through the points of the path (Kasa method)
+# the fit only needs sums of x, y and x^2 + y^2 (and their products), kept in a 4x4 matrix,
+# so adding a point and fitting both take constant time
+class CircleFit:
+    def __init__(self):
+        # sum of v * v^T with v = (x^2 + y^2, x, y, 1)
+        self.moments = np.zeros((4, 4))
+        # points are stored relative to the first point (keeps the sums small)
+        self.origin = None
+        self.last = None
+        # twice the signed area enclosed by the path (shoelace formula), the path is closed
+        # back to the first point, which is (0, 0) so closing adds nothing
+        self.area = 0.0
+
+    def reset(self):
+        self.moments.fill(0)
+        self.origin = None
+        self.last = None
+        self.area = 0.0
+
+    def add(self, x, y):
+        if self.origin is None:
+            self.origin = (x, y)
+        x, y = x - self.origin[0], y - self.origin[1]
+        point = np.array((x * x + y * y, x, y, 1.0))
+        self.moments += np.outer(point, point)
+        if self.last is not None:
+            self.area += self.last[0] * y - x * self.last[1]
+        self.last = (x, y)
+
+    # returns (center x, center y, radius, error, coverage) or None if no circle fits the points
+    # error: rms distance of the points to the circle (part of the radius)
+    # coverage: area enclosed by the path (part of the circle's area)
+    def fit(self):
+        moments = self.moments
+        if moments[3, 3] < 3:
+            return None
+        # minimize sum((x^2 + y^2) + d*x + e*y + f)^2
+        try:
+            d, e, f = np.linalg.solve(moments[1:, 1:], -moments[1:, 0])
+        except np.linalg.LinAlgError:
+            # all points on a line
+            return None
+        center_x, center_y = -d / 2, -e / 2
+        radius_squared = center_x * center_x + center_y * center_y - f
+        if radius_squared <= 0:
+            return None
+
+        # (x^2 + y^2) + d*x + e*y + f = r^2 - R^2 ~ 2R * (r - R) for every point
+        residual = max(moments[0, 0] + moments[0, 1:] @ (d, e, f), 0.0)
+        error = math.sqrt(residual / moments[3, 3]) / (2 * radius_squared)
+        coverage = abs(self.area) / 2 / (math.pi * radius_squared)
+        return center_x + self.origin[0], center_y + self.origin[1], math.sqrt(radius_squared), error, coverage
+
+# state of one pattern tracker, every camera/hand can have its own
+class PatternTracker:
+    def __init__(self, draw=True):
+        # create canvas (window) for the gestures, only for debugging (None -> nothing is drawn)
+        self.canvas = np.zeros(Helper.CANVAS_SIZE, np.uint8) if draw else None
+        # called with the rotation direction when a circle is found
+        self.on_circle = api_call
+        # points of the path (no duplicates), only the first `count` rows are used
+        self.points = np.empty((Helper.MAX_PATH_POINTS, 2), np.int32)
+        self.count = 0
+        self.seen = set()
+        # circle fitted to the path
+        self.circle_fit = CircleFit()
+        self.last_x1, self.last_y1 = Helper.EMPTY_VALUE, Helper.EMPTY_VALUE
+        # sum of the cross products of consecutive points (+ clockwise, - counter-clockwise)
+        self.rotation_direction = Helper.EMPTY
+        # path has left the area around its starting point
+        self.is_draw_out_of_circle = False
+        self.last_command_time = Helper.EMPTY
+
+    # adds a point to the path, returns False if it was already in it
+    def add_point(self, x1, y1):
+        if (x1, y1) in self.seen:
+            return False
+        if self.count == Helper.MAX_PATH_POINTS:
+            # path is far too long to be a circle, start over from this point
+            last = self.last_x1, self.last_y1
+            self.reset()
+            self.last_x1, self.last_y1 = last
+        self.seen.add((x1, y1))
+        self.points[self.count] = x1, y1
+        self.count += 1
+        self.circle_fit.add(x1, y1)
+        return True
+
+    def clear_canvas(self):
+        if self.canvas is not None:
+            self.canvas.fill(0)
+
+    # clear the gesture path on window and reset variables (nothing is allocated)
+    def reset(self):
+        self.clear_canvas()
+        self.circle_fit.reset()
+        self.count = 0
+        self.seen.clear()
+        self.last_x1, self.last_y1 = Helper.EMPTY_VALUE, Helper.EMPTY_VALUE
+        self.is_draw_out_of_circle = False
+        self.rotation_direction = Helper.EMPTY
+
+def run(hand, program_data):   
+    pattern_recognition(hand, program_data)
 
 # returns the rotation direction (clockwise or counter-clockwise)
-def getRotationDirection():
-    if Helper.rotation_direction > 0:
+def getRotationDirection(program_data):
+    if program_data.rotation_direction > 0:
         return Helper.CLOCKWISE
-    elif Helper.rotation_direction < 0:
+    elif program_data.rotation_direction < 0:
         return Helper.COUNTER_CLOCKWISE
     else:
         return Helper.NO_ROTATION
 
 # determines if a circle pattern was drawn on "canvas"
-def pattern_recognition(img, program_data):
-    # flip the image so it is not invertered when "drawing" pattern
-    img = cv2.flip(img, 1)
-    # add hand skeleton to image to detect hand and differentiate between fingers
-    hands, img = program_data.detector.findHands(img, flipType=False) 
-
+def pattern_recognition(hand, program_data):
     # gesture works ONLY on right hand, as this is sufficient for project
-    if hands and hands[0]['type'] == Helper.RIGHT_HAND:
-        if is_gesture_detected(hands[0][Helper.HAND_DATA]):
-            # select index finger
-            index_finger = hands[0][Helper.HAND_DATA][8]
-            # find current position of index finger
-            index_finger_pos = index_finger[0:2]
+    if hand is not None and hand.handedness == Helper.RIGHT_HAND:
+        # mirror the landmarks so the path is not invertered when "drawing" pattern
+        landmark_positions = hand.to_pixels(mirror=True)
+        if is_gesture_detected(landmark_positions):
             # get the x and y coordinate of the index finger
-            x1, y1 = index_finger_pos[0:2]
+            x1, y1 = int(landmark_positions[8][0]), int(landmark_positions[8][1])
+            # find current position of index finger
+            index_finger_pos = (x1, y1)
             
             # draw a dot at the current index finger position
-            cv2.circle(program_data.canvas, index_finger_pos, Helper.DRAW_THICKNESS-5, Helper.finger_color, cv2.FILLED)
+            if program_data.canvas is not None:
+                cv2.circle(program_data.canvas, index_finger_pos, Helper.DRAW_THICKNESS-5, Helper.finger_color, cv2.FILLED)
 
             # initialize last coordinates if they have not been set yet
-            if Helper.last_x1 == Helper.EMPTY_VALUE and Helper.last_y1 == Helper.EMPTY_VALUE:
-                Helper.last_x1, Helper.last_y1 = x1, y1   
+            if program_data.last_x1 == Helper.EMPTY_VALUE and program_data.last_y1 == Helper.EMPTY_VALUE:
+                program_data.last_x1, program_data.last_y1 = x1, y1   
                         
             # make sure that the last point is near the current point to prevent jerky motion
-            if not abs(Helper.last_x1 - x1) > Helper.MIN_POINTS or not abs(Helper.last_y1 - y1) > Helper.MIN_POINTS:
+            if not abs(program_data.last_x1 - x1) > Helper.MIN_POINTS or not abs(program_data.last_y1 - y1) > Helper.MIN_POINTS:
                 # draw a line between last point to current point
-                cv2.line(program_data.canvas, (Helper.last_x1, Helper.last_y1), (x1, y1), Helper.finger_color, Helper.DRAW_THICKNESS)
+                if program_data.canvas is not None:
+                    cv2.line(program_data.canvas, (program_data.last_x1, program_data.last_y1), (x1, y1), Helper.finger_color, Helper.DRAW_THICKNESS)
 
                 # prevent duplicate points
-                if [x1, y1] not in Helper.circle_points:
-                    Helper.circle_points.append([x1, y1])
+                if program_data.add_point(x1, y1):
                     # find the cross product of the last and current coordinate, this is 
                     # used to determine the rotation (clockwise (+) vs counter-clockwise (-))
                     # and all these rotations are added to determine the actual rotation of pattern
-                    Helper.rotation_direction += ((Helper.last_x1 * y1) - (x1 * Helper.last_y1))
+                    program_data.rotation_direction += ((program_data.last_x1 * y1) - (x1 * program_data.last_y1))
                 
                 # set the last coordinates to be the new coordinate of the index finger
-                Helper.last_x1, Helper.last_y1 = x1, y1
+                program_data.last_x1, program_data.last_y1 = x1, y1
                 
                 # determine if current point is near starting point
-                dist = np.hypot(Helper.circle_points[0][0] - x1, Helper.circle_points[0][1] - y1)
+                dist = np.hypot(program_data.points[0, 0] - x1, program_data.points[0, 1] - y1)
                 
                 # checks if current point is near the starting point
                 # this is to make sure that we check if the pattern is a circle
                 # only if it going back around (much like a circle -> what is desired)
                 # also check if user actually went out of the starting point area
-                if dist**2 <= Helper.END_RADIUS**2 and Helper.IS_DRAW_OUT_OF_CIRCLE:
+                if dist**2 <= Helper.END_RADIUS**2 and program_data.is_draw_out_of_circle:
                     if is_circle_found(program_data):
                         # circle pattern was detected, ensure that there is 
                         # a delay between current and next command 
-                        if time.time() - Helper.last_command_time > Helper.TIME_BETWEEN_COMMANDS:
-                            Helper.IS_DRAW_OUT_OF_CIRCLE = False
-                            api_call(getRotationDirection())
+                        if time.time() - program_data.last_command_time > Helper.TIME_BETWEEN_COMMANDS:
+                            program_data.is_draw_out_of_circle = False
+                            program_data.on_circle(getRotationDirection(program_data))
                             # reset canvas since a circle was detected
                             reset_pattern(program_data)
-                            Helper.last_command_time = time.time()
+                            program_data.last_command_time = time.time()
                     else:
                         # circle not found
                         return
                 elif dist**2 >= Helper.END_RADIUS**2:
                     # pattern draw is now out of starting circle
-                    # IS_DRAW_OUT_OF_CIRCLE makes sure the "gesture" leaves the starting point
-                    if not Helper.IS_DRAW_OUT_OF_CIRCLE:
-                        Helper.IS_DRAW_OUT_OF_CIRCLE = True
+                    # is_draw_out_of_circle makes sure the "gesture" leaves the starting point
+                    if not program_data.is_draw_out_of_circle:
+                        program_data.is_draw_out_of_circle = True
             else:
                 # jerky motion detected (distance between last and current point is not within 
                 # threshold), therefore clearing drawing and allowing user to restart drawing pattern
@@ -181,81 +285,75 @@ def is_gesture_detected(fingertip_positions):
 
 # returns true if gesture path was similar to a circle, false otherwise
 def is_circle_found(program_data):
-    # make sure that the canvas is not null and there is at least one point drawn
-    if program_data.canvas is None and len(Helper.circle_points) > Helper.EMPTY:
+    circle = program_data.circle_fit.fit()
+    if circle is None:
         return False
 
-    try:
-        # see if there is a circle found in canvas (the pattern drawn)
-        circles = cv2.HoughCircles(program_data.canvas, cv2.HOUGH_GRADIENT, 
-                                   1, 20, param1=30, param2=20, minRadius=0, maxRadius=0)          
-    except:
-        return False
-    
-    # if a circle was not found, return false
-    if circles is None or len(circles) == 0:
-        return False
-    
-    # else, return true since circles is not empty, indicating a circle pattern was found
-    return True
+    _, _, radius, error, coverage = circle
+    return radius >= Helper.MIN_RADIUS and error <= Helper.MAX_FIT_ERROR and coverage >= Helper.MIN_COVERAGE
     
 # clear the gesture path on window and reset variables
 def reset_pattern(program_data):
-    program_data.clear_canvas()
-    Helper.last_x1, Helper.last_y1 = Helper.EMPTY_VALUE, Helper.EMPTY_VALUE
-    Helper.circle_points = []
-    Helper.IS_DRAW_OUT_OF_CIRCLE = False
-    Helper.rotation_direction = Helper.EMPTY
+    program_data.reset()
     
 # determine which api to call in order to execute pattern gesture
 def api_call(rotation_direction):
-    is_increasing = True
-    if rotation_direction == Helper.COUNTER_CLOCKWISE:
-        is_increasing = False
+    if not spotify_pattern_command(rotation_direction):
+        nest_pattern_command(rotation_direction)
+
+# spotify part of the pattern gesture (only calls spotify, so it can run on the spotify lane)
+# returns True if spotify was playing and its volume was changed, False if the thermostat should change
+def spotify_pattern_command(rotation_direction):
+    is_increasing = rotation_direction != Helper.COUNTER_CLOCKWISE
 
     # check if raspberry pi device is playing a song
     response = spotify.is_playing()
     
     # check if there was an error retrieving is_playing state of raspberry pi
     if response in [spotify._SpotifyConstants.ERROR, spotify._SpotifyConstants.CONNECTION_ERROR]:
-        response = False
+        return False
         
     # if spotify is playing, increment/decrement the volume depending on pattern rotation
-    if response:
-        new_volume = Helper.INCREMENT_SPOTIFY_VOLUME * (1 if is_increasing else -1)
-        spotify.change_volume(new_volume)
-        print(f"Spotify: Volume Increment -> {new_volume}")
-    else:
-        # change thermostat temperature if device is ON
-        current_temp_mode = nest.get_current_temp_mode()
-         # change thermostat temperature if device is ON and is set to either "HEAT" or "COOL"
-        if current_temp_mode in [nest._Helper.COOL, nest._Helper.HEAT]:
-            # get the command to change thermostat based on current thermostat mode
-            current_mode = nest._Helper.COOL_COMMAND if current_temp_mode == nest._Helper.COOL else nest._Helper.HEAT_COMMAND
-            # get current temperature
-            current_temp = nest.get_current_temp()
-            
-            # check if there was an error getting current temperature
-            # usually occurs when making too many calls to Nest API
-            if current_temp == nest._Helper.ERROR:
-                print("Error retrieving current temp, might be due to too many API calls")
-                return
+    if not response:
+        return False
+    new_volume = Helper.INCREMENT_SPOTIFY_VOLUME * (1 if is_increasing else -1)
+    spotify.change_volume(new_volume)
+    print(f"Spotify: Volume Increment -> {new_volume}")
+    return True
+
+# nest part of the pattern gesture (only calls nest, so it can run on the nest lane)
+def nest_pattern_command(rotation_direction):
+    is_increasing = rotation_direction != Helper.COUNTER_CLOCKWISE
+    # change thermostat temperature if device is ON
+    current_temp_mode = nest.get_current_temp_mode()
+     # change thermostat temperature if device is ON and is set to either "HEAT" or "COOL"
+    if current_temp_mode in [nest._Helper.COOL, nest._Helper.HEAT]:
+        # get the command to change thermostat based on current thermostat mode
+        current_mode = nest._Helper.COOL_COMMAND if current_temp_mode == nest._Helper.COOL else nest._Helper.HEAT_COMMAND
+        # get current temperature
+        current_temp = nest.get_current_temp()
+        
+        # check if there was an error getting current temperature
+        # usually occurs when making too many calls to Nest API
+        if current_temp == nest._Helper.ERROR:
+            print("Error retrieving current temp, might be due to too many API calls")
+            return
+        
+        # new temperature
+        if is_increasing:
+            new_temp = math.ceil(current_temp) + Helper.INCREMENT_THERMOSTAT
+        else:
+            new_temp = math.ceil(current_temp) + Helper.INCREMENT_THERMOSTAT * -1
             
-            # new temperature
-            if is_increasing:
-                new_temp = math.ceil(current_temp) + Helper.INCREMENT_THERMOSTAT
-            else:
-                new_temp = math.ceil(current_temp) + Helper.INCREMENT_THERMOSTAT * -1
-                
-            # change temperature (+1 or -1) based on pattern rotation
-            response = nest.update_thermostat(new_temp, current_mode)
-            # if there was an error, notify user
-            if response in [nest._Helper.ERROR, nest._Helper.CONNECTION_ERROR]:
-                text_to_speech.run(Helper.THERMOSTAT_ERROR_MESSAGE)
-            else:
-                # temperature updated, notify
-                text_to_speech.run(Helper.create_message(current_temp_mode, new_temp))
-                print(f"New Temp -> {new_temp}")
+        # change temperature (+1 or -1) based on pattern rotation
+        response = nest.update_thermostat(new_temp, current_mode)
+        # if there was an error, notify user
+        if response in [nest._Helper.ERROR, nest._Helper.CONNECTION_ERROR]:
+            text_to_speech.run(Helper.THERMOSTAT_ERROR_MESSAGE, text_to_speech.Helper.PRIORITY_ERROR)
         else:
-            # thermostat device is off, notify user
-            text_to_speech.run(Helper.THERMOSTAT_OFF_MESSAGE)
\ No newline at end of file
+            # temperature updated, notify
+            text_to_speech.run(Helper.create_message(current_temp_mode, new_temp))
+            print(f"New Temp -> {new_temp}")
+    else:
+        # thermostat device is off, notify user
+        text_to_speech.run(Helper.THERMOSTAT_OFF_MESSAGE)
\ No newline at end of file
@@ -0,0 +1,248 @@
+import concurrent.futures
+import queue
+import threading
+import time
+
+import camera_capture
+import gesture_detection
+import landmark_detection
+import landmark_recording
+import pattern_detection
+
+'''
+Long-lived frame pipeline.
+
+    capture -> landmark inference -> gesture classification -> pattern tracking -> display
+
+Every stage runs on its own thread for the whole life of the program and stages are connected
+by bounded queues, so frame N+1 is being inferred while frame N is classified and frame N-1 is
+tracked. When a later stage falls behind the queues fill up, the inference stage waits and the
+capture stage keeps only the newest frame (see camera_capture).
+
+With an idle monitor (see idle_detection) the inference stage stops running the model when
+nobody is in front of the camera: frames are then only checked for motion a few times a second
+and sent on without a hand, so the display keeps updating at the reduced rate.
+
+The display stage is not a thread: cv2.imshow() has to run on the main thread, so the main
+loop takes finished packets with get() and gives them back with done().
+'''
+
+
+class Helper:
+    QUEUE_SIZE = 2
+    GET_TIMEOUT = 0.1
+    # frames held at once: one in each queue slot, one in each of the 4 stages,
+    # plus the frame waiting to be read and the frame being written by the camera
+    STAGES = 4
+    SPARE_BUFFERS = 2
+    INFERENCE, CLASSIFICATION, PATTERN, DISPLAY = "inference", "classification", "pattern", "display"
+
+
+# data of one frame travelling through the pipeline
+class Packet:
+    def __init__(self, frame):
+        self.frame = frame
+        self.hand = None
+        self.gesture = None
+        # confidence of every class (see gesture_detection.CLASSES)
+        self.confidences = None
+        # copy of the pattern canvas after this frame (None if it is not drawn), the pattern
+        # stage keeps drawing on the canvas while the display shows the copy
+        self.canvas = None
+
+
+class Pipeline:
+    def __init__(self, source, landmark_data, pattern_data, on_gesture, queue_size=Helper.QUEUE_SIZE, record_path=None,
+                 use_roi=True, inference_width=landmark_detection.Helper.INFERENCE_WIDTHS[0], adaptive=True,
+                 idle_monitor=None, classifier_data=None, record_label=None):
+        """
+        :param source: camera index or video file
+        :param landmark_data: model returned by landmark_detection.init(), or a Future of it (still loading)
+        :param pattern_data: tracker returned by pattern_detection.init()
+        :param on_gesture: called from the classification stage with the gesture (or None), timestamp and class
+                           confidences of each frame
+        :param queue_size: max packets waiting between two stages
+        :param record_path: if set, landmarks and gestures of every frame are recorded to this file
+        :param use_roi: run the landmark model on a crop around the last hand (see landmark_detection.HandTracker)
+        :param inference_width: longest side of the image given to the landmark model
+        :param adaptive: lower/raise inference_width with the measured inference latency
+        :param idle_monitor: idle_detection.IdleMonitor, None runs the model on every frame
+        :param classifier_data: gesture classifier returned by gesture_detection.init(), None -> hand written rules
+        :param record_label: gesture the user makes during the recording, "none" for no gesture, None if unlabelled
+                             (ground truth for training, see landmark_recording.py)
+        """
+        buffers = 3 * queue_size + Helper.STAGES + Helper.SPARE_BUFFERS
+        self.capture = camera_capture.CameraCapture(source, buffers)
+        self.landmark_data = landmark_data
+        self.tracker = landmark_detection.HandTracker(landmark_data, use_roi, inference_width, adaptive)
+        self.idle_monitor = idle_monitor
+        self.pattern_data = pattern_data
+        self.classifier_data = classifier_data
+        self.on_gesture = on_gesture
+        self.queues = {
+            Helper.CLASSIFICATION: queue.Queue(queue_size),
+            Helper.PATTERN: queue.Queue(queue_size),
+            Helper.DISPLAY: queue.Queue(queue_size),
+        }
+        self.processed = {Helper.INFERENCE: 0, Helper.CLASSIFICATION: 0, Helper.PATTERN: 0, Helper.DISPLAY: 0}
+        # frames a stage failed on (they are dropped)
+        self.failed = {Helper.INFERENCE: 0, Helper.CLASSIFICATION: 0, Helper.PATTERN: 0}
+        self.stop_event = threading.Event()
+        # packets between the inference stage and done(), the pipeline runs until the last frame of a
+        # file went through every stage
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+        self.threads = []
+        self.start_time = None
+        self.record_path = record_path
+        self.record_label = record_label
+        self.recorder = None
+
+    @property
+    def running(self):
+        if self.stop_event.is_set() or not self.threads:
+            return False
+        inference, *stages = self.threads
+        # a stage thread that ended would leave the video frozen
+        if not all(thread.is_alive() for thread in stages):
+            return False
+        return self.capture.running or inference.is_alive() or self.in_flight > 0
+
+    def start(self):
+        self.capture.start()
+        if self.record_path is not None:
+            height, width = self.capture.buffers[0].shape[:2]
+            self.recorder = landmark_recording.LandmarkRecorder(self.record_path, width, height, label=self.record_label)
+        self.start_time = time.monotonic()
+        self.threads = [
+            threading.Thread(target=self.__inference_stage, daemon=True),
+            threading.Thread(target=self.__stage, args=(Helper.CLASSIFICATION, self.__classify, Helper.PATTERN), daemon=True),
+            threading.Thread(target=self.__stage, args=(Helper.PATTERN, self.__track_pattern, Helper.DISPLAY), daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        # give back the frames that were still in flight
+        for stage_queue in self.queues.values():
+            while not stage_queue.empty():
+                self.__release(stage_queue.get_nowait())
+        self.capture.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    # next finished packet for the display stage (main thread), None if nothing is ready yet
+    def get(self, timeout=Helper.GET_TIMEOUT):
+        try:
+            return self.queues[Helper.DISPLAY].get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    # display is done with the packet, frame buffer can be reused
+    def done(self, packet):
+        self.processed[Helper.DISPLAY] += 1
+        self.__release(packet)
+
+    # number of packets waiting in front of each stage
+    def queue_depths(self):
+        return {stage: stage_queue.qsize() for stage, stage_queue in self.queues.items()}
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.start_time, 1e-9) if self.start_time else 1e-9
+        return {
+            "fps": round(self.processed[Helper.DISPLAY] / elapsed, 1),
+            "queue_depths": self.queue_depths(),
+            "processed": dict(self.processed),
+            "failed": dict(self.failed),
+            "frames": self.capture.stats(),
+            "inference": self.tracker.stats(),
+            "idle": self.idle_monitor.stats(time.monotonic()) if self.idle_monitor is not None else None,
+        }
+
+    # put a packet in the queue of the next stage, waiting while it is full
+    def __put(self, stage, packet):
+        while not self.stop_event.is_set():
+            try:
+                self.queues[stage].put(packet, timeout=Helper.GET_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        self.__release(packet)
+        return False
+
+    def __inference_stage(self):
+        # the model may still be loading in the background (see startup.py)
+        if isinstance(self.landmark_data, concurrent.futures.Future):
+            try:
+                self.landmark_data = self.tracker.hands = self.landmark_data.result()
+            except Exception as error:
+                print(f"Landmark model could not be loaded: {error}")
+                self.stop_event.set()
+                return
+        while not self.stop_event.is_set():
+            frame = self.capture.read(Helper.GET_TIMEOUT)
+            if frame is None:
+                if not self.capture.running:
+                    break
+                continue
+            packet = Packet(frame)
+            with self.in_flight_lock:
+                self.in_flight += 1
+            try:
+                infer = self.idle_monitor is None or self.idle_monitor.should_infer(frame.image, frame.timestamp)
+                if infer:
+                    packet.hand = self.tracker.run(frame.image)
+                    if self.idle_monitor is not None:
+                        self.idle_monitor.update(packet.hand is not None, frame.timestamp)
+            except Exception as error:
+                self.__fail(Helper.INFERENCE, packet, error)
+                continue
+            if not infer:
+                # idle (should_infer is always True while active): nothing moved, only look at
+                # the camera again after the idle interval
+                self.__put(Helper.CLASSIFICATION, packet)
+                self.stop_event.wait(self.idle_monitor.wait_time(time.monotonic()))
+                continue
+            self.processed[Helper.INFERENCE] += 1
+            self.__put(Helper.CLASSIFICATION, packet)
+
+    def __stage(self, name, work, next_stage):
+        while not self.stop_event.is_set():
+            try:
+                packet = self.queues[name].get(timeout=Helper.GET_TIMEOUT)
+            except queue.Empty:
+                continue
+            try:
+                work(packet)
+            except Exception as error:
+                self.__fail(name, packet, error)
+                continue
+            self.processed[name] += 1
+            self.__put(next_stage, packet)
+
+    # one broken frame must not stop the stage, the frame is dropped and its buffer given back
+    def __fail(self, name, packet, error):
+        self.failed[name] += 1
+        print(f"Pipeline {name} failed: {error}")
+        self.__release(packet)
+
+    # the packet left the pipeline, its frame buffer can be reused
+    def __release(self, packet):
+        with self.in_flight_lock:
+            self.in_flight -= 1
+        self.capture.release(packet.frame)
+
+    def __classify(self, packet):
+        packet.gesture, packet.confidences = gesture_detection.classify(packet.hand, self.classifier_data)
+        if self.recorder is not None:
+            self.recorder.write(packet.frame.timestamp, packet.hand, packet.gesture)
+        self.on_gesture(packet.gesture, packet.frame.timestamp, packet.confidences)
+
+    def __track_pattern(self, packet):
+        pattern_detection.run(packet.hand, self.pattern_data)
+        if self.pattern_data.canvas is not None:
+            packet.canvas = self.pattern_data.canvas.copy()
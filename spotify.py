@@ -1,6 +1,7 @@
 from datetime import datetime, timedelta
+import threading
 from spotify_secrets import DEVICE_ID, CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN
-import requests
+import http_session
 
 # Methods (available to use):
 # RETURN VALUES
@@ -26,6 +27,17 @@ import requests
 # paramter: increment - signed int {change volume by the increment value}
 # change_volume(increment):
 
+# get a token and the player state ahead of the first command, e.g. at startup
+# prefetch()
+
+# Player state (playing, active device, volume) is kept locally: our own commands update it
+# right away and it is only read from the API again when it is older than PLAYER_STATE_TTL
+# (a few seconds) or after an error. So back-to-back steps of the volume knob cost one API call
+# each, and the first step after a pause reads the state (maybe changed on another device) again.
+
+# Pooled connections shared by every call to the Spotify API
+_http = http_session.client("spotify")
+
 class _Helper:
     # Token info storage
     access_token = None
@@ -64,6 +76,17 @@ class _Helper:
             'device_id' : f'{DEVICE_ID}',
         }
         
+# Last known state of the player
+class _PlayerState:
+    is_playing = None
+    # raspberry pi is the active device
+    device_active = None
+    volume = None
+    # last time the state was read from the API (None -> unknown)
+    updated = None
+    # calls from different threads update the state
+    lock = threading.RLock()
+
 class _SpotifyConstants:
     # URL endpoint for API calls
     TOKEN_ENDPOINT = "https://accounts.spotify.com/api/token"
@@ -75,6 +98,11 @@ class _SpotifyConstants:
     SKIP_TO_PREVIOUS_ENDPOINT = f"{DEFAULT_URL}/previous?{DEVICE_ID}"
     VOLUME_ENDPOINT = f"{DEFAULT_URL}/volume?{DEVICE_ID}"
 
+    # Seconds the player state is trusted before reading it from the API again: long enough for the
+    # steps of one knob gesture, short enough to notice a pause or volume change made on a phone
+    PLAYER_STATE_TTL = timedelta(seconds=3)
+    MIN_VOLUME, MAX_VOLUME = 0, 100
+
     # Standard return values
     # For status codes other than 200 and 201
     ERROR = 'ERROR' 
@@ -100,7 +128,7 @@ def __refresh_token(bypass_check=False):
 
     # Make API call
     try:
-        response = requests.post(_SpotifyConstants.TOKEN_ENDPOINT, headers=headers, data=payload)
+        response = _http.post(_SpotifyConstants.TOKEN_ENDPOINT, headers=headers, data=payload)
     except:
         return _SpotifyConstants.CONNECTION_ERROR
     
@@ -116,55 +144,84 @@ def __refresh_token(bypass_check=False):
     else:
         None
 
-# Start Playback (private)
-def __start_playback():
+# Forget the player state, it is read from the API next time (private)
+def __invalidate_player_state():
+    with _PlayerState.lock:
+        _PlayerState.updated = None
+
+# Player state is known and recent (private)
+def __is_player_state_fresh():
+    return _PlayerState.updated is not None and datetime.now() - _PlayerState.updated < _SpotifyConstants.PLAYER_STATE_TTL
+
+# Read playing status, active device and volume from the API in one call (private)
+def __refresh_player_state():
     # Check token
     __refresh_token()
 
     # Generate aspects of API call
     headers = _Helper.get_headers()
     
-    # set device to be active if it is not via API call
-    set_active_device = __get_device_info()
-    if set_active_device:
-        error_status = __set_active_device()
-        if error_status in [_SpotifyConstants.ERROR, _SpotifyConstants.CONNECTION_ERROR]:
-            return error_status
-    
     # Make API call
     try:
-        response = requests.put(_SpotifyConstants.START_PLAYBACK_ENDPOINT, headers=headers, data={})
+        response = _http.get(f'{_SpotifyConstants.DEFAULT_URL}', headers=headers)
     except:
+        __invalidate_player_state()
         return _SpotifyConstants.CONNECTION_ERROR
     
-    # Check API response
-    if (response.status_code == 202):
-        return _SpotifyConstants.SUCCESS
-    else:
-        return _SpotifyConstants.ERROR
+    with _PlayerState.lock:
+        # nothing is playing on any device
+        if (response.status_code == 204):
+            _PlayerState.is_playing, _PlayerState.device_active = False, False
+        elif (response.status_code == 200):
+            json_data = response.json()
+            device = json_data.get('device') or {}
+            _PlayerState.is_playing = json_data['is_playing']
+            _PlayerState.device_active = device.get('id') == DEVICE_ID and device.get('is_active', False)
+            if device.get('id') == DEVICE_ID:
+                _PlayerState.volume = device.get('volume_percent')
+        else:
+            _PlayerState.updated = None
+            return _SpotifyConstants.ERROR
+        _PlayerState.updated = datetime.now()
+    return _SpotifyConstants.SUCCESS
 
-# Pause Playback (private)
-def __pause_playback():
+# Start Playback (private)
+def __start_playback():
     # Check token
     __refresh_token()
 
     # Generate aspects of API call
     headers = _Helper.get_headers()
     
+    # set device to be active if it is not via API call (only asked if not known)
+    if not (__is_player_state_fresh() and _PlayerState.device_active):
+        device_info = __get_device_info()
+        if device_info in [_SpotifyConstants.ERROR, _SpotifyConstants.CONNECTION_ERROR]:
+            return device_info
+        set_active_device, _ = device_info
+        if set_active_device:
+            error_status = __set_active_device()
+            if error_status in [_SpotifyConstants.ERROR, _SpotifyConstants.CONNECTION_ERROR]:
+                return error_status
+    
     # Make API call
     try:
-        response = requests.put(_SpotifyConstants.PAUSE_PLAYBACK_ENDPOINT , headers=headers, data={})
+        response = _http.put(_SpotifyConstants.START_PLAYBACK_ENDPOINT, headers=headers, data={})
     except:
+        __invalidate_player_state()
         return _SpotifyConstants.CONNECTION_ERROR
- 
+    
     # Check API response
     if (response.status_code == 202):
+        with _PlayerState.lock:
+            _PlayerState.is_playing, _PlayerState.device_active = True, True
         return _SpotifyConstants.SUCCESS
     else:
+        __invalidate_player_state()
         return _SpotifyConstants.ERROR
 
-# Skip Playback (private)
-def __skip_playback():
+# Send a playback command (pause, next, previous) and update the player state (private)
+def __playback_command(send, endpoint, is_playing):
     # Check token
     __refresh_token()
 
@@ -173,56 +230,42 @@ def __skip_playback():
     
     # Make API call
     try:
-        response = requests.post(_SpotifyConstants.SKIP_TO_NEXT_ENDPOINT, headers=headers, data={})
+        response = send(endpoint, headers=headers, data={})
     except:
+        __invalidate_player_state()
         return _SpotifyConstants.CONNECTION_ERROR
-    
+ 
     # Check API response
     if (response.status_code == 202):
+        with _PlayerState.lock:
+            _PlayerState.is_playing = is_playing
         return _SpotifyConstants.SUCCESS
     else:
+        __invalidate_player_state()
         return _SpotifyConstants.ERROR
 
+# Pause Playback (private)
+def __pause_playback():
+    return __playback_command(_http.put, _SpotifyConstants.PAUSE_PLAYBACK_ENDPOINT, False)
+
+# Skip Playback (private)
+def __skip_playback():
+    return __playback_command(_http.post, _SpotifyConstants.SKIP_TO_NEXT_ENDPOINT, True)
+
 # Previous Playback (private)
 def __previous_playback():
-    # Check token
-    __refresh_token()
-
-    # Generate aspects of API call
-    headers = _Helper.get_headers()
-    
-    # Make API call
-    try:
-        response = requests.post(_SpotifyConstants.SKIP_TO_PREVIOUS_ENDPOINT, headers=headers, data={})
-    except:
-        return _SpotifyConstants.CONNECTION_ERROR
-    
-    # Check API response
-    if (response.status_code == 202):
-        return _SpotifyConstants.SUCCESS
-    else:
-        return _SpotifyConstants.ERROR
+    return __playback_command(_http.post, _SpotifyConstants.SKIP_TO_PREVIOUS_ENDPOINT, True)
     
 # return playing status of device
 def __is_playing():
-     # Check token
-    __refresh_token()
-
-    # Generate aspects of API call
-    headers = _Helper.get_headers()
-    
-    # Make API call
-    try:
-        response = requests.get(f'{_SpotifyConstants.DEFAULT_URL}', headers=headers)
-    except:
-        return _SpotifyConstants.CONNECTION_ERROR
-    
-    if (response.status_code == 200):   
-        return response.json()['is_playing']
-    else:
-        return _SpotifyConstants.ERROR
+    # only ask the API if the state is not known or too old
+    if not __is_player_state_fresh():
+        status = __refresh_player_state()
+        if status != _SpotifyConstants.SUCCESS:
+            return status
+    return _PlayerState.is_playing
     
-# return state of is_playing something
+# change the volume by an increment (volume stays between 0 and 100)
 def __change_volume(change_volume_by):
      # Check token
     __refresh_token()
@@ -230,18 +273,39 @@ def __change_volume(change_volume_by):
     # Generate aspects of API call
     headers = _Helper.get_headers()
     
-    _ , current_volume = __get_device_info()
-    current_volume += change_volume_by
+    with _PlayerState.lock:
+        # current volume is only asked if it is not known
+        if not __is_player_state_fresh() or _PlayerState.volume is None:
+            status = __refresh_player_state()
+            if status != _SpotifyConstants.SUCCESS:
+                return status
+            if _PlayerState.volume is None:
+                device_info = __get_device_info()
+                if device_info in [_SpotifyConstants.ERROR, _SpotifyConstants.CONNECTION_ERROR]:
+                    return device_info
+                _, _PlayerState.volume = device_info
+                if _PlayerState.volume is None:
+                    return _SpotifyConstants.ERROR
+        
+        current_volume = min(max(_PlayerState.volume + change_volume_by, _SpotifyConstants.MIN_VOLUME), _SpotifyConstants.MAX_VOLUME)
+        # already at the lowest/highest volume
+        if current_volume == _PlayerState.volume:
+            return _SpotifyConstants.SUCCESS
+        # optimistic update, the next step builds on this volume without asking the API
+        _PlayerState.volume = current_volume
     
     # Make API call
     try:
-        response = requests.put(f'{_SpotifyConstants.VOLUME_ENDPOINT}', headers=headers, params=_Helper.set_volume_json(current_volume))
+        response = _http.put(f'{_SpotifyConstants.VOLUME_ENDPOINT}', headers=headers, params=_Helper.set_volume_json(current_volume))
     except:
+        __invalidate_player_state()
         return _SpotifyConstants.CONNECTION_ERROR
     
     if (response.status_code == 204):   
         return _SpotifyConstants.SUCCESS
     else:
+        # volume is unknown again, read it from the API next time
+        __invalidate_player_state()
         return _SpotifyConstants.ERROR
 
 # returns "is_active" state and "volume_percent" of raspberry pi device (private)
@@ -254,20 +318,17 @@ def __get_device_info():
     
     # Make API call
     try:
-        response = requests.get(f'{_SpotifyConstants.DEVICES_ENDPOINT}', headers=headers)
+        response = _http.get(f'{_SpotifyConstants.DEVICES_ENDPOINT}', headers=headers)
     except:
         return _SpotifyConstants.CONNECTION_ERROR
     
-    transfer_playback = False
     if (response.status_code == 200): 
         for device in response.json()['devices']:
             # raspberry pi found
             if device['id'] == DEVICE_ID:
-                if not device['is_active']:
-                    transfer_playback = True
-                break
-            
-        return transfer_playback, device['volume_percent']
+                return not device['is_active'], device['volume_percent']
+        # raspberry pi is not listed, it has to be made the active device
+        return True, None
     else:
         return _SpotifyConstants.ERROR
     
@@ -281,12 +342,14 @@ def __set_active_device():
     
     # Make API call
     try:
-        response = requests.put(_SpotifyConstants.DEFAULT_URL, headers=headers, json=_Helper.get_device_json())
+        response = _http.put(_SpotifyConstants.DEFAULT_URL, headers=headers, json=_Helper.get_device_json())
     except:
         return _SpotifyConstants.CONNECTION_ERROR
     
     # Check API response
     if (response.status_code == 202):
+        with _PlayerState.lock:
+            _PlayerState.device_active = True
         return _SpotifyConstants.SUCCESS
     else:
         return _SpotifyConstants.ERROR
@@ -314,3 +377,10 @@ def is_playing():
 # Change playback volume by a certain increment (public)   
 def change_volume(change_volume_by):
     return __change_volume(change_volume_by)
+
+# Get a token and the player state before the first command needs them (public)
+def prefetch():
+    status = __refresh_token()
+    if status != _SpotifyConstants.SUCCESS:
+        return _SpotifyConstants.ERROR if status is None else status
+    return __refresh_player_state()
@@ -0,0 +1,97 @@
+import concurrent.futures
+import importlib
+import threading
+import time
+
+'''
+Fast startup.
+
+Modules that are slow to import (the integrations pull in requests, gTTS and their secrets) are
+imported on first use through lazy():
+
+    nest = startup.lazy("nest")     # nothing is imported yet
+    nest.get_current_temp()         # imported here
+
+Slow first calls (loading the hand model, fetching API tokens) run on background threads with
+background() while the camera opens, so the first frames and the first gesture do not pay for
+them.
+
+Every step is recorded on a timeline (seconds since this module was imported) and report()
+prints it:
+
+    Startup -> imports 0.41s, camera_open 0.93s, model_ready 1.20s, first_actionable_frame 1.24s, import_nest 1.31s, ...
+'''
+
+
+class Helper:
+    # background startup tasks run at the same time
+    WORKERS = 4
+
+
+# seconds since the program started, one entry per milestone
+class Timeline:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.milestones = {}
+        self.lock = threading.Lock()
+
+    # record a milestone (only the first time it is reached)
+    def mark(self, name):
+        with self.lock:
+            if name not in self.milestones:
+                self.milestones[name] = time.monotonic() - self.start
+
+    def reached(self, name):
+        return name in self.milestones
+
+    def report(self):
+        with self.lock:
+            milestones = sorted(self.milestones.items(), key=lambda milestone: milestone[1])
+        return ", ".join(f"{name} {seconds:.2f}s" for name, seconds in milestones)
+
+
+timeline = Timeline()
+_executor = concurrent.futures.ThreadPoolExecutor(Helper.WORKERS, thread_name_prefix="startup")
+
+
+# module imported on first attribute access
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    # only called for attributes that are not on the proxy itself
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = load(self._name)
+        return getattr(self._module, attribute)
+
+
+def lazy(name):
+    return LazyModule(name)
+
+
+# import a module now, the time its import finished is on the timeline
+def load(name):
+    module = importlib.import_module(name)
+    timeline.mark(f"import_{name}")
+    return module
+
+
+def background(name, function, *args):
+    """
+    Runs a startup task on a background thread
+    :param name: milestone recorded when the task is done ("<name>_failed" if it raised)
+    :param function: called with args
+    :return: concurrent.futures.Future with the result of the task
+    """
+    def run():
+        try:
+            result = function(*args)
+        except Exception as error:
+            timeline.mark(f"{name}_failed")
+            print(f"Startup: {name} failed: {error}")
+            raise
+        timeline.mark(name)
+        return result
+    return _executor.submit(run)
@@ -0,0 +1,254 @@
+import collections
+import threading
+import time
+
+import camera_capture
+import gesture_detection
+import idle_detection
+import landmark_detection
+import pattern_detection
+
+'''
+Several cameras (rooms) in one process.
+
+Every stream has its own capture, landmark tracker (crop around the last hand), idle monitor,
+pattern tracker and gesture callback (debouncing and combos, see GestureSession), so nothing
+one room does changes what happens in another.
+
+The hand model is the expensive part, so it is not created per stream: a fixed pool of model
+workers (each with its own model) serves all streams. Workers take the streams in round-robin
+order, skipping streams without a new frame, and a stream never has more than one frame being
+processed, so its frames are handled in order and a busy room can not starve a quiet one.
+Workers sleep until a camera delivers a frame, and idle streams (nobody in the room) only get a
+cheap motion check a few times a second, so CPU time follows the number of active streams, not
+the number of configured ones.
+
+The models run in static image mode: consecutive frames of a stream can go to different
+workers, so the model must not track between frames (the crop around the last hand does that).
+
+Usage:
+    manager = StreamManager([0, 1, "hall.mp4"], on_gesture_factory, workers=2).start()
+    while manager.running:
+        packet = manager.get()      # only if display=True
+        ...
+        manager.done(packet)
+    print(manager.stats())
+    manager.stop()
+'''
+
+
+class Helper:
+    WORKERS = 2
+    # seconds a worker waits before looking at the streams again when some of them are idle
+    POLL_INTERVAL = 0.05
+    GET_TIMEOUT = 0.1
+    # latencies kept per stream for the percentiles
+    LATENCY_SAMPLES = 256
+    DISPLAY_QUEUE_SIZE = 4
+    # frames of a stream held at once: the display queue, one being processed,
+    # one waiting to be read and one being written by the camera
+    BUFFERS = DISPLAY_QUEUE_SIZE + 3
+
+
+# one frame of a stream after processing
+class StreamPacket:
+    def __init__(self, stream, frame, hand, gesture):
+        self.stream = stream
+        self.frame = frame
+        self.hand = hand
+        self.gesture = gesture
+
+
+# state of one camera
+class _Stream:
+    def __init__(self, name, source, on_frame, on_gesture, pattern_data, idle_monitor):
+        self.name = name
+        self.capture = camera_capture.CameraCapture(source, Helper.BUFFERS, on_frame)
+        # the model is given by the worker on every frame
+        self.tracker = landmark_detection.HandTracker(None)
+        self.idle_monitor = idle_monitor
+        self.pattern_data = pattern_data
+        self.on_gesture = on_gesture
+        # a worker is processing a frame of this stream
+        self.busy = False
+        # idle stream, nothing to look at before this time
+        self.not_before = 0.0
+        # counters
+        self.processed = 0
+        self.inferred = 0
+        self.latencies = collections.deque(maxlen=Helper.LATENCY_SAMPLES)
+        self.start_time = None
+
+    def stats(self, now):
+        elapsed = max(now - self.start_time, 1e-9) if self.start_time else 1e-9
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return round(latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000, 1)
+        return {
+            "fps": round(self.processed / elapsed, 1),
+            "inference_fps": round(self.inferred / elapsed, 1),
+            "latency_p50_ms": percentile(0.5),
+            "latency_p95_ms": percentile(0.95),
+            "frames": self.capture.stats(),
+            "idle": self.idle_monitor.stats(now) if self.idle_monitor is not None else None,
+        }
+
+
+class StreamManager:
+    def __init__(self, sources, on_gesture_factory, workers=Helper.WORKERS, pattern_factory=None, idle=True,
+                 display=False, classifier_data=None):
+        """
+        :param sources: camera indexes or video files (one stream each)
+        :param on_gesture_factory: called with the stream name, returns the on_gesture(gesture, timestamp,
+                                   confidences) callback of the stream (see pipeline.Pipeline), called
+                                   from a worker, one frame of a stream at a time
+        :param workers: number of hand models shared by all streams
+        :param pattern_factory: called with the stream name, returns the pattern tracker of the stream
+                                (None -> pattern_detection.init(draw=False))
+        :param idle: stop running the model on streams where nobody is in front of the camera
+        :param display: keep processed frames for get() (frames are released right away otherwise)
+        :param classifier_data: gesture classifier returned by gesture_detection.init(), shared by the workers
+                                (None -> hand written rules)
+        """
+        self.workers = workers
+        self.display = display
+        self.classifier_data = classifier_data
+        self.condition = threading.Condition()
+        self.streams = []
+        for index, source in enumerate(sources):
+            # the same camera can be given twice (e.g. for testing), names have to be unique
+            name = str(source) if sources.count(source) == 1 else f"{source}#{index}"
+            pattern_data = pattern_factory(name) if pattern_factory is not None else pattern_detection.init(draw=False)
+            idle_monitor = idle_detection.IdleMonitor() if idle else None
+            self.streams.append(_Stream(name, source, self.__notify, on_gesture_factory(name), pattern_data, idle_monitor))
+        # next stream a worker looks at
+        self.cursor = 0
+        self.display_queue = collections.deque()
+        self.stopped = False
+        self.threads = []
+
+    @property
+    def running(self):
+        return not self.stopped and any(stream.capture.running for stream in self.streams)
+
+    def start(self):
+        now = time.monotonic()
+        for stream in self.streams:
+            stream.capture.start()
+            stream.start_time = now
+        self.threads = [threading.Thread(target=self.__work, daemon=True) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        while self.display_queue:
+            packet = self.display_queue.popleft()
+            packet.stream.capture.release(packet.frame)
+        for stream in self.streams:
+            stream.capture.stop()
+
+    # next processed frame of any stream (display=True), None if nothing is ready yet
+    def get(self, timeout=Helper.GET_TIMEOUT):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.display_queue or self.stopped, timeout):
+                return None
+            return self.display_queue.popleft() if self.display_queue else None
+
+    # display is done with the packet, frame buffer can be reused
+    def done(self, packet):
+        packet.stream.capture.release(packet.frame)
+
+    def stats(self):
+        now = time.monotonic()
+        return {stream.name: stream.stats(now) for stream in self.streams}
+
+    # a camera has a new frame (or stopped)
+    def __notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    # next stream with a new frame in round-robin order, must be called with the condition held
+    def __next_frame(self):
+        now = time.monotonic()
+        count = len(self.streams)
+        for offset in range(count):
+            index = (self.cursor + offset) % count
+            stream = self.streams[index]
+            if stream.busy or now < stream.not_before:
+                continue
+            frame = stream.capture.read(0)
+            if frame is not None:
+                stream.busy = True
+                self.cursor = (index + 1) % count
+                return stream, frame
+        return None, None
+
+    def __work(self):
+        hands = landmark_detection.init(static_image_mode=True)
+        while True:
+            with self.condition:
+                stream, frame = self.__next_frame()
+                while frame is None and not self.stopped:
+                    # idle streams are looked at again after their interval
+                    idle = any(idle_stream.not_before for idle_stream in self.streams)
+                    self.condition.wait(Helper.POLL_INTERVAL if idle else None)
+                    stream, frame = self.__next_frame()
+                if self.stopped:
+                    if frame is not None:
+                        stream.capture.release(frame)
+                        stream.busy = False
+                    return
+
+            try:
+                packet = self.__process(stream, frame, hands)
+            except Exception as error:
+                # one broken frame must not stop the worker
+                print(f"Stream {stream.name} failed: {error}")
+                stream.capture.release(frame)
+            else:
+                self.__show(packet)
+            finally:
+                with self.condition:
+                    stream.busy = False
+                    # another frame of this stream may be waiting
+                    self.condition.notify()
+
+    def __process(self, stream, frame, hands):
+        hand = None
+        monitor = stream.idle_monitor
+        if monitor is None or monitor.should_infer(frame.image, frame.timestamp):
+            hand = stream.tracker.run(frame.image, hands)
+            stream.inferred += 1
+            if monitor is not None:
+                monitor.update(hand is not None, frame.timestamp)
+        if monitor is not None:
+            stream.not_before = frame.timestamp + monitor.wait_time(frame.timestamp) if monitor.idle else 0.0
+
+        gesture, confidences = gesture_detection.classify(hand, self.classifier_data)
+        stream.on_gesture(gesture, frame.timestamp, confidences)
+        pattern_detection.run(hand, stream.pattern_data)
+        stream.processed += 1
+        stream.latencies.append(time.monotonic() - frame.timestamp)
+        return StreamPacket(stream, frame, hand, gesture)
+
+    # keep the packet for get(), or give the frame back if nothing is displayed
+    def __show(self, packet):
+        if not self.display:
+            packet.stream.capture.release(packet.frame)
+            return
+        with self.condition:
+            # nobody is looking at old frames, give them back
+            if len(self.display_queue) >= Helper.DISPLAY_QUEUE_SIZE:
+                old = self.display_queue.popleft()
+                old.stream.capture.release(old.frame)
+            self.display_queue.append(packet)
+            self.condition.notify_all()
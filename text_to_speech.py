@@ -1,49 +1,262 @@
-from gtts import gTTS
-from mutagen.mp3 import MP3
-from threading import Thread
+from threading import Thread, Lock, Condition, get_ident
 from time import sleep
-import time
+import hashlib
 import os
+import subprocess
+import time
 from sys import platform
 
 # -------------------------------------------------------
 # Program simply converts text to speech and plays it
+#
+# Synthesized audio is kept on disk (tts_cache/), named by a hash of the text and language,
+# so a phrase is only sent to gTTS the first time it is said. Cached phrases play right
+# away and also work without an internet connection. The least recently played files are
+# removed when the cache grows over MAX_CACHE_BYTES.
+#
+# Messages are played one at a time by a single worker thread (mpg123 is waited on, not
+# slept on). A message that is already queued is replaced by the new one, messages that
+# waited longer than DEADLINE are dropped and an error message interrupts a status message.
+#
+# Methods (available to use):
+# speak text (returns right away), priority: PRIORITY_ERROR or PRIORITY_STATUS
+# run(text, priority)
+# synthesize phrases that will be said later in the background (returns the thread)
+# prewarm(phrases)
+# stop playing
+# stop()
 # -------------------------------------------------------
 
-# run in a different thread so it runs concurrently
-def run(text):
-    thread = Thread(target = __text_to_speech, args = (text, ))
+class Helper:
+    LANGUAGE = "en"
+    CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tts_cache")
+    # size of the cache before old files are removed
+    MAX_CACHE_BYTES = 20 * 1024 * 1024
+    # messages waiting to be played, seconds a message may wait before it is dropped
+    QUEUE_SIZE = 4
+    DEADLINE = 5.0
+    # lower is played first, an error interrupts a status message that is playing
+    PRIORITY_ERROR, PRIORITY_STATUS = 0, 1
+    STOP_TIMEOUT = 1.0
+
+    # cache files are written and evicted from different threads
+    lock = Lock()
+    # prewarmed phrases are never evicted
+    pinned = set()
+
+# a text waiting to be played
+class _Message:
+    def __init__(self, text, priority, deadline):
+        self.text = text
+        self.priority = priority
+        self.created = time.monotonic()
+        self.deadline = self.created + deadline
+
+    def is_stale(self):
+        return time.monotonic() > self.deadline
+
+# plays one message at a time on a single worker thread
+class _Player:
+    def __init__(self, get_audio_file, play):
+        # module functions, their names would be mangled inside the class
+        self.get_audio_file = get_audio_file
+        self.play = play
+        self.queue = []
+        self.condition = Condition()
+        self.thread = None
+        self.process = None
+        self.playing = None
+        self.stopped = False
+        # counters
+        self.played = 0
+        self.coalesced = 0
+        self.dropped_stale = 0
+        self.dropped_full = 0
+        self.preempted = 0
+
+    def submit(self, text, priority, deadline):
+        with self.condition:
+            if self.stopped:
+                return
+            if self.thread is None:
+                self.thread = Thread(target=self.__run, daemon=True)
+                self.thread.start()
+
+            message = _Message(text, priority, deadline)
+            # same text is already waiting, only the newest is played
+            for queued in self.queue:
+                if queued.text == text:
+                    self.queue.remove(queued)
+                    message.priority = min(message.priority, queued.priority)
+                    self.coalesced += 1
+                    break
+            # queue is full, drop the oldest of the least important messages (or the new one)
+            if len(self.queue) >= Helper.QUEUE_SIZE:
+                dropped = max(self.queue, key=lambda queued: (queued.priority, -queued.created))
+                self.dropped_full += 1
+                if dropped.priority < message.priority:
+                    return
+                self.queue.remove(dropped)
+            self.queue.append(message)
+
+            # an error interrupts the status message that is playing
+            if self.playing is not None and message.priority < self.playing.priority:
+                self.__stop_process()
+                self.preempted += 1
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.queue.clear()
+            self.__stop_process()
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(Helper.STOP_TIMEOUT)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "played": self.played,
+                "coalesced": self.coalesced,
+                "dropped_stale": self.dropped_stale,
+                "dropped_full": self.dropped_full,
+                "preempted": self.preempted,
+                "queued": len(self.queue),
+            }
+
+    # must be called with the condition held
+    def __stop_process(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    def __run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or self.stopped)
+                if self.stopped:
+                    return
+                # most important message first, then the oldest
+                message = min(self.queue, key=lambda queued: (queued.priority, queued.created))
+                self.queue.remove(message)
+                if message.is_stale():
+                    self.dropped_stale += 1
+                    continue
+                self.playing = message
+
+            try:
+                filename = self.get_audio_file(message.text, Helper.LANGUAGE)
+                # synthesizing can take a while, the message might be old now
+                if filename is not None and not message.is_stale():
+                    self.play(self, filename)
+            except Exception as error:
+                # a failing player must not stop the worker
+                print(f"Text to speech failed: {error}")
+            finally:
+                with self.condition:
+                    self.playing = None
+                    self.process = None
+
+# speak text (returns right away, messages are played one at a time)
+def run(text, priority=Helper.PRIORITY_STATUS, deadline=Helper.DEADLINE):
+    _player.submit(text, priority, deadline)
+
+# stop playing and drop the queued messages
+def stop():
+    _player.stop()
+
+# counters of the player
+def stats():
+    return _player.stats()
+
+# synthesize phrases in the background so they play instantly later
+def prewarm(phrases, lang=Helper.LANGUAGE):
+    thread = Thread(target = __prewarm, args = (list(phrases), lang), daemon=True)
     thread.start()
+    return thread
 
-def __text_to_speech(text):
-    # ensure filename is unique
-    filename = f"output_{time.time()}.mp3"
-    
-    # convert text to speech
-    try:
-        audio = gTTS(text=text, lang="en", slow=False)
-    except: 
-        # there might not be an internet connection
-        return
-    
-    # save text to speech in a mp3 file
-    audio.save(filename)
+def __prewarm(phrases, lang):
+    synthesized = 0
+    for text in phrases:
+        filename = __get_audio_file(text, lang)
+        if filename is None:
+            # there might not be an internet connection, try again on next start
+            break
+        Helper.pinned.add(filename)
+        synthesized += 1
+    print(f"Text to speech: {synthesized}/{len(phrases)} phrases cached")
+
+# play an audio file and wait until it is done (or interrupted)
+def __play(player, filename):
     # start playing audio file (change command based on system)
     if platform == "linux" or platform == "linux2":
-        os.system(f"mpg123 {filename}")
+        with player.condition:
+            if player.stopped:
+                return
+            player.process = subprocess.Popen(["mpg123", "-q", filename], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            process = player.process
+        # a preempted (terminated) message does not count as played
+        if process.wait() == 0:
+            with player.condition:
+                player.played += 1
     elif platform == "win32":
-        os.system(f"start {filename}")
-    # delete file after it was played
-    __delete_file(filename)
-    
-# delete audio file after it has been played
-def __delete_file(filename):
-    if os.path.isfile(filename):
-        # get duration of audio file
-        audio_duration = MP3(filename).info.length
-        # delay is added to ensure audio file has been played
-        sleep(audio_duration)
-        # remove file since it is no longer needed
-        os.remove(filename)
-    else: 
-        print(f"Error: {filename} audio-file not found")
\ No newline at end of file
+        # windows opens the file in the default player, it can not be waited on
+        from mutagen.mp3 import MP3
+        os.startfile(filename)
+        with player.condition:
+            player.played += 1
+        sleep(MP3(filename).info.length)
+
+# cache file of a text (same text and language -> same file)
+def __cache_path(text, lang):
+    key = hashlib.sha1(f"{lang}\0{text}".encode("utf-8")).hexdigest()
+    return os.path.join(Helper.CACHE_DIR, f"{key}.mp3")
+
+# returns the audio file of a text, it is only synthesized if not cached (None if it could not be)
+def __get_audio_file(text, lang):
+    filename = __cache_path(text, lang)
+    with Helper.lock:
+        if os.path.isfile(filename):
+            # mark as recently used
+            os.utime(filename)
+            return filename
+
+    # save under a temporary name so a half written file is never played
+    temp_filename = f"{filename}.{os.getpid()}.{get_ident()}.tmp"
+    # convert text to speech (gTTS is only imported when something has to be synthesized)
+    try:
+        from gtts import gTTS
+        audio = gTTS(text=text, lang=lang, slow=False)
+        os.makedirs(Helper.CACHE_DIR, exist_ok=True)
+        audio.save(temp_filename)
+    except:
+        # there might not be an internet connection, do not leave the half written file behind
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+        return None
+
+    with Helper.lock:
+        os.replace(temp_filename, filename)
+        __evict(filename)
+    return filename
+
+# remove least recently used files until the cache fits in MAX_CACHE_BYTES
+def __evict(keep):
+    files = []
+    for entry in os.scandir(Helper.CACHE_DIR):
+        if entry.name.endswith(".mp3"):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    cache_size = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if cache_size <= Helper.MAX_CACHE_BYTES:
+            break
+        if path == keep or path in Helper.pinned:
+            continue
+        os.remove(path)
+        cache_size -= size
+
+_player = _Player(__get_audio_file, __play)